@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import os
+import signal
+from typing import Any, Dict, Optional, Tuple
+
+from .client import BrokerError, Session, ThrottledError
+from .flow import InputQueue, end_stream
+from .message import Message, MessageType, ProtocolError, negotiate
+
+# Broker certificate, compression offered, client certificate and key
+SessionKey = Tuple[str, Tuple[str, ...], Optional[str], Optional[str]]
+
+
+class Agent:
+    """Runs requests for command line clients on this host over warm connections to servers.
+
+    Every run of the command line client otherwise starts from scratch, with a new SSL
+    context and a full TLS handshake. The agent listens on a Unix socket that only its
+    user can connect to, and speaks the same protocol as the server. Requests name the
+    server to run them on, which the agent keeps a pool of connections to.
+    """
+
+    def __init__(self, params: argparse.Namespace):
+        self.socket_path = params.agent_socket
+        # Sessions by certificates and compression offered, each pooling connections per server
+        self.sessions: Dict[SessionKey, Session] = {}
+        self.serving: Optional[asyncio.Future] = None
+
+    def session(self, server: Dict[str, Any]) -> Session:
+        """The session for the certificates and compression named by a request."""
+        key = (
+            server["broker_cert"],
+            tuple(server.get("compression", ())),
+            server.get("client_cert"),
+            server.get("client_key"),
+        )
+        if key not in self.sessions:
+            broker_cert, compression, client_cert, client_key = key
+            self.sessions[key] = Session(
+                broker_cert,
+                compression=compression,
+                client_cert=client_cert,
+                client_key=client_key,
+            )
+        return self.sessions[key]
+
+    def stop(self) -> None:
+        if self.serving is not None:
+            print("Agent stopped by user.")
+            self.serving.cancel()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+
+        # Other users must not be able to run commands through the agent
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle_client, self.socket_path)
+        finally:
+            os.umask(umask)
+        print(f"Agent listening on {self.socket_path}. Press Ctrl+C to stop.")
+        try:
+            self.serving = asyncio.ensure_future(server.serve_forever())
+            await self.serving
+        except asyncio.exceptions.CancelledError:
+            # Stopped by a signal, see self.stop()
+            pass
+        finally:
+            server.close()
+            await asyncio.gather(*(session.close() for session in self.sessions.values()))
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.socket_path)
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Pass on the requests of a client until it disconnects."""
+        stdin_queues: Dict[int, InputQueue] = {}
+        tasks: Dict[int, asyncio.Task] = {}
+        try:
+            hello = await Message.async_read(reader)
+            welcome = {"version": negotiate(hello)}
+            await Message.build(welcome, 0, MessageType.HELLO).async_write(writer)
+
+            while True:
+                message = await Message.async_read(reader)
+                if message.type == MessageType.REQUEST:
+                    stdin_queue = InputQueue(message.stream_id, writer)
+                    stdin_queues[message.stream_id] = stdin_queue
+                    task = asyncio.create_task(self.forward(message, stdin_queue, writer))
+                    task.add_done_callback(
+                        functools.partial(end_stream, stdin_queues, tasks, message.stream_id)
+                    )
+                    tasks[message.stream_id] = task
+                elif message.type == MessageType.STDIN and message.stream_id in stdin_queues:
+                    await stdin_queues[message.stream_id].put(message.text)
+                elif message.type == MessageType.CANCEL and message.stream_id in tasks:
+                    # The client gave up on the request, which cancels it on the server too
+                    tasks[message.stream_id].cancel()
+        except ProtocolError as err:
+            # Let the client know why it is being disconnected, if it is still there
+            with contextlib.suppress(ConnectionError):
+                await Message.build({"error": str(err)}, 0, MessageType.HELLO).async_write(writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client closed the connection
+            pass
+        finally:
+            # Nobody is left to read the output, stop the requests that are still running
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def forward(
+        self, request: Message, stdin_queue: InputQueue, writer: asyncio.StreamWriter
+    ) -> None:
+        """Run a request on the server it names, passing its output back to the client."""
+        try:
+            payload = request.json()
+            server = payload.pop("server")
+            session = self.session(server)
+            stdin = stdin_queue.chunks() if payload.pop("stdin", False) else None
+            async with session.pool(server["address"], server["port"]).borrow() as connection:
+                async for response in connection.request(payload, stdin):
+                    # Decompressed already, and renumbered for the client's stream
+                    message = Message(response.type, response.text, request.stream_id)
+                    await message.async_write(writer)
+        except (ValueError, KeyError, BrokerError, OSError) as err:
+            # OSError covers servers that cannot be reached and certificates that do not verify
+            end: Dict[str, Any] = {"error": str(err)}
+            if isinstance(err, ThrottledError):
+                end["throttled"] = err.details
+            response = Message.build(end, request.stream_id, MessageType.END)
+            await response.async_write(writer)
@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import secrets
+import signal
+import socket
+import sys
+import tempfile
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple, cast
+
+from . import __version__, eventloop
+from .client import Connection, Session, client_ssl_context
+
+# Seconds to wait for the benchmarked server to start listening
+STARTUP_TIMEOUT = 30
+
+
+def percentiles(values: Sequence[float]) -> Dict[str, float]:
+    """Summarize `values` with their mean and nearest-rank percentiles."""
+    ordered = sorted(values)
+
+    def rank(percentile: int) -> float:
+        return ordered[max(math.ceil(len(ordered) * percentile / 100) - 1, 0)]
+
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": ordered[-1],
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.asynccontextmanager
+async def local_server(
+    directory: str, max_processes: int, server_args: Sequence[str] = ()
+) -> AsyncIterator[Tuple[str, int, str]]:
+    """Run a server on localhost with a freshly generated certificate, in its own process.
+
+    Yields the address and port it listens on and the certificate to verify it with.
+    """
+    address, port = "127.0.0.1", free_port()
+    broker_cert = os.path.join(directory, "broker-cert.pem")
+    # fmt: off
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "cmdbroker", "--server", "--generate-cert-and-key",
+        "--config", os.path.join(directory, "cmdbroker.json"),
+        "--address", address, "--port", str(port),
+        "--password", secrets.token_hex(16),
+        "--broker-cert", broker_cert, "--broker-key", os.path.join(directory, "broker-key.pem"),
+        "--cert-country", "US", "--cert-state", "CA", "--cert-locality", "Benchmark",
+        "--cert-org", "cmdbroker", "--max-processes", str(max_processes), *server_args,
+        stdout=asyncio.subprocess.PIPE,
+        # Print the startup message as soon as the server is listening
+        env={**os.environ, "PYTHONUNBUFFERED": "1"},
+    )
+    # fmt: on
+    stdout = cast(asyncio.StreamReader, process.stdout)
+    try:
+        while True:
+            line = await asyncio.wait_for(stdout.readline(), STARTUP_TIMEOUT)
+            if line.startswith(b"Server listening"):
+                break
+            if not line:
+                raise RuntimeError("The benchmark server did not start")
+        yield address, port, broker_cert
+    finally:
+        with contextlib.suppress(ProcessLookupError):
+            process.send_signal(signal.SIGINT)
+        await process.wait()
+
+
+async def measure_latency(
+    session: Session, address: str, port: int, command: str, requests: int, concurrency: int
+) -> Dict[str, Any]:
+    """Run `command` `requests` times, `concurrency` at a time, timing each run."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run() -> float:
+        async with semaphore:
+            result = await session.run(address, port, command, cache=False)
+        return result.timings["total"]
+
+    started = time.perf_counter()
+    latencies = await asyncio.gather(*(run() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "command": command,
+        "requests": requests,
+        "concurrency": concurrency,
+        "requests_per_second": requests / elapsed,
+        "latency": percentiles(latencies),
+    }
+
+
+async def measure_throughput(
+    session: Session, address: str, port: int, payload_size: int
+) -> Dict[str, float]:
+    """Time moving `payload_size` random bytes through stdout and through stdin."""
+    started = time.perf_counter()
+    result = await session.run(address, port, f"head -c {payload_size} /dev/urandom", cache=False)
+    stdout_time = time.perf_counter() - started
+    if len(result.stdout) != payload_size:
+        raise RuntimeError(f"Expected {payload_size} bytes of output, got {len(result.stdout)}")
+
+    payload = os.urandom(payload_size)
+    started = time.perf_counter()
+    result = await session.run(address, port, "wc -c", payload, cache=False)
+    stdin_time = time.perf_counter() - started
+    if int(result.stdout) != payload_size:
+        raise RuntimeError(f"Expected {payload_size} bytes of input, got {int(result.stdout)}")
+
+    return {
+        "payload_bytes": payload_size,
+        "stdout_mb_per_second": payload_size / stdout_time / 1e6,
+        "stdin_mb_per_second": payload_size / stdin_time / 1e6,
+    }
+
+
+async def measure_connect(
+    address: str, port: int, broker_cert: str, connections: int
+) -> Dict[str, Dict[str, float]]:
+    """Time opening connections with full TLS handshakes and with resumed sessions."""
+
+    async def connect(resume: bool) -> float:
+        if not resume:
+            # A new SSL context has no session to resume
+            client_ssl_context.cache_clear()
+        connection = Connection(address, port, broker_cert)
+        started = time.perf_counter()
+        await connection.open()
+        elapsed = time.perf_counter() - started
+        # Wait for the server's first response, which carries the session tickets
+        async for _ in connection.request({"method": "status"}):
+            pass
+        await connection.close()
+        return elapsed
+
+    timings: Dict[str, Dict[str, float]] = {}
+    for resume in (False, True):
+        elapsed: List[float] = []
+        for _ in range(connections):
+            elapsed.append(await connect(resume))
+        timings["resumed" if resume else "full"] = percentiles(elapsed)
+    return timings
+
+
+async def benchmark(params: argparse.Namespace) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        server_args = ["--event-loop", params.event_loop, *params.server_args]
+        server = local_server(directory, params.concurrency, server_args)
+        async with server as (address, port, broker_cert):
+            connect = await measure_connect(address, port, broker_cert, params.connections)
+            async with Session(broker_cert) as session:
+                latency = await measure_latency(
+                    session, address, port, params.command, params.requests, params.concurrency
+                )
+                throughput = await measure_throughput(session, address, port, params.payload_size)
+        client_ssl_context.cache_clear()
+
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "event_loop": eventloop.resolve(params.event_loop),
+        "server_args": params.server_args,
+        **latency,
+        "throughput": throughput,
+        "connect": connect,
+    }
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="cmdbroker-benchmark",
+        description="Benchmark a cmdbroker server on localhost and print the results as JSON.",
+    )
+    parser.add_argument("--requests", type=int, default=500, help="The number of commands to time")
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="The number of commands to run at once"
+    )
+    parser.add_argument("--command", type=str, default="true", help="The command to time")
+    parser.add_argument(
+        "--payload-size",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="The number of bytes to send through stdin and stdout for the throughput figures",
+    )
+    parser.add_argument(
+        "--connections", type=int, default=20, help="The number of connections to time"
+    )
+    parser.add_argument(
+        "--event-loop",
+        type=str,
+        choices=eventloop.EVENT_LOOPS,
+        default="asyncio",
+        help="The event loop the client and server run on, to compare them",
+    )
+    parser.add_argument(
+        "--output", type=str, help="The file to write the results to instead of stdout"
+    )
+    parser.add_argument(
+        "server_args",
+        nargs=argparse.REMAINDER,
+        help="Options for the server, after --, for example -- --warm-shells 8",
+    )
+    params = parser.parse_args(argv)
+    if params.server_args[:1] == ["--"]:
+        params.server_args = params.server_args[1:]
+
+    results = json.dumps(eventloop.run(benchmark(params), params.event_loop), indent=2)
+    if params.output:
+        with open(params.output, "w") as f:
+            f.write(results + "\n")
+    else:
+        print(results)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from .message import MessageType
+
+
+class Recording:
+    """The output of a command as it is streamed, given up on once it outgrows the cache."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.output: List[Tuple[MessageType, bytes]] = []
+        self.size = 0
+        self.complete = True
+
+    def add(self, message_type: MessageType, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            self.complete = False
+            self.output = []
+        else:
+            self.output.append((message_type, chunk))
+
+
+@dataclass
+class Entry:
+    """The output and END response of a command that ran."""
+
+    output: List[Tuple[MessageType, bytes]]
+    response: Dict[str, Any]
+    size: int
+    expires: float
+
+
+class ResultCache:
+    """Shares the results of identical commands run within `ttl` seconds of each other.
+
+    Entries are evicted least recently used first once their output adds up to more
+    than `max_size` bytes. Identical requests arriving while a command runs wait for
+    it instead of running it again.
+    """
+
+    def __init__(self, ttl: float, max_size: int, env: Iterable[str] = ()):
+        self.ttl = ttl
+        self.max_size = max_size
+        # Environment variables that change what a command outputs
+        self.env = sorted(env)
+        self.entries: "OrderedDict[str, Entry]" = OrderedDict()
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def key(self, command: str, stdin: bytes, env: Mapping[str, str]) -> str:
+        digest = hashlib.sha256()
+        allowed_env = {name: env.get(name) for name in self.env}
+        for part in (command.encode("utf-8"), stdin, json.dumps(allowed_env).encode("utf-8")):
+            # Length prefixed so the parts cannot run into each other
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Entry]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= time.monotonic():
+            self.evict(key)
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: Entry) -> None:
+        if key in self.entries:
+            self.evict(key)
+        while self.entries and self.size + entry.size > self.max_size:
+            self.evict(next(iter(self.entries)))
+        self.entries[key] = entry
+        self.size += entry.size
+
+    def evict(self, key: str) -> None:
+        self.size -= self.entries.pop(key).size
+
+    async def fetch(
+        self, key: str, run: Callable[[Recording], Awaitable[Dict[str, Any]]]
+    ) -> Tuple[Entry, bool]:
+        """Get the result for `key`, calling `run` to produce it if nobody else is.
+
+        Also returns whether the result is shared, in which case its output still has to be
+        sent to the client. Otherwise `run` already streamed it while recording it.
+        """
+        while (entry := self.get(key)) is None and key in self.pending:
+            # An identical request is running, wait for its result
+            entry = await asyncio.shield(self.pending[key])
+            if entry is not None:
+                self.coalesced += 1
+                return entry, True
+        if entry is not None:
+            return entry, True
+
+        self.misses += 1
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            recording = Recording(self.max_size)
+            response = await run(recording)
+            entry = Entry(recording.output, response, recording.size, time.monotonic() + self.ttl)
+            if recording.complete and response["returncode"] == 0:
+                self.put(key, entry)
+            return entry, False
+        finally:
+            del self.pending[key]
+            # Requests waiting on an incomplete result run the command themselves
+            future.set_result(entry if entry is not None and recording.complete else None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -1,32 +1,50 @@
 import argparse
-import asyncio
 import json
 import os
 
-from .client import Client
-from .server import Server
+from . import eventloop
+from .client import Client, default_agent_socket
+from .compression import CODECS
+from .message import CHUNK_SIZE, MAX_FRAME_SIZE
+
+COMPRESSIONS = ["auto", "none", *CODECS]
 
 
 # Main function to start server and client
 async def main(args: argparse.Namespace):
     if args.server:
+        # Clients do not pay for importing the server, its scheduler, cache and metrics
+        from .server import Server
+
         await Server(args).run()
+    elif args.agent:
+        from .agent import Agent
+
+        await Agent(args).run()
     else:
         await Client(args).run()
 
 
-async def run():
+def load_config(path):
+    if path and os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parse the command line, defaulting options to the configuration file.
+
+    Exits with a usage message if they are invalid. The server parses them again to reload.
+    """
     parser = argparse.ArgumentParser(prog="cmdbroker", description="Run as server or client.")
     parser.add_argument(
         "--config", type=str, default="cmdbroker.json", help="Path to the configuration file"
     )
     # Temporarily parse known args to get config file path
-    temp_args, _ = parser.parse_known_args()
+    temp_args, _ = parser.parse_known_args(argv)
 
-    config = {}
-    if temp_args.config and os.path.exists(temp_args.config):
-        with open(temp_args.config, "r") as f:
-            config = json.load(f)
+    config = load_config(temp_args.config)
 
     # Define all other arguments
     parser.add_argument(
@@ -42,6 +60,24 @@ async def run():
         help="Run in server mode",
         default=config.get("server", False),
     )
+    parser.add_argument(
+        "--agent",
+        action="store_true",
+        help="Run an agent that keeps connections to servers warm for the clients on this host",
+        default=config.get("agent", False),
+    )
+    parser.add_argument(
+        "--agent-socket",
+        type=str,
+        default=config.get("agent-socket", default_agent_socket()),
+        help="The Unix socket the agent listens on, and clients look for it on",
+    )
+    parser.add_argument(
+        "--no-agent",
+        action="store_true",
+        help="Connect to the server directly even if an agent is running",
+        default=config.get("no-agent", False),
+    )
     parser.add_argument(
         "--generate-cert-and-key",
         action="store_true",
@@ -96,23 +132,266 @@ async def run():
         default=config.get("broker-cert", "broker-cert.pem"),
         help="The broker certificate file",
     )
+    parser.add_argument(
+        "--client-ca",
+        type=str,
+        default=config.get("client-ca"),
+        help="Require clients to present a certificate signed by the CA in this file",
+    )
+    parser.add_argument(
+        "--client-cert",
+        type=str,
+        default=config.get("client-cert"),
+        help="The certificate to present to servers that require one",
+    )
+    parser.add_argument(
+        "--client-key",
+        type=str,
+        default=config.get("client-key"),
+        help="The key of --client-cert, unless the certificate file holds it",
+    )
     parser.add_argument(
         "--address",
         type=str,
-        required="address" not in config,
         help="The address to bind to",
         default=config.get("address"),
     )
     parser.add_argument(
         "--port", type=int, default=config.get("port", 8889), help="The port to bind to"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.get("workers", 1),
+        help="The number of server processes sharing the port, to use more than one core",
+    )
+    parser.add_argument(
+        "--max-processes",
+        type=int,
+        default=config.get("max-processes", 32),
+        help="The maximum number of commands the server runs at once",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=config.get("max-queued", 256),
+        help="The maximum number of commands waiting for their turn to run on the server",
+    )
+    parser.add_argument(
+        "--max-client-processes",
+        type=int,
+        default=config.get("max-client-processes", 0),
+        help="The maximum number of commands of a single client running or waiting at once,"
+        " 0 for no limit",
+    )
+    parser.add_argument(
+        "--rate-limit-requests",
+        type=float,
+        default=config.get("rate-limit-requests", 0),
+        help="The requests per second the server accepts from a single client, 0 for no limit",
+    )
+    parser.add_argument(
+        "--rate-limit-bytes",
+        type=float,
+        default=config.get("rate-limit-bytes", 0),
+        help="The bytes per second of stdin and output the server lets a single client transfer,"
+        " 0 for no limit",
+    )
+    parser.add_argument(
+        "--max-frame-size",
+        type=int,
+        default=config.get("max-frame-size", MAX_FRAME_SIZE),
+        help="The largest message in bytes the server accepts from a client",
+    )
+    parser.add_argument(
+        "--warm-shells",
+        type=int,
+        default=config.get("warm-shells", 0),
+        help="The number of shells the server starts ahead of time for upcoming commands",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=config.get("metrics-port", 0),
+        help="The port the server serves Prometheus metrics on over plain HTTP, 0 disables it",
+    )
+    parser.add_argument(
+        "--log-requests",
+        action="store_true",
+        help="Print a JSON line with the id, outcome and phase timings of each request",
+        default=config.get("log-requests", False),
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=config.get("timeout", 0),
+        help="Seconds a command may run for before it and the processes it started are stopped,"
+        " for the server the default of requests that do not set one, 0 for no limit",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=config.get("drain-timeout", 30),
+        help="Seconds the server lets the requests in flight finish for when it stops or restarts,"
+        " before their commands are stopped",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=config.get("cache-ttl", 0),
+        help="Seconds the server reuses the output of identical commands for, 0 disables it",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=config.get("cache-size", 64 * 1024 * 1024),
+        help="The most output in bytes the server keeps cached",
+    )
+    parser.add_argument(
+        "--cache-env",
+        type=str,
+        nargs="*",
+        default=config.get("cache-env", ["HOME", "LANG", "PATH"]),
+        help="Environment variables whose values are part of the cache key",
+    )
+    parser.add_argument(
+        "--exec",
+        action="store_true",
+        help="Run the command as a program with arguments, without a shell on the server",
+        default=config.get("exec", False),
+    )
+    parser.add_argument(
+        "--cwd",
+        type=str,
+        default=config.get("cwd"),
+        help="The working directory of the command, with --exec",
+    )
+    parser.add_argument(
+        "--env",
+        type=str,
+        action="append",
+        metavar="NAME=VALUE",
+        default=config.get("env", []),
+        help="An environment variable to set for the command, with --exec",
+    )
+    parser.add_argument(
+        "--event-loop",
+        type=str,
+        choices=eventloop.EVENT_LOOPS,
+        default=config.get("event-loop", "asyncio"),
+        help="The event loop to run on, uvloop if installed for auto",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=COMPRESSIONS,
+        default=config.get("compression", "none"),
+        help="Compress stdin and output with this algorithm if the server supports it,"
+        " auto picks the best one both sides have",
+    )
+    parser.add_argument(
+        "--batch",
+        type=str,
+        metavar="FILE",
+        default=config.get("batch"),
+        help="Run the commands in FILE, one per line, in a single request (- reads stdin)",
+    )
+    parser.add_argument(
+        "--sequential",
+        action="store_true",
+        help="Run the commands of a batch one after the other",
+        default=config.get("sequential", False),
+    )
+    parser.add_argument(
+        "--max-parallel",
+        type=int,
+        default=config.get("max-parallel"),
+        help="The maximum number of commands of a batch run at once",
+    )
+    parser.add_argument(
+        "--stop-on-failure",
+        action="store_true",
+        help="Skip the commands of a batch that have not started once one fails",
+        default=config.get("stop-on-failure", False),
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always run the command, even if the server has its output cached",
+        default=config.get("no-cache", False),
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print where the time of the request went to stderr as JSON",
+        default=config.get("timings", False),
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    if not args.server and not args.command:
+    # Only the agent does without an address, requests tell it where to go
+    if not args.address and not args.agent:
+        parser.error("the following arguments are required: --address")
+
+    if args.agent and args.server:
+        parser.error("--agent and --server are exclusive")
+
+    if not args.server and not args.agent and not args.command and not args.batch:
         parser.error("You must provide a command when running in client mode")
 
-    if not args.generate_cert_and_key or not args.server:
+    if args.command and args.batch:
+        parser.error("--batch takes its commands from a file, not the command line")
+
+    if (args.sequential or args.max_parallel or args.stop_on_failure) and not args.batch:
+        parser.error("--sequential, --max-parallel and --stop-on-failure require --batch")
+
+    if args.timings and args.batch:
+        parser.error("--timings does not apply to --batch")
+
+    if (args.cwd or args.env) and not args.exec:
+        parser.error("--cwd and --env require --exec")
+
+    if any("=" not in variable for variable in args.env):
+        parser.error("--env takes NAME=VALUE")
+
+    # argparse checks choices on the command line only, not defaults from the config file
+    if args.event_loop not in eventloop.EVENT_LOOPS:
+        parser.error(f"--event-loop must be one of {', '.join(eventloop.EVENT_LOOPS)}")
+
+    if args.compression not in COMPRESSIONS:
+        parser.error(f"--compression must be one of {', '.join(COMPRESSIONS)}")
+
+    if args.timeout < 0:
+        parser.error("--timeout must not be negative")
+
+    if args.drain_timeout < 0:
+        parser.error("--drain-timeout must not be negative")
+
+    if min(args.max_client_processes, args.rate_limit_requests, args.rate_limit_bytes) < 0:
+        parser.error(
+            "--max-client-processes, --rate-limit-requests and --rate-limit-bytes"
+            " must not be negative"
+        )
+
+    if args.client_key and not args.client_cert:
+        parser.error("--client-key requires --client-cert")
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    # No command would ever get a slot, or be let past the queue limit
+    if args.max_processes < 1:
+        parser.error("--max-processes must be at least 1")
+
+    if min(args.max_queued, args.cache_size, args.warm_shells) < 0:
+        parser.error("--max-queued, --cache-size and --warm-shells must not be negative")
+
+    # Clients send stdin in chunks of this size
+    if args.max_frame_size < CHUNK_SIZE:
+        parser.error(f"--max-frame-size must be at least {CHUNK_SIZE}")
+
+    # The agent is told which certificate to verify each server with
+    if (not args.generate_cert_and_key or not args.server) and not args.agent:
         if not os.path.exists(args.broker_cert):
             parser.error("Broker certificate file not found")
 
@@ -120,8 +399,25 @@ async def run():
         if not os.path.exists(args.broker_key):
             parser.error("Broker key file not found")
 
-    await main(args)
+    return args
+
+
+async def run():
+    await main(parse_args())
+
+
+def event_loop():
+    """Find the event loop to run on, it has to be started before the other options are parsed."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--config", type=str, default="cmdbroker.json")
+    parser.add_argument("--event-loop", type=str, choices=eventloop.EVENT_LOOPS)
+    args, _ = parser.parse_known_args()
+    if args.event_loop:
+        return args.event_loop
+    event_loop = load_config(args.config).get("event-loop", "asyncio")
+    # parse_args reports an unknown one, running on the default loop
+    return event_loop if event_loop in eventloop.EVENT_LOOPS else "asyncio"
 
 
 def async_run():
-    asyncio.run(run())
+    eventloop.run(run(), event_loop())
@@ -1,10 +1,638 @@
 import argparse
 import asyncio
+import base64
+import contextlib
+import functools
+import itertools
+import json
+import os
 import select
+import shlex
 import ssl
 import sys
+import tempfile
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
-from .message import Message
+from .compression import CODECS, Codec, choose, compress, decompress
+from .flow import SendWindow
+from .message import CHUNK_SIZE, MAX_FRAME_SIZE, Message, MessageType, ProtocolError
+
+# Number of responses buffered per stream before the connection stops reading
+RESPONSE_QUEUE_SIZE = 16
+
+# Number of connections kept open to each server
+POOL_SIZE = 4
+
+
+class BrokerError(Exception):
+    """Raised when the server could not run a request."""
+
+
+class ThrottledError(BrokerError):
+    """Raised when the server turned a request away because the client went over a limit.
+
+    `details` names the limit and, for rates, the seconds to wait in `retry_after`.
+    """
+
+    def __init__(self, message: str, details: Dict[str, Any]):
+        super().__init__(message)
+        self.details = details
+
+
+# The port of the server being connected to, the TLS handshake is only told its host name
+connecting_port: ContextVar[Optional[int]] = ContextVar("connecting_port", default=None)
+
+
+class ResumableSSLContext(ssl.SSLContext):
+    """A client SSL context that resumes the last TLS session it had with each server.
+
+    Resumed sessions skip the certificate exchange and key agreement of a full handshake.
+    Servers are told apart by host name and port, see `connecting_port`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.sessions: Dict[Tuple[str, Optional[int]], ssl.SSLSession] = {}
+
+    def wrap_bio(
+        self,
+        incoming,
+        outgoing,
+        server_side=False,
+        server_hostname=None,
+        session=None,
+    ) -> ssl.SSLObject:
+        if session is None:
+            session = self.sessions.get((server_hostname, connecting_port.get()))
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+@functools.lru_cache(maxsize=None)
+def client_ssl_context(
+    broker_cert: str, client_cert: Optional[str] = None, client_key: Optional[str] = None
+) -> ResumableSSLContext:
+    """Create the SSL context used for connections verified by `broker_cert`, once.
+
+    Connections present `client_cert` to servers that require mutual TLS, with its key in
+    `client_key` or in the same file.
+    """
+    ssl_context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.check_hostname = True
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+    ssl_context.load_verify_locations(broker_cert)
+    if client_cert:
+        ssl_context.load_cert_chain(client_cert, client_key)
+    return ssl_context
+
+
+class Connection:
+    """A connection to the server that carries any number of concurrent requests."""
+
+    ssl_context: ResumableSSLContext
+    reader: asyncio.StreamReader
+    writer: asyncio.StreamWriter
+    receive_task: asyncio.Task
+
+    def __init__(
+        self,
+        address: str,
+        port: int,
+        broker_cert: str,
+        compression: Sequence[str] = (),
+        client_cert: Optional[str] = None,
+        client_key: Optional[str] = None,
+    ):
+        self.address = address
+        self.port = port
+        self.broker_cert = broker_cert
+        # Compression algorithms offered to the server, the preferred ones first
+        self.compression = compression
+        self.client_cert = client_cert
+        self.client_key = client_key
+        self.streams: Dict[int, asyncio.Queue] = {}
+        # How much stdin each request may still send, see `cmdbroker.flow`
+        self.windows: Dict[int, SendWindow] = {}
+        self.stream_ids = itertools.count(1)
+        # Protocol version and compression agreed with the server, and why it closed
+        # the connection
+        self.version: Optional[int] = None
+        self.codec: Optional[Codec] = None
+        self.error: Optional[str] = None
+        # Set once the server asked for no more requests, it is shutting down
+        self.draining = False
+
+    async def __aenter__(self) -> "Connection":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        self.ssl_context = client_ssl_context(self.broker_cert, self.client_cert, self.client_key)
+        # The handshake runs in a callback, which gets a copy of the context variables
+        token = connecting_port.set(self.port)
+        try:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.address, self.port, ssl=self.ssl_context
+            )
+        finally:
+            connecting_port.reset(token)
+        # Requests can follow right away, the server answers the HELLO first
+        await Message.hello(self.compression).async_write(self.writer)
+        self.receive_task = asyncio.create_task(self.receive())
+
+    async def close(self) -> None:
+        self.remember_session()
+        self.receive_task.cancel()
+        self.writer.close()
+        with contextlib.suppress(ConnectionError):
+            # The server may have dropped the connection, when it rejected the client certificate
+            await self.writer.wait_closed()
+
+    def remember_session(self) -> None:
+        """Keep the TLS session so the next connection to this server can resume it."""
+        if self.writer.is_closing():
+            # Remembered along with the first response already, the TLS state is gone by now
+            return
+        ssl_object = self.writer.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.session is not None:
+            self.ssl_context.sessions[self.address, self.port] = ssl_object.session
+
+    async def receive(self) -> None:
+        """Route each response from the server to the request it belongs to."""
+        try:
+            response = await Message.async_read(self.reader)
+            # TLS 1.3 session tickets are only processed along with the first response
+            self.remember_session()
+            while True:
+                if response.type == MessageType.HELLO:
+                    hello = response.json()
+                    if "error" in hello:
+                        # The server is about to close the connection
+                        self.error = hello["error"]
+                        break
+                    self.version = hello["version"]
+                    self.codec = choose([hello.get("compression", "")])
+                elif response.type == MessageType.WINDOW:
+                    if response.stream_id in self.windows:
+                        self.windows[response.stream_id].grant(response.json()["size"])
+                elif response.type == MessageType.GOAWAY:
+                    self.draining = True
+                    self.hang_up_if_idle()
+                elif response.stream_id in self.streams:
+                    response = decompress(response, self.codec, MAX_FRAME_SIZE)
+                    # A full queue holds up the connection until the request catches up
+                    await self.streams[response.stream_id].put(response)
+                response = await Message.async_read(self.reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+
+        # Wake up the requests still waiting on the server
+        for queue in self.streams.values():
+            queue.put_nowait(None)
+
+    async def request(
+        self, payload: Dict[str, Any], stdin: Optional[AsyncIterable[bytes]] = None
+    ) -> AsyncIterator[Message]:
+        """Send a request, streaming `stdin` to it, and yield its output as it arrives.
+
+        The last message yielded is the END message that describes how the request finished.
+        """
+        if self.receive_task.done():
+            raise BrokerError(self.error or "Lost the connection to the server")
+
+        stream_id = next(self.stream_ids)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=RESPONSE_QUEUE_SIZE)
+        self.streams[stream_id] = queue
+
+        stdin_task = None
+        ended = False
+        try:
+            if stdin is not None:
+                payload = {**payload, "stdin": True}
+            await Message.build(payload, stream_id).async_write(self.writer)
+            if stdin is not None:
+                window = self.windows[stream_id] = SendWindow()
+                stdin_task = asyncio.create_task(self.send_stdin(stream_id, stdin, window))
+
+            # Receive output chunks from server until the command is done
+            while True:
+                response = await queue.get()
+                if response is None:
+                    raise BrokerError(self.error or "Lost the connection to the server")
+                ended = response.type == MessageType.END
+                if ended and "error" in (end := response.json()):
+                    if "throttled" in end:
+                        raise ThrottledError(end["error"], end["throttled"])
+                    raise BrokerError(end["error"])
+
+                yield response
+
+                if ended:
+                    break
+        finally:
+            if stdin_task:
+                # The command may finish without consuming all of its input
+                stdin_task.cancel()
+            if not ended and not self.receive_task.done():
+                # Abandoned or cancelled, the server stops the command
+                Message(MessageType.CANCEL, b"", stream_id).write(self.writer)
+            del self.streams[stream_id]
+            self.windows.pop(stream_id, None)
+            while not queue.empty():
+                queue.get_nowait()
+            self.hang_up_if_idle()
+
+    def hang_up_if_idle(self) -> None:
+        """Close a connection the server is draining once its last request is done.
+
+        Hanging up is left to the client, so no request can be on its way as the server does.
+        """
+        if self.draining and not self.streams:
+            self.remember_session()
+            self.writer.close()
+
+    async def send_stdin(
+        self, stream_id: int, stdin: AsyncIterable[bytes], window: SendWindow
+    ) -> None:
+        """Send `stdin` to the server in chunks, followed by an empty chunk to mark the end.
+
+        Chunks wait for the server to open the window of the request, and are split to fit.
+        """
+        async for chunk in stdin:
+            while chunk:
+                size = await window.take(len(chunk))
+                part, chunk = chunk[:size], chunk[size:]
+                message = compress(Message(MessageType.STDIN, part, stream_id), self.codec)
+                await message.async_write(self.writer)
+        await Message(MessageType.STDIN, b"", stream_id).async_write(self.writer)
+
+
+class AgentConnection(Connection):
+    """A connection to the agent on this host, which runs requests over its warm connections.
+
+    Requests name the server they are for, see `cmdbroker.agent.Agent`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        address: str,
+        port: int,
+        broker_cert: str,
+        compression: Sequence[str] = (),
+        client_cert: Optional[str] = None,
+        client_key: Optional[str] = None,
+    ):
+        super().__init__(address, port, broker_cert, compression, client_cert, client_key)
+        self.path = path
+
+    async def open(self) -> None:
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        # Nothing to gain from compressing data between processes on the same host
+        await Message.hello().async_write(self.writer)
+        self.receive_task = asyncio.create_task(self.receive())
+
+    def remember_session(self) -> None:
+        # There is no TLS between the client and the agent
+        pass
+
+    def request(
+        self, payload: Dict[str, Any], stdin: Optional[AsyncIterable[bytes]] = None
+    ) -> AsyncIterator[Message]:
+        server = {
+            "address": self.address,
+            "port": self.port,
+            # The agent runs in a directory of its own
+            "broker_cert": os.path.abspath(self.broker_cert),
+            "compression": list(self.compression),
+        }
+        if self.client_cert:
+            server["client_cert"] = os.path.abspath(self.client_cert)
+        if self.client_key:
+            server["client_key"] = os.path.abspath(self.client_key)
+        return super().request({**payload, "server": server}, stdin)
+
+
+def default_agent_socket() -> str:
+    """Where the agent of the current user listens unless told otherwise."""
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(directory, f"cmdbroker-agent-{os.getuid()}.sock")
+
+
+def agent_running(path: str) -> bool:
+    """Whether `path` is the socket of an agent started by the current user.
+
+    Sockets of other users are ignored, they would see the commands and their input.
+    """
+    try:
+        return os.stat(path).st_uid == os.getuid()
+    except OSError:
+        return False
+
+
+class ConnectionPool:
+    """Warm connections to a single server, shared by the requests sent to it."""
+
+    def __init__(
+        self,
+        address: str,
+        port: int,
+        broker_cert: str,
+        size: int = POOL_SIZE,
+        compression: Sequence[str] = (),
+        client_cert: Optional[str] = None,
+        client_key: Optional[str] = None,
+    ):
+        self.address = address
+        self.port = port
+        self.broker_cert = broker_cert
+        self.size = size
+        self.compression = compression
+        self.client_cert = client_cert
+        self.client_key = client_key
+        # Number of requests using each connection
+        self.connections: Dict[Connection, int] = {}
+        self.lock = asyncio.Lock()
+
+    @contextlib.asynccontextmanager
+    async def borrow(self) -> AsyncIterator[Connection]:
+        """Lend the least busy connection, opening another one while all of them are busy."""
+        async with self.lock:
+            # Forget connections the server has closed or is about to
+            self.connections = {
+                connection: requests
+                for connection, requests in self.connections.items()
+                if not connection.receive_task.done() and not connection.draining
+            }
+
+            if len(self.connections) < self.size and all(self.connections.values()):
+                connection = Connection(
+                    self.address,
+                    self.port,
+                    self.broker_cert,
+                    self.compression,
+                    self.client_cert,
+                    self.client_key,
+                )
+                await connection.open()
+                self.connections[connection] = 0
+            else:
+                connection = min(self.connections, key=self.connections.__getitem__)
+            self.connections[connection] += 1
+
+        try:
+            yield connection
+        finally:
+            if connection in self.connections:
+                self.connections[connection] -= 1
+
+    async def close(self) -> None:
+        await asyncio.gather(*(connection.close() for connection in self.connections))
+        self.connections = {}
+
+
+@dataclass
+class Result:
+    """The outcome of a command run on the server."""
+
+    stdout: bytes
+    stderr: bytes
+    returncode: int
+    # Seconds spent acquiring a connection, until the first response, waiting for
+    # the server to start the command and overall
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Wall, user and system CPU time of the command in seconds and its peak memory
+    rusage: Dict[str, float] = field(default_factory=dict)
+    # Whether the server answered with the output of an identical command it ran earlier
+    cached: bool = False
+
+
+@dataclass
+class BatchResult:
+    """The outcome of one of the commands of a batch, see `Session.batch`."""
+
+    # Position of the command in the batch
+    index: int
+    stdout: bytes = b""
+    stderr: bytes = b""
+    # None when the command did not run
+    returncode: Optional[int] = None
+    # Seconds the command waited for the server to start it
+    wait_time: float = 0.0
+    rusage: Dict[str, float] = field(default_factory=dict)
+    # Whether the output was cut short to fit in a single message
+    truncated: bool = False
+    # Why the command could not run
+    error: Optional[str] = None
+    # Whether the command was left out after another one failed
+    skipped: bool = False
+
+
+class Session:
+    """Runs commands on servers, keeping a pool of warm connections to each of them.
+
+    Sessions are safe to share between tasks, so many commands can run at once with
+    `asyncio.gather`::
+
+        async with Session("broker-cert.pem") as session:
+            results = await asyncio.gather(
+                *(session.run(address, 8889, command) for command in commands)
+            )
+
+    `compression` lists the algorithms to offer servers for compressing stdin and output,
+    the preferred ones first, see `cmdbroker.compression.CODECS`. Servers that require
+    mutual TLS are shown `client_cert`, with its key in `client_key` or the same file.
+    """
+
+    def __init__(
+        self,
+        broker_cert: str,
+        pool_size: int = POOL_SIZE,
+        compression: Sequence[str] = (),
+        client_cert: Optional[str] = None,
+        client_key: Optional[str] = None,
+    ):
+        self.broker_cert = broker_cert
+        self.pool_size = pool_size
+        self.compression = compression
+        self.client_cert = client_cert
+        self.client_key = client_key
+        self.pools: Dict[Tuple[str, int], ConnectionPool] = {}
+
+    async def __aenter__(self) -> "Session":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def pool(self, address: str, port: int) -> ConnectionPool:
+        if (address, port) not in self.pools:
+            self.pools[(address, port)] = ConnectionPool(
+                address,
+                port,
+                self.broker_cert,
+                self.pool_size,
+                self.compression,
+                self.client_cert,
+                self.client_key,
+            )
+        return self.pools[(address, port)]
+
+    async def run(
+        self,
+        address: str,
+        port: int,
+        command: str,
+        stdin: Optional[bytes] = None,
+        cache: bool = True,
+        timeout: Optional[float] = None,
+    ) -> Result:
+        """Run `command` on the server at `address`:`port` and collect its output.
+
+        Set `cache` to False to run the command even if the server has its output cached.
+        The server stops the command after `timeout` seconds, or its `--timeout` by default.
+        """
+        payload = {"method": "process", "parameters": {"command": command}}
+        return await self.request(address, port, payload, stdin, cache, timeout)
+
+    async def exec(
+        self,
+        address: str,
+        port: int,
+        argv: Sequence[str],
+        stdin: Optional[bytes] = None,
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+        cache: bool = True,
+        timeout: Optional[float] = None,
+    ) -> Result:
+        """Run the program in `argv` on the server without a shell and collect its output.
+
+        `cwd` and `env` override the working directory and environment variables of the
+        server for the program.
+        """
+        parameters: Dict[str, Any] = {"argv": list(argv)}
+        if cwd is not None:
+            parameters["cwd"] = cwd
+        if env is not None:
+            parameters["env"] = env
+        payload = {"method": "exec", "parameters": parameters}
+        return await self.request(address, port, payload, stdin, cache, timeout)
+
+    async def batch(
+        self,
+        address: str,
+        port: int,
+        commands: Iterable[Union[str, Dict[str, Any]]],
+        parallel: bool = True,
+        max_parallel: Optional[int] = None,
+        stop_on_failure: bool = False,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[BatchResult]:
+        """Run `commands` on the server in a single request, yielding results as they complete.
+
+        Commands are shell command lines, or dictionaries with an `argv` and optionally a
+        `cwd` and `env` to run a program without a shell. They run at most `max_parallel`
+        at a time, the server's `--max-processes` by default, or one after the other unless
+        `parallel` is set. With `stop_on_failure`, commands that have not started when one
+        fails are skipped. `timeout` limits how long each command may run for.
+        """
+        parameters: Dict[str, Any] = {
+            "commands": [
+                {"command": command} if isinstance(command, str) else command
+                for command in commands
+            ],
+            "parallel": parallel,
+            "stop_on_failure": stop_on_failure,
+        }
+        if max_parallel is not None:
+            parameters["max_parallel"] = max_parallel
+        payload: Dict[str, Any] = {"method": "batch", "parameters": parameters}
+        if timeout is not None:
+            payload["timeout"] = timeout
+        async with self.pool(address, port).borrow() as connection:
+            async for response in connection.request(payload):
+                if response.type == MessageType.RESULT:
+                    result = response.json()
+                    yield BatchResult(
+                        result["index"],
+                        base64.b64decode(result.get("stdout", "")),
+                        base64.b64decode(result.get("stderr", "")),
+                        result.get("returncode"),
+                        result.get("wait_time", 0.0),
+                        result.get("rusage", {}),
+                        result.get("truncated", False),
+                        result.get("error"),
+                        result.get("skipped", False),
+                    )
+
+    async def request(
+        self,
+        address: str,
+        port: int,
+        payload: Dict[str, Any],
+        stdin: Optional[bytes] = None,
+        cache: bool = True,
+        timeout: Optional[float] = None,
+    ) -> Result:
+        started = time.perf_counter()
+        if not cache:
+            payload = {**payload, "cache": False}
+        if timeout is not None:
+            payload = {**payload, "timeout": timeout}
+        output: Dict[MessageType, List[bytes]] = {MessageType.STDOUT: [], MessageType.STDERR: []}
+        async with self.pool(address, port).borrow() as connection:
+            timings = {"connect": time.perf_counter() - started}
+            async for response in connection.request(
+                payload, None if stdin is None else split(stdin)
+            ):
+                timings.setdefault("first_response", time.perf_counter() - started)
+                if response.type == MessageType.END:
+                    end = response.json()
+                    timings["queued"] = end["wait_time"]
+                else:
+                    output[response.type].append(response.text)
+        timings["total"] = time.perf_counter() - started
+
+        return Result(
+            b"".join(output[MessageType.STDOUT]),
+            b"".join(output[MessageType.STDERR]),
+            end["returncode"],
+            timings,
+            end["rusage"],
+            end.get("cached", False),
+        )
+
+    async def close(self) -> None:
+        await asyncio.gather(*(pool.close() for pool in self.pools.values()))
+        self.pools = {}
+
+
+async def split(data: bytes) -> AsyncIterator[bytes]:
+    """Split `data` into chunks to stream as stdin."""
+    for start in range(0, len(data), CHUNK_SIZE):
+        yield data[start : start + CHUNK_SIZE]
+
+
+async def read_chunks(stdin) -> AsyncIterator[bytes]:
+    """Read a binary file in chunks without blocking the event loop."""
+    while chunk := await asyncio.to_thread(stdin.read1, CHUNK_SIZE):
+        yield chunk
 
 
 class Client:
@@ -13,40 +641,168 @@ class Client:
         self.address = params.address
         self.port = params.port
         self.broker_cert = params.broker_cert
+        self.client_cert = params.client_cert
+        self.client_key = params.client_key
+        self.no_cache = params.no_cache
+        self.timings = params.timings
+        # Seconds the server may run the command for, its own default when 0
+        self.timeout = params.timeout
+        self.exec = params.exec
+        self.cwd = params.cwd
+        self.env = dict(variable.split("=", 1) for variable in params.env)
+        self.batch = params.batch
+        self.sequential = params.sequential
+        self.max_parallel = params.max_parallel
+        self.stop_on_failure = params.stop_on_failure
+        # Single commands go through the agent when one is running
+        self.agent_socket = None if params.no_agent else params.agent_socket
+        # Offer every available algorithm for auto, the named one otherwise
+        self.compression: List[str] = {"auto": list(CODECS), "none": []}.get(
+            params.compression, [params.compression]
+        )
+
+    def parameters(self, command: str) -> Dict[str, Any]:
+        """The request parameters that run `command`, through a shell or directly."""
+        if not self.exec:
+            return {"command": command}
+
+        # Run the program directly, the command is split like a shell would
+        parameters: Dict[str, Any] = {"argv": shlex.split(command)}
+        if self.cwd:
+            parameters["cwd"] = self.cwd
+        if self.env:
+            parameters["env"] = self.env
+        return parameters
+
+    async def connect(self) -> Connection:
+        """Connect to the agent if one is running, straight to the server otherwise."""
+        if self.agent_socket and agent_running(self.agent_socket):
+            agent = AgentConnection(
+                self.agent_socket,
+                self.address,
+                self.port,
+                self.broker_cert,
+                self.compression,
+                self.client_cert,
+                self.client_key,
+            )
+            try:
+                await agent.open()
+                return agent
+            except OSError:
+                # The agent is gone and left its socket behind
+                pass
+
+        connection = Connection(
+            self.address,
+            self.port,
+            self.broker_cert,
+            self.compression,
+            self.client_cert,
+            self.client_key,
+        )
+        await connection.open()
+        return connection
 
     async def run(self):
-        payload = {
-            "method": "process",
-            "parameters": {
-                "command": self.command,
-            },
+        if self.batch:
+            return await self.run_batch()
+
+        payload: Dict[str, Any] = {
+            "method": "exec" if self.exec else "process",
+            "parameters": self.parameters(self.command),
         }
+        if self.no_cache:
+            payload["cache"] = False
+        if self.timings:
+            payload["timings"] = True
+        if self.timeout:
+            payload["timeout"] = self.timeout
 
-        # Add stdin parameter if there's something in stdin
+        # Stream stdin after the request if there's something in stdin
+        stdin = None
         if select.select([sys.stdin], [], [], 0.0)[0]:
-            payload["stdin"] = await asyncio.to_thread(sys.stdin.read)
-
-        # Forward request to server and get response
-        response = await self.relay_to_server(Message.build(payload))
+            stdin = read_chunks(sys.stdin.buffer)
 
-        # Output the response to stdout
-        response.write(sys.stdout.buffer)
+        # Forward request to server and output the response as it arrives
+        started = time.perf_counter()
+        connection = await self.connect()
+        try:
+            connected = time.perf_counter() - started
+            try:
+                async for response in connection.request(payload, stdin):
+                    if response.type == MessageType.END:
+                        end = response.json()
+                        returncode = end["returncode"]
+                        if self.timings:
+                            self.print_timings(end, connected, time.perf_counter() - started)
+                    else:
+                        output = sys.stderr if response.type == MessageType.STDERR else sys.stdout
+                        output.buffer.write(response.text)
+                        output.buffer.flush()
+            except BrokerError as err:
+                print(f"Error: {err}", file=sys.stderr)
+                sys.exit(1)
+        finally:
+            await connection.close()
 
-    async def relay_to_server(self, request):
-        # Create an SSL context
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = True
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.load_verify_locations(self.broker_cert)
+        if returncode:
+            # Exit like a shell would, 128 plus the signal number for killed commands
+            sys.exit(returncode if returncode > 0 else 128 - returncode)
 
-        reader, writer = await asyncio.open_connection(self.address, self.port, ssl=ssl_context)
+    @staticmethod
+    def print_timings(end: Dict[str, Any], connect: float, total: float) -> None:
+        """Print the phases the server timed, and what the client saw, as a JSON line."""
+        timings = {
+            "request_id": end["request_id"],
+            "server": end["timings"],
+            "client": {"connect": connect, "total": total},
+        }
+        print(json.dumps(timings), file=sys.stderr)
 
-        await request.async_write(writer)
+    async def run_batch(self):
+        """Run the commands in the batch file, one per line, in a single request."""
+        if self.batch == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(self.batch) as f:
+                lines = f.read().splitlines()
+        # Blank lines and comments are left out
+        commands = [line for line in map(str.strip, lines) if line and not line.startswith("#")]
 
-        # Receive response from server
-        response = await Message.async_read(reader)
+        failed = False
+        async with Session(
+            self.broker_cert, 1, self.compression, self.client_cert, self.client_key
+        ) as session:
+            try:
+                async for result in session.batch(
+                    self.address,
+                    self.port,
+                    [self.parameters(command) for command in commands],
+                    parallel=not self.sequential,
+                    max_parallel=self.max_parallel,
+                    stop_on_failure=self.stop_on_failure,
+                    timeout=self.timeout or None,
+                ):
+                    # Each command's output is written out in one go as it completes
+                    sys.stdout.buffer.write(result.stdout)
+                    sys.stdout.buffer.flush()
+                    sys.stderr.buffer.write(result.stderr)
+                    sys.stderr.buffer.flush()
 
-        writer.close()
-        await writer.wait_closed()
+                    command = f"Command {result.index + 1} ({commands[result.index]})"
+                    if result.truncated:
+                        print(f"{command} output was truncated", file=sys.stderr)
+                    if result.error:
+                        print(f"{command} failed: {result.error}", file=sys.stderr)
+                    elif result.skipped:
+                        print(f"{command} was skipped", file=sys.stderr)
+                    elif result.returncode:
+                        print(f"{command} exited with status {result.returncode}", file=sys.stderr)
+                    failed = failed or result.returncode != 0
+            except BrokerError as err:
+                print(f"Error: {err}", file=sys.stderr)
+                sys.exit(1)
 
-        return response
+        if failed:
+            sys.exit(1)
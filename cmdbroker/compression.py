@@ -0,0 +1,150 @@
+import abc
+import functools
+import importlib.util
+import zlib
+from typing import TYPE_CHECKING, Dict, Optional, Sequence
+
+from .message import COMPRESSED, Message, ProtocolError
+
+if TYPE_CHECKING:  # pragma: no cover
+    import zstandard
+
+# Data messages smaller than this are sent as is, compressing them saves too little
+COMPRESSION_THRESHOLD = 1024
+
+
+class Codec(abc.ABC):
+    """A compression algorithm for the stdin, stdout and stderr chunks of a connection.
+
+    Each chunk is compressed on its own, so the streams multiplexed over a connection do
+    not depend on each other.
+    """
+
+    name = ""
+    # Whether the library the codec needs is installed
+    available = True
+
+    @abc.abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        """Compress `data` on its own."""
+
+    @abc.abstractmethod
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        """Decompress `data`, refusing to inflate it past `max_size` bytes."""
+
+
+def installed(module: str) -> bool:
+    """Whether `module` can be imported, without paying for importing it until it is used."""
+    return importlib.util.find_spec(module) is not None
+
+
+def too_large(max_size: int) -> ProtocolError:
+    return ProtocolError(f"Compressed message is truncated or exceeds {max_size} bytes")
+
+
+class Zlib(Codec):
+    name = "zlib"
+
+    def compress(self, data: bytes) -> bytes:
+        # The fastest level, compression has to keep up with the network
+        return zlib.compress(data, 1)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        try:
+            text = decompressor.decompress(data, max_size)
+        except zlib.error as err:
+            raise ProtocolError(f"Invalid zlib data: {err}") from None
+        if not decompressor.eof:
+            raise too_large(max_size)
+        return text
+
+
+class Zstd(Codec):
+    name = "zstd"
+    available = installed("zstandard")
+
+    # Reused, setting them up for every chunk is a fair share of the work
+    @functools.cached_property
+    def compressor(self) -> "zstandard.ZstdCompressor":
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=3)
+
+    @functools.cached_property
+    def decompressor(self) -> "zstandard.ZstdDecompressor":
+        import zstandard
+
+        return zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        import zstandard
+
+        try:
+            # The frame header has the size, check it before anything is allocated
+            if not 0 <= zstandard.frame_content_size(data) <= max_size:
+                raise too_large(max_size)
+            return self.decompressor.decompress(data)
+        except zstandard.ZstdError as err:
+            raise ProtocolError(f"Invalid zstd data: {err}") from None
+
+
+class Lz4(Codec):
+    name = "lz4"
+    available = installed("lz4")
+
+    def compress(self, data: bytes) -> bytes:
+        import lz4.frame
+
+        return lz4.frame.compress(data)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        import lz4.frame
+
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        try:
+            text = decompressor.decompress(data, max_length=max_size)
+        except RuntimeError as err:
+            raise ProtocolError(f"Invalid lz4 data: {err}") from None
+        if not decompressor.eof:
+            raise too_large(max_size)
+        return text
+
+
+# The codecs that can be used here, the preferred ones first
+CODECS: Dict[str, Codec] = {
+    codec.name: codec for codec in (Zstd(), Lz4(), Zlib()) if codec.available
+}
+
+
+def choose(names: Sequence[str]) -> Optional[Codec]:
+    """Pick the first of the codecs offered by the other side that can be used here."""
+    return next((CODECS[name] for name in names if name in CODECS), None)
+
+
+def compress(message: Message, codec: Optional[Codec]) -> Message:
+    """Compress the payload of `message` if it is large enough for it to pay off."""
+    if codec is None or len(message.text) < COMPRESSION_THRESHOLD:
+        return message
+    text = codec.compress(message.text)
+    if len(text) >= len(message.text):
+        # Random or already compressed data does not shrink
+        return message
+    return Message(message.type, text, message.stream_id, message.flags | COMPRESSED)
+
+
+def decompress(message: Message, codec: Optional[Codec], max_size: int) -> Message:
+    """Restore the payload of a compressed message, others are returned as they are."""
+    if not message.flags & COMPRESSED:
+        return message
+    if codec is None:
+        raise ProtocolError("Received a compressed message without agreeing on compression")
+    return Message(
+        message.type,
+        codec.decompress(message.text, max_size),
+        message.stream_id,
+        message.flags & ~COMPRESSED,
+    )
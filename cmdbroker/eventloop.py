@@ -0,0 +1,34 @@
+import asyncio
+import importlib.util
+import sys
+from typing import Any, Coroutine, TypeVar
+
+# The event loops to choose from, auto picks uvloop when it is installed
+EVENT_LOOPS = ("asyncio", "uvloop", "auto")
+
+T = TypeVar("T")
+
+
+def uvloop_installed() -> bool:
+    # Looked up rather than imported, clients on the asyncio loop do not pay for importing it
+    return importlib.util.find_spec("uvloop") is not None
+
+
+def resolve(event_loop: str) -> str:
+    """The event loop to run for `event_loop`, asyncio when uvloop is not installed."""
+    if event_loop == "asyncio":
+        return "asyncio"
+    if uvloop_installed():
+        return "uvloop"
+    if event_loop == "uvloop":
+        print("uvloop is not installed, using the asyncio event loop", file=sys.stderr)
+    return "asyncio"
+
+
+def run(coroutine: Coroutine[Any, Any, T], event_loop: str = "asyncio") -> T:
+    """Run `coroutine` to completion on a new event loop of the chosen kind."""
+    if resolve(event_loop) == "uvloop":
+        import uvloop
+
+        return uvloop.run(coroutine)
+    return asyncio.run(coroutine)
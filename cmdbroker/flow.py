@@ -0,0 +1,82 @@
+import asyncio
+from typing import AsyncIterator, Dict
+
+from .message import CHUNK_SIZE, Message, MessageType, ProtocolError
+
+# Bytes of stdin a client may send to a request ahead of what its command consumed
+STDIN_WINDOW = 16 * CHUNK_SIZE
+
+
+class InputQueue:
+    """The stdin a client streams to a request, buffered until its command reads it.
+
+    Clients keep to a window of `STDIN_WINDOW` bytes per request, which is granted again
+    with WINDOW messages as the command consumes its input. Stdin for a command still
+    waiting for its turn then never holds up the other requests of the connection.
+    """
+
+    def __init__(self, stream_id: int, writer):
+        self.stream_id = stream_id
+        self.writer = writer
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # Bytes the client may still send, and consumed since the window was last granted
+        self.window = STDIN_WINDOW
+        self.consumed = 0
+
+    async def put(self, chunk: bytes) -> None:
+        self.window -= len(chunk)
+        if self.window < 0:
+            raise ProtocolError(f"Stream {self.stream_id} sent more stdin than its window")
+        self.queue.put_nowait(chunk)
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """Yield the stdin chunks sent by the client until an empty chunk marks the end."""
+        while chunk := await self.queue.get():
+            self.consumed += len(chunk)
+            # Granted in halves rather than chunk by chunk, to keep WINDOW messages rare
+            if self.consumed >= STDIN_WINDOW // 2:
+                await self.grant()
+            yield chunk
+
+    async def grant(self) -> None:
+        self.window += self.consumed
+        window = Message.build({"size": self.consumed}, self.stream_id, MessageType.WINDOW)
+        self.consumed = 0
+        await window.async_write(self.writer)
+
+    def clear(self) -> None:
+        """Drop the stdin the command did not consume."""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class SendWindow:
+    """How much stdin a client may still send to a request before it is granted more."""
+
+    def __init__(self) -> None:
+        self.size = STDIN_WINDOW
+        self.granted = asyncio.Event()
+
+    def grant(self, size: int) -> None:
+        self.size += size
+        self.granted.set()
+
+    async def take(self, size: int) -> int:
+        """Wait for the window to open, returns how much of `size` bytes may be sent now."""
+        while self.size <= 0:
+            self.granted.clear()
+            await self.granted.wait()
+        taken = min(size, self.size)
+        self.size -= taken
+        return taken
+
+
+def end_stream(
+    stdin_queues: Dict[int, InputQueue],
+    tasks: Dict[int, asyncio.Task],
+    stream_id: int,
+    task: asyncio.Task,
+) -> None:
+    """Forget a finished stream, dropping any stdin its command did not consume."""
+    del tasks[stream_id]
+    stdin_queues.pop(stream_id).clear()
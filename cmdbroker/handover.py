@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess  # nosec B404
+import sys
+from typing import Optional
+
+# Environment variables telling a server started by its predecessor which inherited file
+# descriptors to listen on and to report back on
+LISTEN_FD = "CMDBROKER_LISTEN_FD"
+CONTROL_FD = "CMDBROKER_CONTROL_FD"
+
+# Seconds the new server gets to start listening before the restart is called off
+READY_TIMEOUT = 60
+
+
+async def start_successor(listening: socket.socket, password: str) -> Optional[int]:
+    """Start a new server that takes over `listening`, returns its pid once it accepts on it.
+
+    The new server runs the command line this one was started with, so it picks up the code
+    and configuration as they are now. It inherits the socket rather than binding the port
+    again, connections keep queueing up on it while one server hands over to the other.
+    Returns None if the new server exits or does not get going in time.
+    """
+    control, inherited = socket.socketpair()
+    try:
+        process = subprocess.Popen(  # nosec B603
+            [sys.executable, "-m", "cmdbroker", *sys.argv[1:]],
+            pass_fds=(listening.fileno(), inherited.fileno()),
+            env={
+                **os.environ,
+                LISTEN_FD: str(listening.fileno()),
+                CONTROL_FD: str(inherited.fileno()),
+            },
+        )
+    finally:
+        inherited.close()
+
+    reader, writer = await asyncio.open_connection(sock=control)
+    # Saves prompting for the password of the key again
+    writer.write(json.dumps({"password": password}).encode("utf-8") + b"\n")
+    try:
+        ready = await asyncio.wait_for(reader.readline(), READY_TIMEOUT)
+    except (asyncio.TimeoutError, ConnectionError):
+        # Too slow, or gone without reading the password
+        ready = b""
+    writer.close()
+    if ready != b"ready\n":
+        # A supervisor stops the workers it started on SIGTERM
+        process.terminate()
+        await asyncio.to_thread(process.wait)
+        return None
+    return process.pid
+
+
+class Predecessor:
+    """The server that started this one to take over its listening socket."""
+
+    def __init__(self, listen_fd: int, control_fd: int):
+        self.socket = socket.socket(fileno=listen_fd)
+        self.control = socket.socket(fileno=control_fd)
+        with self.control.makefile("rb") as handover:
+            self.password: str = json.loads(handover.readline())["password"]
+
+    def ready(self) -> None:
+        """Let the predecessor know this server accepts connections, so it can stop."""
+        self.control.sendall(b"ready\n")
+        self.control.close()
+
+
+def predecessor() -> Optional[Predecessor]:
+    """The server handing its socket over to this process, if it was started by one."""
+    if LISTEN_FD not in os.environ:
+        return None
+    # Neither commands nor the next restart should find these
+    listen_fd = int(os.environ.pop(LISTEN_FD))
+    control_fd = int(os.environ.pop(CONTROL_FD))
+    return Predecessor(listen_fd, control_fd)
@@ -1,46 +1,152 @@
 import json
 import struct
+import time
 from asyncio import StreamReader
-from typing import Any, Dict
+from enum import IntEnum
+from typing import Any, Dict, Sequence
+
+# Size of the stdin/stdout/stderr chunks forwarded between client and server
+CHUNK_SIZE = 64 * 1024
+
+# Largest payload accepted in a single message, so a bad length cannot exhaust memory
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Versions of the wire protocol spoken by this release, the newest one is preferred
+PROTOCOL_VERSION = 1
+SUPPORTED_VERSIONS = [PROTOCOL_VERSION]
+
+# Version carried in the header of every frame, it only changes along with the header
+FRAME_VERSION = 1
+
+# Set in the flags of messages whose payload is compressed
+COMPRESSED = 0x01
+
+
+class ProtocolError(Exception):
+    """Raised when the other side does not speak a protocol we understand."""
+
+
+class MessageType(IntEnum):
+    """The kind of payload carried by a message."""
+
+    REQUEST = 0
+    STDOUT = 1
+    STDERR = 2
+    END = 3
+    STDIN = 4
+    HELLO = 5
+    RESULT = 6
+    CANCEL = 7
+    GOAWAY = 8
+    WINDOW = 9
 
 
 class Message:
-    """Represents a brokered message."""
+    """Represents a brokered message.
 
-    def __init__(self) -> None:
-        self.text: bytes = b""
-        self.text_length_bytes: bytes = b""
+    Messages are framed by a fixed size header in network byte order and followed by
+    their payload as is. Control messages (HELLO, REQUEST, RESULT and END) carry JSON while
+    stdin, stdout and stderr chunks are raw bytes. CANCEL, sent by clients that gave up on
+    a request, carries nothing. Neither does GOAWAY, sent by a server that is shutting down
+    to ask the client not to send further requests over the connection. WINDOW, JSON too,
+    lets the client send more stdin to a request, see `cmdbroker.flow`.
+    """
+
+    # Frame version, message type, flags, padding, stream id and payload length
+    HEADER = struct.Struct("!BBBxII")
+
+    def __init__(
+        self,
+        message_type: MessageType = MessageType.REQUEST,
+        text: bytes = b"",
+        stream_id: int = 0,
+        flags: int = 0,
+    ) -> None:
+        self.type = message_type
+        self.text = text
+        self.stream_id = stream_id
+        self.flags = flags
+        # Seconds it took the payload of a received message to arrive after its header
+        self.read_time = 0.0
 
     @staticmethod
-    def build(json_data: Dict[str, Any]) -> "Message":
-        message = Message()
-        message.text = json.dumps(json_data).encode("utf-8")
-        message.text_length_bytes = struct.pack("@I", len(message.text))
+    def build(
+        json_data: Dict[str, Any],
+        stream_id: int = 0,
+        message_type: MessageType = MessageType.REQUEST,
+    ) -> "Message":
+        return Message(message_type, json.dumps(json_data).encode("utf-8"), stream_id)
 
-        return message
+    @staticmethod
+    def hello(compression: Sequence[str] = ()) -> "Message":
+        """The first message sent by a client, listing the protocol versions it speaks.
+
+        It also offers the compression algorithms the client would like data sent with.
+        """
+        hello: Dict[str, Any] = {"versions": SUPPORTED_VERSIONS}
+        if compression:
+            hello["compression"] = list(compression)
+        return Message.build(hello, message_type=MessageType.HELLO)
 
-    def unpack_length(self) -> int:
-        """Unpack the message length from the first 4 bytes."""
-        return struct.unpack("@I", self.text_length_bytes)[0]
+    def header(self) -> bytes:
+        return self.HEADER.pack(
+            FRAME_VERSION, self.type, self.flags, self.stream_id, len(self.text)
+        )
 
     def output(self) -> bytes:
-        return self.text_length_bytes + self.text
+        return self.header() + self.text
 
     def json(self) -> Dict[str, Any]:
         return json.loads(self.text.decode("utf-8"))
 
     @staticmethod
-    async def async_read(reader: StreamReader) -> "Message":
-        message = Message()
-        # Read the message length/text
-        message.text_length_bytes = await reader.read(4)
-        message.text = await reader.read(message.unpack_length())
+    async def async_read(reader: StreamReader, max_size: int = MAX_FRAME_SIZE) -> "Message":
+        # Read the message header/text, a single read may return less than requested
+        version, message_type, flags, stream_id, length = Message.HEADER.unpack(
+            await reader.readexactly(Message.HEADER.size)
+        )
+        # Check the header before trusting its length, older releases send something else
+        if version != FRAME_VERSION:
+            raise ProtocolError(f"Unsupported protocol version {version}")
+        try:
+            message_type = MessageType(message_type)
+        except ValueError:
+            raise ProtocolError(f"Unknown message type {message_type}") from None
+        if length > max_size:
+            raise ProtocolError(f"Message of {length} bytes exceeds the maximum of {max_size}")
+        started = time.perf_counter()
+        text = await reader.readexactly(length)
 
+        message = Message(message_type, text, stream_id, flags)
+        message.read_time = time.perf_counter() - started
         return message
 
     def write(self, writer) -> None:
-        writer.write(self.output())
+        # Hand both parts to the transport instead of concatenating them here
+        writer.writelines((self.header(), self.text))
 
     async def async_write(self, writer) -> None:
         self.write(writer)
         await writer.drain()
+
+
+def negotiate(hello: Message) -> int:
+    """Pick the newest protocol version spoken by both sides of a connection."""
+    if hello.type != MessageType.HELLO:
+        raise ProtocolError("Expected a HELLO message, the client is too old")
+
+    try:
+        offer = hello.json()
+    except ValueError:
+        raise ProtocolError("The HELLO message is not valid JSON") from None
+    if not isinstance(offer, dict):
+        raise ProtocolError("The HELLO message must be a JSON object")
+    for key, kind in (("versions", int), ("compression", str)):
+        offered = offer.get(key, [])
+        if not isinstance(offered, list) or not all(isinstance(item, kind) for item in offered):
+            raise ProtocolError(f"The HELLO message must offer {key} as a list")
+
+    versions = set(offer.get("versions", [])) & set(SUPPORTED_VERSIONS)
+    if not versions:
+        raise ProtocolError(f"Unsupported protocol version, the server speaks {SUPPORTED_VERSIONS}")
+    return max(versions)
@@ -0,0 +1,240 @@
+import abc
+import asyncio
+import bisect
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .scheduler import Scheduler
+from .writer import WriterProxy
+
+# Upper bounds in seconds of the buckets durations are counted in
+DURATION_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# Seconds a scraper gets to send its HTTP request
+SCRAPE_TIMEOUT = 10
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric(abc.ABC):
+    """A metric in the Prometheus text exposition format, optionally split up by labels."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def key(self, labels: Dict[str, str]) -> Labels:
+        return tuple((name, str(labels[name])) for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        """Yield the name suffix, labels and value of each sample."""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        # Metrics without labels are reported from the start
+        self.values: Dict[Labels, float] = {} if labels else {(): 0.0}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, value in self.values.items():
+            yield "", labels, value
+
+
+class Gauge(Counter):
+    """A value that goes up and down, or is read from `function` when scraped."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, function: Optional[Callable[[], float]] = None):
+        super().__init__(name, description)
+        self.function = function
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.inc(-amount)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        if self.function is not None:
+            yield "", (), self.function()
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DURATION_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = sorted(buckets)
+        # Observations per bucket, the last one past the largest bound, and their sum
+        self.counts: Dict[Labels, List[int]] = {}
+        self.sums: Dict[Labels, float] = {}
+        if not labels:
+            self.counts[()] = [0] * (len(self.buckets) + 1)
+            self.sums[()] = 0.0
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] = self.sums.get(key, 0.0) + value
+
+    def samples(self) -> Iterator[Tuple[str, Labels, float]]:
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip([*self.buckets, float("inf")], counts):
+                total += count
+                yield "_bucket", (*labels, ("le", format_value(bound))), total
+            yield "_sum", labels, self.sums[labels]
+            yield "_count", labels, total
+
+
+class Registry:
+    """A set of metrics served over HTTP for Prometheus to scrape."""
+
+    def __init__(self) -> None:
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(line + "\n" for metric in self.metrics for line in metric.render())
+
+    async def handle_scrape(self, reader: asyncio.StreamReader, writer) -> None:
+        """Answer a single HTTP request, with the metrics for GET /metrics."""
+        try:
+            method, path = await asyncio.wait_for(self.read_request(reader), SCRAPE_TIMEOUT)
+            if method != "GET":
+                status, body = "405 Method Not Allowed", "Only GET is supported\n"
+            elif path.split("?")[0] != "/metrics":
+                status, body = "404 Not Found", "Metrics are served on /metrics\n"
+            else:
+                status, body = "200 OK", self.render()
+        except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            status, body = "400 Bad Request", "Malformed request\n"
+        except ConnectionError:
+            return
+
+        content = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(content)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + content
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str]:
+        """Read the method and path of an HTTP request, skipping its headers."""
+        method, path, _ = (await reader.readline()).decode("latin-1").split()
+        while (await reader.readline()).strip():
+            pass
+        return method, path
+
+
+class ServerMetrics(Registry):
+    """What a server keeps track of about its connections and the commands it runs."""
+
+    def __init__(self, scheduler: Scheduler):
+        super().__init__()
+        self.connections = Gauge("cmdbroker_connections", "Client connections open")
+        self.accepted = Counter("cmdbroker_connections_total", "Client connections accepted")
+        self.handshake_duration = Histogram(
+            "cmdbroker_tls_handshake_duration_seconds",
+            "Time from accepting a connection to completing its TLS handshake",
+        )
+        self.requests = Counter("cmdbroker_requests_total", "Requests received", ["method"])
+        self.errors = Counter(
+            "cmdbroker_errors_total", "Requests, commands and connections that failed", ["error"]
+        )
+        self.running = Gauge(
+            "cmdbroker_commands_running", "Commands running", lambda: scheduler.running
+        )
+        self.queued = Gauge(
+            "cmdbroker_commands_queued", "Commands waiting for their turn", lambda: scheduler.queued
+        )
+        self.wait_time = Histogram(
+            "cmdbroker_command_wait_seconds", "Time commands waited for their turn"
+        )
+        self.command_duration = Histogram(
+            "cmdbroker_command_duration_seconds", "Wall time of the commands run", ["method"]
+        )
+        self.received_bytes = Counter(
+            "cmdbroker_received_bytes_total", "Bytes received from clients, with message headers"
+        )
+        self.sent_bytes = Counter(
+            "cmdbroker_sent_bytes_total", "Bytes sent to clients, with message headers"
+        )
+        for metric in vars(self).values():
+            if isinstance(metric, Metric):
+                self.register(metric)
+
+
+class CountingWriter(WriterProxy):
+    """Counts the bytes written in `counter`."""
+
+    def __init__(self, writer, counter: Counter):
+        super().__init__(writer)
+        self.counter = counter
+
+    def writelines(self, data: Sequence[bytes]) -> None:
+        self.counter.inc(sum(len(part) for part in data))
+        super().writelines(data)
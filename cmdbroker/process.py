@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+import os
+import signal
+import subprocess  # nosec B404
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Deque, Dict, List, Optional, TypeVar
+
+# Seconds a command gets to exit after SIGTERM before it is killed
+TERMINATE_TIMEOUT = 5
+
+T = TypeVar("T")
+
+
+class CommandTimeoutError(Exception):
+    """Raised when a command runs for longer than its request allows."""
+
+
+class Process:
+    """A shell command run for a client, along with the resources it used.
+
+    asyncio reaps the processes it starts and throws their resource usage away, so
+    commands are started with `subprocess.Popen` instead, their pipes are attached to
+    the event loop and a thread collects them with `os.wait4` when they exit.
+
+    Each command leads a process group of its own, so whatever it starts can be stopped
+    along with it.
+    """
+
+    stdin: Optional[asyncio.StreamWriter]
+    stdout: asyncio.StreamReader
+    stderr: asyncio.StreamReader
+    # Where warm shells read their command from
+    script: asyncio.WriteTransport
+
+    def __init__(self, popen: subprocess.Popen):
+        self.popen = popen
+        self.started = time.perf_counter()
+        self.exited = asyncio.get_running_loop().create_future()
+        self.returncode: Optional[int] = None
+        # Wall, user and system CPU time in seconds and peak memory (kilobytes on Linux)
+        self.rusage: Dict[str, float] = {}
+
+    @classmethod
+    async def start(cls, command: str, stdin: bool = False) -> "Process":
+        """Start `command` in a shell, with a pipe to its stdin only if `stdin` is set."""
+        popen = subprocess.Popen(  # nosec B602
+            command,
+            shell=True,
+            stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        return await cls.attach(popen)
+
+    @classmethod
+    async def exec(
+        cls,
+        argv: List[str],
+        stdin: bool = False,
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> "Process":
+        """Start the program in `argv` directly, without a shell in between."""
+        popen = subprocess.Popen(  # nosec B603
+            argv,
+            stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+            start_new_session=True,
+        )
+        return await cls.attach(popen)
+
+    @classmethod
+    async def warm(cls) -> "Process":
+        """Start a shell ahead of time, it runs the command given to `run` later on."""
+        script, script_writer = os.pipe()
+        try:
+            # The shell sources its command from the pipe, blocking until it is sent
+            popen = subprocess.Popen(  # nosec B603
+                ["/bin/sh", "-c", f". /dev/fd/{script}"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=(script,),
+                start_new_session=True,
+            )
+        finally:
+            os.close(script)
+        process = await cls.attach(popen)
+        process.script, _ = await asyncio.get_running_loop().connect_write_pipe(
+            asyncio.BaseProtocol, os.fdopen(script_writer, "wb")
+        )
+        return process
+
+    @classmethod
+    async def attach(cls, popen: subprocess.Popen) -> "Process":
+        process = cls(popen)
+        threading.Thread(target=process.reap, daemon=True).start()
+
+        process.stdin = await cls.write_pipe(popen.stdin) if popen.stdin else None
+        process.stdout = await cls.read_pipe(popen.stdout)
+        process.stderr = await cls.read_pipe(popen.stderr)
+        return process
+
+    def run(self, command: str, stdin: bool = False) -> None:
+        """Have a warm shell run `command`, closing its stdin unless `stdin` is set."""
+        self.started = time.perf_counter()
+        if not stdin and self.stdin:
+            self.stdin.close()
+            self.stdin = None
+        self.script.write(command.encode("utf-8"))
+        self.script.close()
+
+    @staticmethod
+    async def read_pipe(pipe) -> asyncio.StreamReader:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+    @staticmethod
+    async def write_pipe(pipe) -> asyncio.StreamWriter:
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+        return asyncio.StreamWriter(transport, protocol, None, loop)
+
+    def reap(self) -> None:
+        """Wait for the command to exit, in a thread of its own."""
+        loop = self.exited.get_loop()
+        _, status, rusage = os.wait4(self.popen.pid, 0)
+        self.rusage = {
+            "wall_time": time.perf_counter() - self.started,
+            "user_time": rusage.ru_utime,
+            "system_time": rusage.ru_stime,
+            "max_rss": rusage.ru_maxrss,
+        }
+        self.returncode = self.popen.returncode = os.waitstatus_to_exitcode(status)
+        loop.call_soon_threadsafe(self.exited.set_result, self.returncode)
+
+    async def wait(self) -> int:
+        # Shielded so a cancelled wait does not fail setting the result later on
+        return await asyncio.shield(self.exited)
+
+    def signal_group(self, signum: int) -> None:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self.popen.pid, signum)
+
+    async def terminate(self, timeout: float = TERMINATE_TIMEOUT) -> None:
+        """Stop the command and everything it started, killing them after `timeout` seconds.
+
+        Processes of the group that outlive the command, or ignore SIGTERM, are killed too.
+        """
+        self.signal_group(signal.SIGTERM)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.wait(), timeout)
+        self.signal_group(signal.SIGKILL)
+        await self.wait()
+
+    async def supervise(self, work: Awaitable[T], timeout: Optional[float] = None) -> T:
+        """Await `work`, which lasts until the command is done, for at most `timeout` seconds.
+
+        The command and everything it started are terminated if it times out, or if `work`
+        fails or is cancelled, typically because the client went away.
+        """
+        finished = False
+        try:
+            result = await asyncio.wait_for(work, timeout)
+            finished = True
+            return result
+        except asyncio.TimeoutError:
+            raise CommandTimeoutError(f"Command timed out after {timeout:g} seconds") from None
+        finally:
+            if not finished:
+                await self.terminate()
+
+
+class ShellPool:
+    """Shells started ahead of time, so commands do not wait for one to spawn.
+
+    Each shell runs a single command and exits along with it, so nothing a command does
+    to its shell carries over to the next one.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.shells: Deque[Process] = deque()
+        self.refill_task: Optional[asyncio.Task] = None
+
+    def fill(self) -> None:
+        """Start shells in the background until the pool is full."""
+        if self.refill_task is None or self.refill_task.done():
+            self.refill_task = asyncio.create_task(self.refill())
+
+    async def refill(self) -> None:
+        while len(self.shells) < self.size:
+            self.shells.append(await Process.warm())
+
+    async def run(self, command: str, stdin: bool = False) -> Process:
+        """Run `command` in a warm shell, or start one for it if the pool ran dry.
+
+        Spawning replacements would hold up the command, call `fill` once it is done.
+        """
+        while self.shells:
+            process = self.shells.popleft()
+            # Shells killed while they waited are dropped
+            if not process.exited.done():
+                process.run(command, stdin)
+                return process
+            process.script.close()
+        return await Process.start(command, stdin)
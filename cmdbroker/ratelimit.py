@@ -0,0 +1,157 @@
+import asyncio
+import contextlib
+import time
+from typing import Any, Dict, Hashable, Iterator, Optional, Sequence
+
+from .writer import WriterProxy
+
+# Number of clients kept track of before the ones that are idle are forgotten
+PRUNE_THRESHOLD = 1024
+
+
+class ThrottledError(Exception):
+    """Raised when a client goes over one of its limits.
+
+    `details` tells the client which limit it hit and, for rates, how many seconds to
+    wait before trying again.
+    """
+
+    def __init__(self, message: str, limit: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.details: Dict[str, Any] = {"limit": limit}
+        if retry_after is not None:
+            self.details["retry_after"] = retry_after
+
+
+class TokenBucket:
+    """Allows `rate` units per second on average, in bursts of up to a second's worth."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.burst = max(rate, 1.0)
+        self.tokens = self.burst
+        self.updated = time.perf_counter()
+
+    def refill(self) -> None:
+        now = time.perf_counter()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float = 1.0) -> float:
+        """Take `amount` tokens if there are enough, returns the seconds until there are if not."""
+        self.refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def spend(self, amount: float) -> float:
+        """Take `amount` tokens, running into debt if need be, returns the seconds to pay it off."""
+        self.refill()
+        self.tokens -= amount
+        return max(-self.tokens / self.rate, 0.0)
+
+    def full(self) -> bool:
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class ClientLimits:
+    """What a single client has used up of its limits."""
+
+    def __init__(self, requests_per_second: float, bytes_per_second: float):
+        # Buckets of the limits that are disabled are never taken from
+        self.requests = TokenBucket(requests_per_second)
+        self.bytes = TokenBucket(bytes_per_second)
+        # Commands admitted, running or waiting for their turn
+        self.commands = 0
+
+    def idle(self) -> bool:
+        """Whether forgetting the client would not change what it is allowed to do."""
+        return not self.commands and self.requests.full() and self.bytes.full()
+
+
+class RateLimiter:
+    """Keeps any one client from monopolizing the server, 0 disables a limit.
+
+    Clients are limited to `requests_per_second` requests and `max_commands` commands
+    admitted at once, and are turned away with a `ThrottledError` beyond that. Their
+    stdin and output are slowed down to `bytes_per_second` instead.
+    """
+
+    def __init__(
+        self, requests_per_second: float = 0, max_commands: int = 0, bytes_per_second: float = 0
+    ):
+        self.requests_per_second = requests_per_second
+        self.max_commands = max_commands
+        self.bytes_per_second = bytes_per_second
+        self.clients: Dict[Hashable, ClientLimits] = {}
+
+    def client(self, client: Hashable) -> ClientLimits:
+        if client not in self.clients:
+            if len(self.clients) >= PRUNE_THRESHOLD:
+                self.clients = {
+                    other: limits for other, limits in self.clients.items() if not limits.idle()
+                }
+            self.clients[client] = ClientLimits(self.requests_per_second, self.bytes_per_second)
+        return self.clients[client]
+
+    def admit(self, client: Hashable) -> None:
+        """Count a request from `client`, raising `ThrottledError` if it sent too many."""
+        if not self.requests_per_second:
+            return
+        retry_after = self.client(client).requests.take()
+        if retry_after:
+            raise ThrottledError(
+                f"Too many requests, at most {self.requests_per_second:g} per second",
+                "requests",
+                retry_after,
+            )
+
+    @contextlib.contextmanager
+    def command(self, client: Hashable) -> Iterator[None]:
+        """Admit a command from `client`, unless too many of its commands run or wait already."""
+        if not self.max_commands:
+            yield
+            return
+        limits = self.client(client)
+        if limits.commands >= self.max_commands:
+            raise ThrottledError(
+                f"Too many commands, at most {self.max_commands} at once", "commands"
+            )
+        limits.commands += 1
+        try:
+            yield
+        finally:
+            limits.commands -= 1
+
+    def delay(self, client: Hashable, size: int) -> float:
+        """Count `size` bytes to or from `client`, returns the seconds to hold off for."""
+        if not self.bytes_per_second:
+            return 0.0
+        return self.client(client).bytes.spend(size)
+
+    async def transfer(self, client: Hashable, size: int) -> None:
+        """Wait until `client` may send or receive another `size` bytes."""
+        delay = self.delay(client, size)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class ThrottledWriter(WriterProxy):
+    """Slows writes down to a client's byte rate."""
+
+    def __init__(self, writer, limiter: RateLimiter, client: Hashable):
+        super().__init__(writer)
+        self.limiter = limiter
+        self.client = client
+        self.delay = 0.0
+
+    def writelines(self, data: Sequence[bytes]) -> None:
+        self.delay = self.limiter.delay(self.client, sum(len(part) for part in data))
+        super().writelines(data)
+
+    async def drain(self) -> None:
+        await super().drain()
+        if self.delay:
+            await asyncio.sleep(self.delay)
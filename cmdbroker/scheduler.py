@@ -0,0 +1,94 @@
+import asyncio
+import contextlib
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Hashable
+
+
+class QueueFullError(Exception):
+    """Raised when a command can neither run nor wait for its turn."""
+
+
+class Scheduler:
+    """Caps the number of commands running at once, queueing the rest.
+
+    Queued commands are grouped by client and the clients take turns, so one client
+    sending a burst of commands does not hold up everybody else.
+    """
+
+    def __init__(self, max_running: int, max_queued: int):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.running = 0
+        self.queued = 0
+        # Waiting commands per client, in the order the clients get their turn
+        self.waiting: Dict[Hashable, Deque[asyncio.Future]] = {}
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, client: Hashable) -> AsyncIterator[float]:
+        """Wait for a command from `client` to be allowed to run, yielding how long it waited."""
+        started = time.perf_counter()
+        await self.acquire(client)
+        wait_time = time.perf_counter() - started
+
+        self.waited += 1
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            yield wait_time
+        finally:
+            self.release()
+
+    async def acquire(self, client: Hashable) -> None:
+        if self.running < self.max_running and not self.queued:
+            self.running += 1
+            return
+
+        if self.queued >= self.max_queued:
+            raise QueueFullError(f"Server is busy, {self.queued} commands are already queued")
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(client, deque()).append(future)
+        self.queued += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                # The slot was handed over just before the cancellation
+                self.release()
+            elif future in self.waiting.get(client, ()):
+                # Still queued, unless a release dropped it since the cancellation
+                self.waiting[client].remove(future)
+                if not self.waiting[client]:
+                    del self.waiting[client]
+                self.queued -= 1
+            raise
+
+    def release(self) -> None:
+        """Hand the slot over to the next client in line, or free it."""
+        while self.waiting:
+            client = next(iter(self.waiting))
+            futures = self.waiting.pop(client)
+            future = futures.popleft()
+            if futures:
+                # Go to the back of the line
+                self.waiting[client] = futures
+            self.queued -= 1
+            # Cancelled commands are skipped, they have yet to notice they were
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "max_running": self.max_running,
+            "max_queued": self.max_queued,
+            "mean_wait_time": self.wait_time / self.waited if self.waited else 0.0,
+            "max_wait_time": self.max_wait_time,
+        }
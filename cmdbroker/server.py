@@ -1,30 +1,86 @@
 import argparse
 import asyncio
+import base64
+import contextlib
+import functools
 import getpass
 import ipaddress
+import json
+import multiprocessing
 import os
 import signal
+import socket
 import ssl
 import sys
+import time
 from datetime import datetime, timedelta
+from typing import Set
 
-from cryptography import x509
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives.serialization import (
-    BestAvailableEncryption,
-    Encoding,
-    PrivateFormat,
+from . import eventloop, handover
+from .cache import ResultCache
+from .compression import choose, compress, decompress
+from .flow import InputQueue, end_stream
+from .message import CHUNK_SIZE, MAX_FRAME_SIZE, Message, MessageType, ProtocolError, negotiate
+from .metrics import CountingWriter, ServerMetrics
+from .process import CommandTimeoutError, Process, ShellPool
+from .ratelimit import RateLimiter, ThrottledError, ThrottledWriter
+from .scheduler import QueueFullError, Scheduler
+from .tracing import TimedWriter, Trace
+
+# Number of TLS 1.3 session tickets sent to each client, every resumption uses one up
+SESSION_TICKETS = 2
+
+# Seconds a worker has to stop before it is killed, and that one exiting sooner after
+# starting waits before it is restarted, so a broken setup does not spin
+WORKER_STOP_TIMEOUT = 10
+WORKER_RESTART_DELAY = 1
+
+# Request methods counted in the metrics, anything else is counted as invalid
+METHODS = ("process", "exec", "batch", "status")
+
+# Options a reload applies, and those that only change when the server restarts
+RELOADED_OPTIONS = (
+    "broker_cert",
+    "broker_key",
+    "client_ca",
+    "timeout",
+    "drain_timeout",
+    "log_requests",
+    "max_frame_size",
+    "max_client_processes",
+    "rate_limit_requests",
+    "rate_limit_bytes",
 )
-from cryptography.x509.oid import NameOID
+RESTART_OPTIONS = (
+    "address",
+    "port",
+    "workers",
+    "event_loop",
+    "max_processes",
+    "max_queued",
+    "warm_shells",
+    "metrics_port",
+    "cache_ttl",
+    "cache_size",
+    "cache_env",
+)
+
+
+class TimedSSLContext(ssl.SSLContext):
+    """Notes when the TLS handshake of each connection starts, to measure how long it takes."""
 
-from .message import Message
+    def wrap_bio(self, *args, **kwargs):
+        # asyncio wraps the connection as soon as it is accepted
+        ssl_object = super().wrap_bio(*args, **kwargs)
+        setattr(ssl_object, "handshake_started", time.perf_counter())
+        return ssl_object
 
 
 class Server:
     """Server class to handle incoming requests from clients."""
 
     def __init__(self, params: argparse.Namespace):
+        self.params = params
         self.address = params.address
         self.port = params.port
         self.broker_cert = params.broker_cert
@@ -35,9 +91,45 @@ class Server:
         self.cert_locality = params.cert_locality
         self.cert_org = params.cert_org
         self.cert_days = params.cert_days
+        # Clients need a certificate signed by this CA to connect, when set
+        self.client_ca = params.client_ca
+        self.scheduler = Scheduler(params.max_processes, params.max_queued)
+        self.limiter = RateLimiter(
+            params.rate_limit_requests, params.max_client_processes, params.rate_limit_bytes
+        )
+        self.max_frame_size = params.max_frame_size
+        self.cache = None
+        if params.cache_ttl:
+            self.cache = ResultCache(params.cache_ttl, params.cache_size, params.cache_env)
+        self.shells = ShellPool(params.warm_shells) if params.warm_shells else None
+        self.metrics = ServerMetrics(self.scheduler)
+        self.metrics_port = params.metrics_port
+        self.log_requests = params.log_requests
+        # Seconds commands may run for unless their request says otherwise, 0 for no limit
+        self.timeout = params.timeout
+        # Seconds the requests in flight get to finish once the server stops
+        self.drain_timeout = params.drain_timeout
+        self.workers = params.workers
+        # Which of the worker processes sharing the port this is, None for a single server
+        self.worker = None
+        # Set by workers once they accept connections, for a supervisor taking over a port
+        self.listening = None
         self.server = None
+        self.serving = None
+        self.metrics_server = None
+        # The SSL context handed to new connections, replaced by reloads
+        self.latest_ssl_context = None
+        # Tasks serving the open client connections, and set once they should wind down
+        self.connections: Set[asyncio.Task] = set()
+        self.draining = asyncio.Event()
+        self.restarting = None
+        self.stop_reason = "Server stopped by user."
+        # The server that started this one to take over its listening socket, if any
+        self.predecessor = handover.predecessor()
+        # A restarted server keeps the certificate and key its predecessor used
+        generate_cert_and_key = params.generate_cert_and_key and self.predecessor is None
 
-        if params.generate_cert_and_key:
+        if generate_cert_and_key:
             if not self.cert_country:
                 self.cert_country = input("Enter the country for the certificate: ")
             if not self.cert_state:
@@ -47,6 +139,8 @@ class Server:
             if not self.cert_org:
                 self.cert_org = input("Enter the organization for the certificate: ")
 
+        if self.password is None and self.predecessor is not None:
+            self.password = self.predecessor.password
         if self.password is None:
             try:
                 # Prompt the user for a password, do not echo the input
@@ -57,7 +151,7 @@ class Server:
                 print("Password cannot be empty.")
                 sys.exit(0)
 
-        if params.generate_cert_and_key:
+        if generate_cert_and_key:
             self.generate_cert_and_key()
 
         if not (os.path.exists(self.broker_cert) and os.path.exists(self.broker_key)):
@@ -65,66 +159,780 @@ class Server:
 
     def stop(self):
         if self.server:
-            print("Server stopped by user.")
+            # Stop accepting, the connections that are open drain once serving ends
             self.server.close()
+            if self.serving is not None:
+                # Closing the server does not end serve_forever with uvloop
+                self.serving.cancel()
+            if self.metrics_server:
+                self.metrics_server.close()
+            if self.worker is None:
+                # Stdout may be gone, a successor inherits it from the server it replaced
+                with contextlib.suppress(OSError):
+                    print(self.stop_reason)
         else:
             print("There is no server running.")
 
-    async def run(self):
-        loop = asyncio.get_running_loop()
-        loop.add_signal_handler(signal.SIGINT, self.stop)
-
-        # Create an SSL context
-        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    def ssl_context(self):
+        """Create an SSL context, shared by every connection."""
         try:
-            ssl_context.load_cert_chain(self.broker_cert, self.broker_key, self.password)
+            return self.new_ssl_context(
+                self.broker_cert, self.broker_key, self.password, self.client_ca
+            )
         except ssl.SSLError:
             print("Wrong password for key")
             sys.exit(0)
 
-        # Start an SSL server
-        self.server = await asyncio.start_server(
-            self.handle_request, self.address, self.port, ssl=ssl_context
+    @staticmethod
+    def new_ssl_context(broker_cert, broker_key, password, client_ca=None):
+        """Create an SSL context from the given files, raises if they do not load."""
+        ssl_context = TimedSSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # Hand out session tickets so returning clients can skip the full handshake
+        ssl_context.options &= ~ssl.OP_NO_TICKET
+        ssl_context.num_tickets = SESSION_TICKETS
+        ssl_context.load_cert_chain(broker_cert, broker_key, password)
+        if client_ca:
+            # Mutual TLS, clients are told apart by their certificate instead of their address
+            ssl_context.verify_mode = ssl.CERT_REQUIRED
+            ssl_context.load_verify_locations(client_ca)
+        return ssl_context
+
+    def use_latest_ssl_context(self, ssl_object, server_name, ssl_context):
+        """Switch a connection over to the SSL context of the last reload as it shakes hands.
+
+        Called for every handshake on the context the server listens with, clients need not
+        send a server name. Connections that are already open keep the context they got.
+        """
+        if ssl_context is not self.latest_ssl_context:
+            ssl_object.context = self.latest_ssl_context
+
+    def reload(self):
+        """Parse the command line and configuration file again, returns whether it worked.
+
+        New connections get the certificate, key and client CA as they are now, and
+        timeouts and limits apply to the requests that come after. Options that take a
+        restart keep their value until then, see `restart`.
+        """
+        # The command line module depends on the client, which the server otherwise does not
+        from .cli import parse_args
+
+        try:
+            params = parse_args()
+        except (SystemExit, ValueError):
+            print("Not reloading, the configuration is invalid.")
+            return False
+        restart = [
+            name for name in RESTART_OPTIONS if getattr(params, name) != getattr(self.params, name)
+        ]
+        if bool(params.client_ca) != bool(self.client_ca):
+            # Whether clients need a certificate stays with the context the server listens with
+            restart.append("client_ca")
+            params.client_ca = self.client_ca
+        password = params.password or self.password
+        try:
+            ssl_context = self.new_ssl_context(
+                params.broker_cert, params.broker_key, password, params.client_ca
+            )
+        except (ssl.SSLError, OSError) as err:
+            print(f"Not reloading, the certificate and key do not load: {err}")
+            return False
+
+        self.latest_ssl_context = ssl_context
+        self.params = argparse.Namespace(
+            **{**vars(self.params), **{name: getattr(params, name) for name in RELOADED_OPTIONS}}
         )
+        self.broker_cert = params.broker_cert
+        self.broker_key = params.broker_key
+        self.password = password
+        self.client_ca = params.client_ca
+        self.timeout = params.timeout
+        self.drain_timeout = params.drain_timeout
+        self.log_requests = params.log_requests
+        self.max_frame_size = params.max_frame_size
+        limits = (params.rate_limit_requests, params.max_client_processes, params.rate_limit_bytes)
+        limiter = self.limiter
+        if limits != (limiter.requests_per_second, limiter.max_commands, limiter.bytes_per_second):
+            # Clients start over with limits of the new size
+            self.limiter = RateLimiter(*limits)
+        if self.worker is None:
+            print("Reloaded the configuration, certificate and key.")
+            if restart:
+                options = ", ".join("--" + name.replace("_", "-") for name in restart)
+                print(f"Restart the server to change {options}.")
+        return True
+
+    async def run(self):
+        if self.workers > 1 and self.worker is None:
+            return await self.supervise()
+
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+        ssl_context = self.latest_ssl_context = self.ssl_context()
+        ssl_context.sni_callback = self.use_latest_ssl_context
+        if self.predecessor is None:
+            # Start an SSL server, workers share the port with each other
+            self.server = await asyncio.start_server(
+                self.handle_request,
+                self.address,
+                self.port,
+                ssl=ssl_context,
+                reuse_port=self.worker is not None,
+            )
+        else:
+            # Accept on the socket of the server that started this one, it queued connections
+            # all along
+            self.server = await asyncio.start_server(
+                self.handle_request, ssl=ssl_context, sock=self.predecessor.socket
+            )
+        if self.worker is None:
+            loop.add_signal_handler(signal.SIGUSR2, self.restart, self.server.sockets, self.stop)
+        if self.shells is not None:
+            self.shells.fill()
         addr = ":".join([str(part) for part in self.server.sockets[0].getsockname()])
-        print(f"Server listening on {addr}. Press Ctrl+C to stop.")
+        if self.metrics_port:
+            self.metrics_server = await asyncio.start_server(
+                self.metrics.handle_scrape, self.address, self.metrics_port
+            )
+            metrics_addr = self.metrics_server.sockets[0].getsockname()
+            print(f"Serving metrics on http://{metrics_addr[0]}:{metrics_addr[1]}/metrics")
+        if self.worker is None:
+            print(f"Server listening on {addr}. Press Ctrl+C to stop.")
+        else:
+            print(f"Worker {self.worker} (pid {os.getpid()}) listening on {addr}.")
+        if self.predecessor is not None:
+            self.predecessor.ready()
+        if self.listening is not None:
+            self.listening.set()
         try:
-            await self.server.serve_forever()
+            self.serving = asyncio.ensure_future(self.server.serve_forever())
+            await self.serving
         except asyncio.exceptions.CancelledError:
             # Occurs as a side-effect of SIGINT (Ctrl+C) but we handle that signal
             # in self.stop() so we can safely ignore it here.
             pass
+        await self.drain()
+
+    async def drain(self):
+        """Give the open connections `drain_timeout` seconds to finish their requests.
+
+        Clients are asked to send their next requests elsewhere, whatever still runs at the
+        deadline is cancelled, which stops its commands.
+        """
+        self.draining.set()
+        if not self.connections:
+            return
+        if self.worker is None:
+            print(f"Waiting up to {self.drain_timeout:g} seconds for the requests in flight.")
+        _, pending = await asyncio.wait(self.connections, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def restart(self, sockets, stop):
+        """Hand the listening socket over to a new server process, then stop this one."""
+        if self.restarting is None or self.restarting.done():
+            self.restarting = asyncio.ensure_future(self.hand_over(sockets, stop))
+
+    async def hand_over(self, sockets, stop):
+        if len(sockets) != 1:
+            print("Restarting takes a server listening on a single address.")
+            return
+        print("Restarting, starting a new server on the same socket.")
+        pid = await handover.start_successor(sockets[0], self.password)
+        if pid is None:
+            print("The new server did not start, this one keeps running.")
+            return
+        self.stop_reason = f"Server {pid} took over the port."
+        stop()
+
+    async def supervise(self):
+        """Run `workers` server processes sharing the port, restarting any that die."""
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGINT, self.stopping.set)
+        loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+
+        # Fail here rather than in every worker
+        self.ssl_context()
+        # Hold the port for restarted workers, without listening it gets no connections
+        if self.predecessor is None:
+            reserved = self.reserve_port()
+        else:
+            reserved = self.predecessor.socket
+        port = reserved.getsockname()[1]
+        loop.add_signal_handler(signal.SIGUSR2, self.restart, [reserved], self.stopping.set)
+
+        workers = {index: self.start_worker(index, port) for index in range(self.workers)}
+        loop.add_signal_handler(signal.SIGHUP, self.reload_workers, workers)
+        exits = {asyncio.create_task(self.exited(workers[index])): index for index in workers}
+        stop = asyncio.create_task(self.stopping.wait())
+        taking_over = None
+        if self.predecessor is not None:
+            taking_over = asyncio.create_task(self.take_over(list(workers.values())))
+        # Stdout may be gone, like in stop()
+        with contextlib.suppress(OSError):
+            print(
+                f"Server listening on {self.address}:{port} with {self.workers} workers."
+                " Press Ctrl+C to stop."
+            )
+
+        while True:
+            done, _ = await asyncio.wait({stop, *exits}, return_when=asyncio.FIRST_COMPLETED)
+            if stop in done:
+                break
+            for task in done:
+                index = exits.pop(task)
+                process = workers[index]
+                with contextlib.suppress(OSError):
+                    print(f"Worker {index} exited with status {process.exitcode}, restarting it.")
+                if time.monotonic() - process.started < WORKER_RESTART_DELAY:
+                    await asyncio.wait({stop}, timeout=WORKER_RESTART_DELAY)
+                workers[index] = self.start_worker(index, port)
+                exits[asyncio.create_task(self.exited(workers[index]))] = index
+
+        if taking_over is not None:
+            taking_over.cancel()
+        # Pass the signal on and give the workers time to drain
+        for process in workers.values():
+            process.terminate()
+        _, pending = await asyncio.wait(exits, timeout=self.drain_timeout + WORKER_STOP_TIMEOUT)
+        for task in pending:
+            workers[exits[task]].kill()
+        await asyncio.gather(*pending)
+        reserved.close()
+        with contextlib.suppress(OSError):
+            print(self.stop_reason)
+
+    def reload_workers(self, workers):
+        """Reload here to check the configuration and report on it, then in every worker."""
+        if self.reload():
+            for process in workers.values():
+                # Unless it died and waits to be restarted, with the new configuration
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(process.pid, signal.SIGHUP)
+
+    async def take_over(self, workers):
+        """Let the predecessor know once all of the first workers accept connections.
+
+        The predecessor stops its own workers then, so the port is never left unserved.
+        """
+        while not all(process.listening.is_set() for process in workers):
+            await asyncio.sleep(0.1)
+        self.predecessor.ready()
+
+    def reserve_port(self):
+        """Bind the port the workers share, which also picks one for all of them if it is 0."""
+        family, kind, proto, _, address = socket.getaddrinfo(
+            self.address, self.port, type=socket.SOCK_STREAM
+        )[0]
+        reserved = socket.socket(family, kind, proto)
+        reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        reserved.bind(address)
+        return reserved
+
+    def start_worker(self, index, port):
+        # Workers do not prompt or generate certificates again, and serve metrics side by side
+        params = argparse.Namespace(
+            **{
+                **vars(self.params),
+                "port": port,
+                "password": self.password,
+                "generate_cert_and_key": False,
+                "metrics_port": self.metrics_port + index if self.metrics_port else 0,
+            }
+        )
+        # A fresh interpreter rather than a fork of the running event loop
+        context = multiprocessing.get_context("spawn")
+        listening = context.Event()
+        process = context.Process(
+            target=run_worker, args=(params, index, listening), name=f"cmdbroker-worker-{index}"
+        )
+        process.start()
+        process.started = time.monotonic()
+        process.listening = listening
+        return process
+
+    @staticmethod
+    async def exited(process):
+        """Wait for a worker process to exit."""
+        await asyncio.to_thread(process.join)
 
     async def handle_request(self, reader, writer):
-        # Process incoming data
-        request = await Message.async_read(reader)
+        """Serve the requests multiplexed over a client connection until it disconnects."""
+        # Commands are queued fairly, and limited, per client
+        client = self.client_identity(writer)
+        stdin_queues = {}
+        tasks = {}
+        self.metrics.accepted.inc()
+        self.metrics.connections.inc()
+        # Only the first request of the connection waited for the handshake
+        handshake = None
+        started = getattr(writer.get_extra_info("ssl_object"), "handshake_started", None)
+        if started is not None:
+            handshake = time.perf_counter() - started
+            self.metrics.handshake_duration.observe(handshake)
+        writer = CountingWriter(writer, self.metrics.sent_bytes)
+        if self.limiter.bytes_per_second:
+            writer = ThrottledWriter(writer, self.limiter, client)
+        # Cancelled if the client still keeps it open once the server is done draining
+        connection = asyncio.current_task()
+        self.connections.add(connection)
+        hang_up = None
+        try:
+            # Agree on the protocol version and compression before anything else
+            hello = await self.read_message(reader)
+            welcome = {"version": negotiate(hello)}
+            codec = choose(hello.json().get("compression", []))
+            if codec is not None:
+                welcome["compression"] = codec.name
+            await Message.build(welcome, 0, MessageType.HELLO).async_write(writer)
+            hang_up = asyncio.create_task(self.hang_up(writer))
 
-        request_json = request.json()
-        method = request_json["method"]
-        if method == "process":
-            parameters = request_json["parameters"]
-            cmd = parameters["command"]
+            while True:
+                message = await self.read_message(reader)
+                if message.type == MessageType.REQUEST:
+                    stdin_queue = InputQueue(message.stream_id, writer)
+                    stdin_queues[message.stream_id] = stdin_queue
+                    task = asyncio.create_task(
+                        self.handle_stream(message, client, stdin_queue, writer, codec, handshake)
+                    )
+                    handshake = None
+                    task.add_done_callback(
+                        functools.partial(end_stream, stdin_queues, tasks, message.stream_id)
+                    )
+                    tasks[message.stream_id] = task
+                elif message.type == MessageType.STDIN and message.stream_id in stdin_queues:
+                    # Holding off reading slows the client down too
+                    await self.limiter.transfer(client, len(message.text))
+                    message = decompress(message, codec, self.max_frame_size)
+                    await stdin_queues[message.stream_id].put(message.text)
+                elif message.type == MessageType.CANCEL and message.stream_id in tasks:
+                    # The client gave up on the request, stop its command
+                    tasks[message.stream_id].cancel()
+        except ProtocolError as err:
+            self.metrics.errors.inc(error=type(err).__name__)
+            # Let the client know why it is being disconnected, if it is still there
+            with contextlib.suppress(ConnectionError):
+                await Message.build({"error": str(err)}, 0, MessageType.HELLO).async_write(writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client closed the connection
+            pass
+        except asyncio.CancelledError:
+            # Still open once the server was done draining, nobody awaits this to find out
+            pass
+        finally:
+            if hang_up is not None:
+                hang_up.cancel()
+            # Nobody is left to read the output, stop the commands that are still running
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            self.metrics.connections.dec()
+            self.connections.discard(connection)
+
+            writer.close()
+            with contextlib.suppress(ConnectionError, ssl.SSLError):
+                # The client may still be sending as the server hangs up
+                await writer.wait_closed()
 
-            process = await asyncio.create_subprocess_shell(
-                cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+    async def hang_up(self, writer):
+        """Once the server drains, ask the client to send no more requests over the connection.
+
+        The client closes the connection when its requests are done.
+        """
+        await self.draining.wait()
+        with contextlib.suppress(ConnectionError):
+            await Message(MessageType.GOAWAY).async_write(writer)
+
+    @staticmethod
+    def client_identity(writer):
+        """The common name of the client's certificate with mutual TLS, its address otherwise."""
+        for rdn in (writer.get_extra_info("peercert") or {}).get("subject", ()):
+            for name, value in rdn:
+                if name == "commonName":
+                    return value
+        peername = writer.get_extra_info("peername")
+        return peername[0] if peername else None
+
+    async def read_message(self, reader):
+        message = await Message.async_read(reader, self.max_frame_size)
+        self.metrics.received_bytes.inc(Message.HEADER.size + len(message.text))
+        return message
+
+    async def handle_stream(self, request, client, stdin_queue, writer, codec=None, handshake=None):
+        """Run a single request and let the client know when it is done."""
+        trace = Trace(handshake)
+        trace.add("read", request.read_time)
+        writer = TimedWriter(writer, trace)
+        request_json = {}
+        try:
+            with trace.phase("read"):
+                request_json = self.check_request(request.json())
+            response = await self.process_request(
+                request_json, request.stream_id, client, stdin_queue, writer, trace, codec
             )
+        except asyncio.CancelledError:
+            self.metrics.errors.inc(error="CancelledError")
+            raise
+        except (ValueError, QueueFullError, CommandTimeoutError, ThrottledError, OSError) as err:
+            # OSError covers executables and working directories that do not exist
+            self.metrics.errors.inc(error=type(err).__name__)
+            response = {"error": str(err)}
+            if isinstance(err, ThrottledError):
+                response["throttled"] = err.details
+        except Exception as err:
+            # Whatever went wrong, the client must not be left waiting for the END message
+            self.metrics.errors.inc(error=type(err).__name__)
+            response = {"error": f"Internal server error: {type(err).__name__}: {err}"}
+
+        if request_json.get("timings"):
+            response = {**response, "request_id": trace.id, "timings": trace.timings()}
+        await Message.build(response, request.stream_id, MessageType.END).async_write(writer)
+        if self.log_requests:
+            self.log_request(trace, client, request.stream_id, request_json, response)
+        if self.shells is not None:
+            # Replace the shell the command used, now that it no longer holds up the response
+            self.shells.fill()
 
-            if "stdin" in request_json:
-                process.stdin.write(request_json["stdin"].encode("utf8"))
-                process.stdin.close()
+    @staticmethod
+    def check_request(request_json):
+        """Make sure a request has the shape its method expects, returns it."""
+        if not isinstance(request_json, dict) or not isinstance(request_json.get("method"), str):
+            raise ValueError("A request must be a JSON object with a method")
+        method = request_json["method"]
+        if method in ("process", "exec", "batch"):
+            parameters = request_json.get("parameters")
+            if not isinstance(parameters, dict):
+                raise ValueError(f"A {method} request needs its parameters as a JSON object")
+            if method == "process" and not isinstance(parameters.get("command"), str):
+                raise ValueError("command must be a string")
+        return request_json
 
-            response_text = await process.stdout.read()
+    @staticmethod
+    def log_request(trace, client, stream_id, request_json, response):
+        """Print a JSON line describing how a request went and where its time went."""
+        entry = {
+            "request_id": trace.id,
+            "client": client,
+            "stream_id": stream_id,
+            "method": request_json.get("method"),
+        }
+        for key in ("returncode", "error", "cached"):
+            if key in response:
+                entry[key] = response[key]
+        # Unlike the timings sent back, these include writing the END message
+        entry["timings"] = trace.timings()
+        print(json.dumps(entry), flush=True)
+
+    async def process_request(
+        self, request_json, stream_id, client, stdin_queue, writer, trace, codec=None
+    ):
+        method = request_json["method"]
+        self.metrics.requests.inc(method=method if method in METHODS else "invalid")
+        self.limiter.admit(client)
+        if method in ("process", "exec"):
+            stdin = stdin_queue.chunks() if request_json.get("stdin") else None
+            if self.cache is not None and request_json.get("cache", True):
+                return await self.run_cached(
+                    request_json, stream_id, client, stdin, writer, trace, codec
+                )
+            return await self.run_command(
+                request_json, stream_id, client, stdin, writer, trace, codec=codec
+            )
+        elif method == "batch":
+            return await self.run_batch(
+                request_json["parameters"],
+                stream_id,
+                client,
+                writer,
+                trace,
+                codec,
+                self.request_timeout(request_json),
+            )
+        elif method == "status":
+            status = {"scheduler": self.scheduler.stats()}
+            if self.cache is not None:
+                status["cache"] = self.cache.stats()
+            return status
         else:
             raise ValueError(f"Invalid method: {method}")
 
-        # Send response to the client
-        writer.write(response_text)
-        await writer.drain()
+    def request_timeout(self, request_json):
+        """Seconds the commands of a request may run for, None if there is no limit."""
+        timeout = request_json.get("timeout", self.timeout or None)
+        if timeout is not None and (
+            isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0
+        ):
+            raise ValueError("timeout must be a positive number of seconds")
+        return timeout
+
+    async def run_command(
+        self, request_json, stream_id, client, stdin, writer, trace, recording=None, codec=None
+    ):
+        """Run the requested command once the scheduler lets it and describe how it went."""
+        with self.limiter.command(client):
+            async with self.scheduler.slot(client) as wait_time:
+                trace.add("queue", wait_time)
+                process = await self.run_process(
+                    request_json, stream_id, stdin, writer, trace, recording, codec
+                )
+        self.record(request_json["method"], wait_time, process)
+        return {
+            "returncode": process.returncode,
+            "wait_time": wait_time,
+            "rusage": process.rusage,
+        }
+
+    async def run_cached(self, request_json, stream_id, client, stdin, writer, trace, codec=None):
+        """Answer from the cache, or run the command and remember what it output."""
+        # The cache key covers stdin, so all of it has to arrive first
+        chunks, size = [], 0
+        if stdin is not None:
+            async for chunk in stdin:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > self.cache.max_size:
+                    # Too large to cache, pass what arrived so far on along with the rest
+                    return await self.run_command(
+                        request_json,
+                        stream_id,
+                        client,
+                        self.replay(chunks, stdin),
+                        writer,
+                        trace,
+                        codec=codec,
+                    )
+            stdin = self.replay(chunks, stdin)
+
+        # Covers the argv, working directory and environment overrides of exec requests too
+        command = json.dumps([request_json["method"], request_json["parameters"]], sort_keys=True)
+        key = self.cache.key(command, b"".join(chunks), os.environ)
+        entry, shared = await self.cache.fetch(
+            key,
+            functools.partial(
+                self.run_command,
+                request_json,
+                stream_id,
+                client,
+                stdin,
+                writer,
+                trace,
+                codec=codec,
+            ),
+        )
+        if not shared:
+            return entry.response
+
+        for message_type, chunk in entry.output:
+            await compress(Message(message_type, chunk, stream_id), codec).async_write(writer)
+        return {**entry.response, "wait_time": 0.0, "cached": True}
+
+    async def run_batch(
+        self, parameters, stream_id, client, writer, trace, codec=None, timeout=None
+    ):
+        """Run a list of commands, sending a RESULT message for each one as it completes."""
+        commands = parameters.get("commands")
+        if not isinstance(commands, list) or not commands:
+            raise ValueError("commands must be a non-empty list")
+        for command in commands:
+            if not isinstance(command, dict) or ("argv" in command) == isinstance(
+                command.get("command"), str
+            ):
+                raise ValueError("Each command of a batch needs either a command string or argv")
+        max_parallel = parameters.get("max_parallel", self.scheduler.max_running)
+        if not isinstance(max_parallel, int) or max_parallel < 1:
+            raise ValueError("max_parallel must be a positive integer")
+        if self.limiter.max_commands:
+            # A batch must not get its own commands throttled
+            max_parallel = min(max_parallel, self.limiter.max_commands)
+        if not parameters.get("parallel", True):
+            max_parallel = 1
+        stop_on_failure = parameters.get("stop_on_failure", False)
+
+        # Commands wait for their turn here so a large batch does not fill the scheduler queue
+        semaphore = asyncio.Semaphore(max_parallel)
+        counts = {"succeeded": 0, "failed": 0, "skipped": 0}
 
-        writer.close()
-        await writer.wait_closed()
+        async def run(index, command):
+            async with semaphore:
+                if stop_on_failure and counts["failed"]:
+                    result = {"skipped": True}
+                    counts["skipped"] += 1
+                else:
+                    result = await self.run_batch_command(command, client, trace, timeout)
+                    counts["succeeded" if result.get("returncode") == 0 else "failed"] += 1
+            message = Message.build({"index": index, **result}, stream_id, MessageType.RESULT)
+            await compress(message, codec).async_write(writer)
+            if self.shells is not None:
+                self.shells.fill()
+
+        await asyncio.gather(*(run(index, command) for index, command in enumerate(commands)))
+        return {"returncode": 1 if counts["failed"] else 0, **counts}
+
+    async def run_batch_command(self, command, client, trace, timeout=None):
+        """Run a command of a batch without stdin, collecting its output."""
+        request_json = {"method": "exec" if "argv" in command else "process", "parameters": command}
+        # Leave room for base64 and both streams in a single message, which clients read with
+        # the default frame size limit whatever the server's is
+        limit = min(self.max_frame_size, MAX_FRAME_SIZE) // 4
+        try:
+            with self.limiter.command(client):
+                async with self.scheduler.slot(client) as wait_time:
+                    trace.add("queue", wait_time)
+                    with trace.phase("spawn"):
+                        process = await self.start_process(request_json, stdin=False)
+                    (stdout, stdout_size), (stderr, stderr_size) = await process.supervise(
+                        self.collect_outputs(process, limit), timeout
+                    )
+        except (ValueError, QueueFullError, CommandTimeoutError, ThrottledError, OSError) as err:
+            self.metrics.errors.inc(error=type(err).__name__)
+            if isinstance(err, ThrottledError):
+                return {"error": str(err), "throttled": err.details}
+            return {"error": str(err)}
+        trace.add("run", process.rusage["wall_time"])
+        self.record(request_json["method"], wait_time, process)
+
+        return {
+            "returncode": process.returncode,
+            "wait_time": wait_time,
+            "rusage": process.rusage,
+            "stdout": base64.b64encode(stdout).decode("ascii"),
+            "stderr": base64.b64encode(stderr).decode("ascii"),
+            "truncated": max(stdout_size, stderr_size) > limit,
+        }
+
+    def record(self, method, wait_time, process):
+        """Count a command that ran in the metrics."""
+        self.metrics.wait_time.observe(wait_time)
+        self.metrics.command_duration.observe(process.rusage["wall_time"], method=method)
+
+    async def run_process(
+        self, request_json, stream_id, stdin, writer, trace, recording=None, codec=None
+    ):
+        """Run the requested command, streaming its input and output, until it exits."""
+        timeout = self.request_timeout(request_json)
+        with trace.phase("spawn"):
+            process = await self.start_process(request_json, stdin=stdin is not None)
+
+        stdin_task = None
+        if process.stdin:
+            # The client streams stdin after the request, pipe it in as it arrives
+            stdin_task = asyncio.create_task(self.stream_input(stdin, process.stdin))
+
+        try:
+            await process.supervise(
+                self.stream_outputs(process, stream_id, writer, recording, codec), timeout
+            )
+        finally:
+            if stdin_task:
+                # The command may finish without consuming all of its input
+                stdin_task.cancel()
+        trace.add("run", process.rusage["wall_time"])
+
+        return process
+
+    @classmethod
+    async def stream_outputs(cls, process, stream_id, writer, recording=None, codec=None):
+        """Forward the output of `process` to the client as it is produced, until it exits."""
+        await asyncio.gather(
+            cls.stream_output(
+                process.stdout, MessageType.STDOUT, stream_id, writer, recording, codec
+            ),
+            cls.stream_output(
+                process.stderr, MessageType.STDERR, stream_id, writer, recording, codec
+            ),
+        )
+        await process.wait()
+
+    async def start_process(self, request_json, stdin):
+        parameters = request_json["parameters"]
+        if request_json["method"] == "exec":
+            argv = parameters.get("argv")
+            if (
+                not isinstance(argv, list)
+                or not argv
+                or not all(isinstance(arg, str) for arg in argv)
+            ):
+                raise ValueError("argv must be a non-empty list of strings")
+            cwd = parameters.get("cwd")
+            if cwd is not None and not isinstance(cwd, str):
+                raise ValueError("cwd must be a string")
+            env = parameters.get("env")
+            if env is not None and (
+                not isinstance(env, dict)
+                or not all(isinstance(item, str) for pair in env.items() for item in pair)
+            ):
+                raise ValueError("env must map strings to strings")
+            return await Process.exec(argv, stdin, cwd, {**os.environ, **env} if env else None)
+
+        if self.shells is not None:
+            return await self.shells.run(parameters["command"], stdin)
+        return await Process.start(parameters["command"], stdin)
+
+    @staticmethod
+    async def replay(chunks, stdin):
+        """Yield stdin chunks that were read ahead, then the ones still to come."""
+        for chunk in chunks:
+            yield chunk
+        async for chunk in stdin:
+            yield chunk
+
+    @staticmethod
+    async def stream_input(chunks, stdin):
+        """Pipe stdin chunks from the client into `stdin`."""
+        async for chunk in chunks:
+            if stdin.is_closing():
+                continue
+            stdin.write(chunk)
+            try:
+                await stdin.drain()
+            except ConnectionError:
+                # The command stopped reading its input, discard the rest
+                stdin.close()
+        stdin.close()
+
+    @classmethod
+    async def collect_outputs(cls, process, limit):
+        """Read both outputs of `process`, see `collect_output`, and wait for it to exit."""
+        outputs = await asyncio.gather(
+            cls.collect_output(process.stdout, limit), cls.collect_output(process.stderr, limit)
+        )
+        await process.wait()
+        return outputs
+
+    @staticmethod
+    async def collect_output(stream, limit):
+        """Read `stream` to the end, keeping its first `limit` bytes, and count its size."""
+        chunks, size = [], 0
+        while chunk := await stream.read(CHUNK_SIZE):
+            if size < limit:
+                chunks.append(chunk[: limit - size])
+            size += len(chunk)
+        return b"".join(chunks), size
+
+    @staticmethod
+    async def stream_output(stream, message_type, stream_id, writer, recording=None, codec=None):
+        """Send each chunk read from `stream` to the client, waiting for it to drain."""
+        while chunk := await stream.read(CHUNK_SIZE):
+            if recording is not None:
+                recording.add(message_type, chunk)
+            await compress(Message(message_type, chunk, stream_id), codec).async_write(writer)
 
     def generate_cert_and_key(self):
+        # Imported here, the x509 stack is slow to load and only needed to make a certificate
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.serialization import (
+            BestAvailableEncryption,
+            Encoding,
+            PrivateFormat,
+        )
+        from cryptography.x509.oid import NameOID
+
         # Generate a private key
         private_key = rsa.generate_private_key(
             public_exponent=65537,
@@ -181,3 +989,11 @@ class Server:
             )
 
         print(f"Generated certificate {self.broker_cert} and key {self.broker_key}")
+
+
+def run_worker(params, index, listening=None):
+    """Run one of the server processes sharing the port."""
+    server = Server(params)
+    server.worker = index
+    server.listening = listening
+    eventloop.run(server.run(), params.event_loop)
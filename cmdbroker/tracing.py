@@ -0,0 +1,56 @@
+import contextlib
+import time
+import uuid
+from typing import Dict, Iterator, Optional, Sequence
+
+from .writer import WriterProxy
+
+
+class Trace:
+    """Where the time of a request went, phase by phase.
+
+    The phases are the TLS handshake of the connection (for its first request only),
+    reading the request, waiting for the scheduler, spawning the command, running it
+    and writing the response. Output is written while the command runs, so the phases
+    can overlap, and the commands of a batch add up.
+    """
+
+    def __init__(self, handshake: Optional[float] = None):
+        self.id = uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        if handshake is not None:
+            self.phases["handshake"] = handshake
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        """Count the time spent in the block towards `phase`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - started)
+
+    def timings(self) -> Dict[str, float]:
+        """Seconds spent in each phase so far, and since the request arrived."""
+        return {**self.phases, "total": time.perf_counter() - self.started}
+
+
+class TimedWriter(WriterProxy):
+    """Counts the time writes take as writing."""
+
+    def __init__(self, writer, trace: Trace):
+        super().__init__(writer)
+        self.trace = trace
+
+    def writelines(self, data: Sequence[bytes]) -> None:
+        # TLS transports encrypt as data is written
+        with self.trace.phase("write"):
+            super().writelines(data)
+
+    async def drain(self) -> None:
+        with self.trace.phase("write"):
+            await super().drain()
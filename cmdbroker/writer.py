@@ -0,0 +1,20 @@
+from typing import Sequence
+
+
+class WriterProxy:
+    """Passes writes on to a stream writer, for subclasses to watch or hold them up.
+
+    Anything else, such as closing the writer or its transport, goes straight to the writer.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def writelines(self, data: Sequence[bytes]) -> None:
+        self.writer.writelines(data)
+
+    async def drain(self) -> None:
+        await self.writer.drain()
+
+    def __getattr__(self, name: str):
+        return getattr(self.writer, name)
@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import os
 import shutil
 import sys
@@ -8,9 +9,42 @@ from unittest.mock import AsyncMock, MagicMock
 import pytest
 
 from cmdbroker.client import Client
+from cmdbroker.message import PROTOCOL_VERSION, Message, MessageType
 from cmdbroker.server import Server
 
 
+def client_reader(*messages, hello=Message.hello()):
+    reader = asyncio.StreamReader()
+    for message in (hello, *messages):
+        reader.feed_data(message.output())
+    # The client stays connected until these are answered, see test_server.handle_request
+    reader.streams = {
+        message.stream_id for message in messages if message.type == MessageType.REQUEST
+    }
+    return reader
+
+
+def client_writer(**extra_info):
+    writer = AsyncMock()
+    writer.writelines = MagicMock()
+    writer.close = MagicMock()
+    extra_info = {"peername": ("127.0.0.1", 50000), **extra_info}
+    writer.get_extra_info = MagicMock(side_effect=extra_info.get)
+    return writer
+
+
+def written(writer):
+    return [b"".join(args[0]) for args, _ in writer.writelines.call_args_list]
+
+
+def welcome(**hello):
+    return Message.build(hello or {"version": PROTOCOL_VERSION}, 0, MessageType.HELLO)
+
+
+def end(stream_id=1, **response):
+    return Message.build(response, stream_id, MessageType.END)
+
+
 @pytest.fixture
 def mock_argv():
     original_argv = sys.argv
@@ -21,7 +55,25 @@ def mock_argv():
 @pytest.fixture
 def client_args() -> argparse.Namespace:
     return argparse.Namespace(
-        command="test_command", address="127.0.0.1", port=8080, broker_cert="test-cert.pem"
+        command="test_command",
+        address="127.0.0.1",
+        port=8080,
+        broker_cert="test-cert.pem",
+        client_cert=None,
+        client_key=None,
+        no_cache=False,
+        timings=False,
+        timeout=0,
+        exec=False,
+        cwd=None,
+        env=[],
+        batch=None,
+        sequential=False,
+        max_parallel=None,
+        stop_on_failure=False,
+        compression="none",
+        agent_socket=None,
+        no_agent=False,
     )
 
 
@@ -31,6 +83,7 @@ def client_ssl_context():
     ssl_context.check_hostname = True
     ssl_context.verify_mode = MagicMock()
     ssl_context.load_verify_locations = MagicMock()
+    ssl_context.sessions = {}
     return ssl_context
 
 
@@ -72,6 +125,7 @@ def server_args(ssl_files):
         port=8080,
         broker_cert=ssl_files[0],
         broker_key=ssl_files[1],
+        client_ca=None,
         cert_country="US",
         cert_state="CA",
         cert_locality="San Francisco",
@@ -79,6 +133,22 @@ def server_args(ssl_files):
         cert_days=15,
         generate_cert_and_key=False,
         password="test-password",
+        max_processes=4,
+        max_queued=8,
+        max_client_processes=0,
+        rate_limit_requests=0,
+        rate_limit_bytes=0,
+        max_frame_size=1024,
+        warm_shells=0,
+        metrics_port=0,
+        log_requests=False,
+        timeout=0,
+        drain_timeout=30,
+        workers=1,
+        event_loop="asyncio",
+        cache_ttl=0,
+        cache_size=1024,
+        cache_env=["PATH"],
     )
 
 
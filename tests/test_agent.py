@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import stat
+from contextlib import redirect_stdout
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from cmdbroker import benchmark
+from cmdbroker.agent import Agent
+from cmdbroker.client import AgentConnection, BrokerError, ThrottledError, client_ssl_context
+from cmdbroker.flow import STDIN_WINDOW
+from cmdbroker.message import Message, MessageType
+
+from .conftest import client_reader, client_writer, end, welcome, written
+
+SERVER = {"address": "127.0.0.1", "port": 8080, "broker_cert": "/certs/broker-cert.pem"}
+
+
+@pytest.fixture
+def agent(tmp_path):
+    return Agent(argparse.Namespace(agent_socket=str(tmp_path / "agent.sock")))
+
+
+async def handle_client(agent, reader, writer, responses=0):
+    """Let the agent serve a client that disconnects once it has had `responses` messages."""
+    handled = asyncio.create_task(agent.handle_client(reader, writer))
+    while len(written(writer)) < responses and not handled.done():
+        await asyncio.sleep(0)
+    reader.feed_eof()
+    await asyncio.wait_for(handled, 5)
+
+
+def payload(output):
+    """The JSON payload of a message written out as `output`."""
+    return Message(MessageType.END, output[Message.HEADER.size :]).json()
+
+
+def request(stream_id=1, server=SERVER, **payload):
+    return Message.build({"method": "process", "server": server, **payload}, stream_id)
+
+
+async def chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.fixture
+def forwarded():
+    """Patch the sessions of the agent, answering every request with `responses`."""
+    requests = []
+
+    def forward(*responses):
+        async def request(payload, stdin=None):
+            requests.append((payload, stdin and [chunk async for chunk in stdin]))
+            for response in responses:
+                if isinstance(response, Exception):
+                    raise response
+                yield response
+
+        @contextlib.asynccontextmanager
+        async def borrow():
+            yield MagicMock(request=request)
+
+        session = MagicMock()
+        session.pool.return_value.borrow = borrow
+        session.close = AsyncMock()
+        return patch("cmdbroker.agent.Session", return_value=session)
+
+    forward.requests = requests
+    return forward
+
+
+@pytest.mark.asyncio
+async def test_agent_forwards_requests(agent, forwarded):
+    reader = client_reader(
+        request(1, stdin=True),
+        request(3, {**SERVER, "compression": ["zlib"], "client_cert": "/certs/client.pem"}),
+        Message(MessageType.STDIN, b"input", 1),
+        Message(MessageType.STDIN, b"", 1),
+    )
+    writer = client_writer()
+
+    with forwarded(Message(MessageType.STDOUT, b"out", 7), end(7, returncode=0)) as mock_session:
+        await handle_client(agent, reader, writer, 5)
+
+    assert written(writer)[0] == welcome().output()
+    assert sorted(written(writer)[1:]) == sorted(
+        [Message(MessageType.STDOUT, b"out", stream_id).output() for stream_id in (1, 3)]
+        + [end(stream_id, returncode=0).output() for stream_id in (1, 3)]
+    )
+    assert sorted(forwarded.requests, key=lambda request: request[1] is None) == [
+        ({"method": "process"}, [b"input"]),
+        ({"method": "process"}, None),
+    ]
+    # A session per certificates and compression, and a pool per server
+    assert set(agent.sessions) == {
+        ("/certs/broker-cert.pem", (), None, None),
+        ("/certs/broker-cert.pem", ("zlib",), "/certs/client.pem", None),
+    }
+    mock_session.assert_any_call(
+        "/certs/broker-cert.pem",
+        compression=("zlib",),
+        client_cert="/certs/client.pem",
+        client_key=None,
+    )
+    mock_session.return_value.pool.assert_called_with("127.0.0.1", 8080)
+    writer.close.assert_called_once()
+    writer.wait_closed.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "message, response, error",
+    [
+        (request(), BrokerError("Invalid method: bogus"), "Invalid method: bogus"),
+        (
+            request(),
+            ThrottledError("Too many requests", {"limit": "requests", "retry_after": 0.5}),
+            "Too many requests",
+        ),
+        (request(), ConnectionRefusedError("Connect call failed"), "Connect call failed"),
+        (Message.build({"method": "process"}, 1), None, "'server'"),
+        (Message(MessageType.REQUEST, b"{", 1), None, "Expecting property name"),
+    ],
+)
+async def test_agent_request_error(agent, forwarded, message, response, error):
+    writer = client_writer()
+
+    with forwarded(response):
+        # Input for a request that failed, and for one the agent does not know about
+        reader = client_reader(
+            message, Message(MessageType.STDIN, b"unused", 1), Message(MessageType.STDIN, b"", 9)
+        )
+        await handle_client(agent, reader, writer, 2)
+
+    hello, output = written(writer)
+    assert hello == welcome().output()
+    assert payload(output)["error"].startswith(error)
+    # Clients learn which limit they went over through the agent too
+    assert payload(output).get("throttled") == getattr(response, "details", None)
+
+
+@pytest.mark.asyncio
+async def test_agent_rejects_unsupported_protocol(agent):
+    hello = Message.build({"versions": [99]}, message_type=MessageType.HELLO)
+    writer = client_writer()
+
+    await handle_client(agent, client_reader(hello=hello), writer, 1)
+
+    (response,) = written(writer)
+    assert "error" in payload(response)
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_agent_protocol_error_cancels_requests(agent):
+    cancelled = []
+
+    async def forward(request, stdin_queue, writer):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(request.stream_id)
+            raise
+
+    reader = client_reader(request(1))
+    # The client is gone before it learns about the error
+    writer = client_writer()
+    writer.drain.side_effect = [None, ConnectionResetError]
+    writer.wait_closed.side_effect = ConnectionResetError
+
+    with patch.object(agent, "forward", forward):
+        handled = asyncio.create_task(agent.handle_client(reader, writer))
+        await asyncio.sleep(0.01)
+        # More stdin than the window lets the client send
+        reader.feed_data(Message(MessageType.STDIN, bytes(STDIN_WINDOW + 1), 1).output())
+        await asyncio.wait_for(handled, 5)
+
+    assert cancelled == [1]
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_agent_cancels_requests_of_disconnected_clients(agent, forwarded):
+    # The client goes away while the command still waits for its input
+    writer = client_writer()
+
+    with forwarded(end(returncode=0)):
+        await handle_client(agent, client_reader(request(stdin=True)), writer)
+
+    assert written(writer) == [welcome().output()]
+    assert forwarded.requests == []
+
+
+@pytest.mark.asyncio
+async def test_agent_request_cancelled_by_the_client(agent):
+    cancelled = []
+
+    async def forward(request, stdin_queue, writer):
+        if request.stream_id == 1:
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(request.stream_id)
+                raise
+        # Only answered once the other request was cancelled
+        while not cancelled:
+            await asyncio.sleep(0)
+        await end(request.stream_id, returncode=0).async_write(writer)
+
+    reader = client_reader(request(1), request(3))
+    writer = client_writer()
+
+    with patch.object(agent, "forward", forward):
+        handled = asyncio.create_task(agent.handle_client(reader, writer))
+        await asyncio.sleep(0.01)
+        reader.feed_data(Message(MessageType.CANCEL, b"", 1).output())
+        # Cancelling an unknown or finished stream does nothing
+        reader.feed_data(Message(MessageType.CANCEL, b"", 5).output())
+        while len(written(writer)) < 2:
+            await asyncio.sleep(0)
+        reader.feed_eof()
+        await asyncio.wait_for(handled, 5)
+
+    assert cancelled == [1]
+    assert written(writer) == [welcome().output(), end(3, returncode=0).output()]
+
+
+def test_agent_stop_before_running(agent):
+    with io.StringIO() as buf, redirect_stdout(buf):
+        agent.stop()
+
+        assert buf.getvalue() == ""
+
+
+@pytest.mark.asyncio
+async def test_agent_run(agent):
+    with io.StringIO() as buf, redirect_stdout(buf):
+        running = asyncio.create_task(agent.run())
+        while not os.path.exists(agent.socket_path):
+            await asyncio.sleep(0.01)
+
+        # Only the user running the agent can connect to it
+        assert stat.S_IMODE(os.stat(agent.socket_path).st_mode) == 0o600
+        agent.sessions[("cert.pem", ())] = session = MagicMock(close=AsyncMock())
+        agent.stop()
+        await running
+
+        assert buf.getvalue() == (
+            f"Agent listening on {agent.socket_path}. Press Ctrl+C to stop.\n"
+            "Agent stopped by user.\n"
+        )
+    session.close.assert_awaited_once()
+    assert not os.path.exists(agent.socket_path)
+
+
+@pytest.mark.asyncio
+async def test_agent_runs_commands_on_a_server(agent, tmp_path):
+    with io.StringIO() as buf, redirect_stdout(buf):
+        running = asyncio.create_task(agent.run())
+        while not os.path.exists(agent.socket_path):
+            await asyncio.sleep(0.01)
+        async with benchmark.local_server(str(tmp_path), 2) as (address, port, broker_cert):
+            for _ in range(2):
+                connection = AgentConnection(agent.socket_path, address, port, broker_cert)
+                async with connection:
+                    request = {"method": "process", "parameters": {"command": "cat"}}
+                    stdin = chunks(b"hello ", b"agent")
+                    *output, last = [
+                        response async for response in connection.request(request, stdin)
+                    ]
+
+                assert b"".join(response.text for response in output) == b"hello agent"
+                assert last.json()["returncode"] == 0
+            # Both clients were served over the same connection to the server
+            (session,) = agent.sessions.values()
+            (pool,) = session.pools.values()
+            assert len(pool.connections) == 1
+
+            agent.stop()
+            await running
+    client_ssl_context.cache_clear()
@@ -0,0 +1,102 @@
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from cmdbroker import benchmark
+from cmdbroker.client import Result
+from cmdbroker.eventloop import uvloop_installed
+
+
+def test_percentiles():
+    assert benchmark.percentiles(range(100, 0, -1)) == {
+        "mean": 50.5,
+        "p50": 50,
+        "p95": 95,
+        "p99": 99,
+        "max": 100,
+    }
+    assert benchmark.percentiles([0.5]) == {
+        "mean": 0.5,
+        "p50": 0.5,
+        "p95": 0.5,
+        "p99": 0.5,
+        "max": 0.5,
+    }
+
+
+@pytest.mark.parametrize(
+    "event_loop",
+    [
+        "asyncio",
+        pytest.param(
+            "uvloop",
+            marks=pytest.mark.skipif(not uvloop_installed(), reason="uvloop is not installed"),
+        ),
+    ],
+)
+def test_main(tmp_path, event_loop):
+    output = tmp_path / "results.json"
+
+    benchmark.main(
+        [
+            "--requests=10",
+            "--concurrency=2",
+            "--payload-size=100000",
+            "--connections=2",
+            f"--event-loop={event_loop}",
+            f"--output={output}",
+        ]
+    )
+
+    results = json.loads(output.read_text())
+    assert results["event_loop"] == event_loop
+    assert results["requests"] == 10
+    assert results["concurrency"] == 2
+    assert results["requests_per_second"] > 0
+    assert set(results["latency"]) == {"mean", "p50", "p95", "p99", "max"}
+    assert results["throughput"]["payload_bytes"] == 100000
+    assert results["throughput"]["stdout_mb_per_second"] > 0
+    assert results["throughput"]["stdin_mb_per_second"] > 0
+    assert set(results["connect"]) == {"full", "resumed"}
+
+
+@patch("cmdbroker.benchmark.benchmark", new_callable=AsyncMock, return_value={"requests": 1})
+def test_main_prints_results(mock_benchmark, capsys):
+    benchmark.main(["--requests=1"])
+
+    assert json.loads(capsys.readouterr().out) == {"requests": 1}
+    assert mock_benchmark.await_args.args[0].requests == 1
+    assert mock_benchmark.await_args.args[0].server_args == []
+    assert mock_benchmark.await_args.args[0].event_loop == "asyncio"
+
+
+@patch("cmdbroker.benchmark.benchmark", new_callable=AsyncMock, return_value={})
+def test_main_passes_options_to_the_server(mock_benchmark, capsys):
+    benchmark.main(["--requests=1", "--", "--warm-shells", "8"])
+
+    assert mock_benchmark.await_args.args[0].server_args == ["--warm-shells", "8"]
+
+
+@pytest.mark.asyncio
+async def test_local_server_does_not_start(tmp_path):
+    with patch("cmdbroker.benchmark.sys.executable", "false"):
+        with pytest.raises(RuntimeError, match="did not start"):
+            async with benchmark.local_server(str(tmp_path), 1):
+                pass  # pragma: no cover
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "results, error",
+    [
+        ([Result(b"short", b"", 0)], "Expected 10 bytes of output, got 5"),
+        ([Result(b"x" * 10, b"", 0), Result(b"5\n", b"", 0)], "Expected 10 bytes of input, got 5"),
+    ],
+)
+async def test_measure_throughput_checks_the_payload(results, error):
+    session = MagicMock()
+    session.run = AsyncMock(side_effect=results)
+
+    with pytest.raises(RuntimeError, match=error):
+        await benchmark.measure_throughput(session, "127.0.0.1", 8080, 10)
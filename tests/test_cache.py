@@ -0,0 +1,145 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from cmdbroker.cache import Entry, Recording, ResultCache
+from cmdbroker.message import MessageType
+
+
+def entry(size, expires=float("inf")):
+    return Entry([(MessageType.STDOUT, b"x" * size)], {"returncode": 0}, size, expires)
+
+
+def recorded(*chunks, returncode=0):
+    async def run(recording):
+        for chunk in chunks:
+            recording.add(MessageType.STDOUT, chunk)
+        await asyncio.sleep(0.01)
+        return {"returncode": returncode}
+
+    return run
+
+
+def test_recording():
+    recording = Recording(8)
+
+    recording.add(MessageType.STDOUT, b"out")
+    recording.add(MessageType.STDERR, b"err")
+
+    assert recording.output == [(MessageType.STDOUT, b"out"), (MessageType.STDERR, b"err")]
+    assert recording.complete
+
+
+def test_recording_outgrows_the_cache():
+    recording = Recording(8)
+
+    for chunk in (b"first", b"second", b""):
+        recording.add(MessageType.STDOUT, chunk)
+
+    assert recording.output == []
+    assert recording.size == 11
+    assert not recording.complete
+
+
+def test_key():
+    cache = ResultCache(60, 1024, ["PATH"])
+    key = cache.key("cmd", b"stdin", {"PATH": "/bin", "TERM": "xterm"})
+
+    assert key == cache.key("cmd", b"stdin", {"PATH": "/bin", "TERM": "dumb"})
+    assert key != cache.key("cmd", b"stdin", {"PATH": "/usr/bin"})
+    assert key != cache.key("cmd", b"", {"PATH": "/bin"})
+    assert key != cache.key("cmds", b"tdin", {"PATH": "/bin"})
+
+
+def test_get_expired_entry():
+    cache = ResultCache(60, 1024)
+    cache.put("key", entry(4, expires=10.0))
+
+    with patch("cmdbroker.cache.time.monotonic", return_value=5.0):
+        assert cache.get("key") is not None
+    with patch("cmdbroker.cache.time.monotonic", return_value=10.0):
+        assert cache.get("key") is None
+
+    assert cache.get("key") is None
+    assert cache.size == 0
+    assert cache.hits == 1
+
+
+def test_put_evicts_least_recently_used():
+    cache = ResultCache(60, 10)
+    cache.put("first", entry(4))
+    cache.put("second", entry(4))
+    cache.get("first")
+
+    cache.put("third", entry(4))
+
+    assert list(cache.entries) == ["first", "third"]
+    assert cache.size == 8
+
+
+def test_put_replaces_entry():
+    cache = ResultCache(60, 10)
+    cache.put("key", entry(4))
+
+    cache.put("key", entry(6))
+
+    assert cache.size == 6
+    assert cache.entries["key"].size == 6
+
+
+@pytest.mark.asyncio
+async def test_fetch_coalesces_identical_requests():
+    cache = ResultCache(60, 1024)
+
+    (first, first_shared), (second, second_shared) = await asyncio.gather(
+        cache.fetch("key", recorded(b"out")), cache.fetch("key", recorded(b"other"))
+    )
+    third, third_shared = await cache.fetch("key", recorded(b"other"))
+
+    assert first is second is third
+    assert first.output == [(MessageType.STDOUT, b"out")]
+    assert (first_shared, second_shared, third_shared) == (False, True, True)
+    assert cache.stats() == {"entries": 1, "size": 3, "hits": 1, "misses": 1, "coalesced": 1}
+    assert cache.pending == {}
+
+
+@pytest.mark.asyncio
+async def test_fetch_does_not_keep_failures():
+    cache = ResultCache(60, 1024)
+
+    failed, _ = await cache.fetch("key", recorded(b"out", returncode=1))
+
+    assert failed.response == {"returncode": 1}
+    assert cache.entries == {}
+
+
+@pytest.mark.asyncio
+async def test_fetch_runs_again_when_the_output_was_too_large():
+    cache = ResultCache(60, 4)
+
+    (first, _), (second, second_shared) = await asyncio.gather(
+        cache.fetch("key", recorded(b"too large")), cache.fetch("key", recorded(b"out"))
+    )
+
+    assert first.output == []
+    assert second.output == [(MessageType.STDOUT, b"out")]
+    assert not second_shared
+    assert cache.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_fetch_runs_again_when_the_first_request_failed():
+    cache = ResultCache(60, 1024)
+
+    async def fail(recording):
+        await asyncio.sleep(0.01)
+        raise ValueError("Invalid method")
+
+    first, second = await asyncio.gather(
+        cache.fetch("key", fail), cache.fetch("key", recorded(b"out")), return_exceptions=True
+    )
+
+    assert isinstance(first, ValueError)
+    assert second[0].output == [(MessageType.STDOUT, b"out")]
+    assert cache.pending == {}
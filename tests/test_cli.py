@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import io
 import json
 import sys
@@ -8,7 +9,7 @@ from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from cmdbroker import cli
+from cmdbroker import benchmark, cli
 
 
 @pytest.mark.asyncio
@@ -20,10 +21,16 @@ async def test_main_initializes_server_when_server_arg_provided(
 ):
     args = Namespace(
         server=True,
+        agent=False,
+        agent_socket=None,
+        no_agent=False,
         address="localhost",
         port=8889,
         command=None,
         broker_cert="test-cert.pem",
+        client_ca=None,
+        client_cert=None,
+        client_key=None,
         broker_key="test-key.pem",
         cert_country="US",
         cert_state="CA",
@@ -32,6 +39,32 @@ async def test_main_initializes_server_when_server_arg_provided(
         cert_days=15,
         generate_cert_and_key=False,
         password="test-password",
+        max_processes=32,
+        max_queued=256,
+        max_client_processes=0,
+        rate_limit_requests=0,
+        rate_limit_bytes=0,
+        max_frame_size=16 * 1024 * 1024,
+        warm_shells=0,
+        metrics_port=0,
+        log_requests=False,
+        workers=1,
+        event_loop="asyncio",
+        cache_ttl=0,
+        cache_size=64 * 1024 * 1024,
+        cache_env=["HOME", "LANG", "PATH"],
+        no_cache=False,
+        timings=False,
+        timeout=0,
+        drain_timeout=30,
+        exec=False,
+        cwd=None,
+        env=[],
+        batch=None,
+        sequential=False,
+        max_parallel=None,
+        stop_on_failure=False,
+        compression="none",
     )
 
     await cli.main(args)
@@ -49,10 +82,27 @@ async def test_main_initializes_server_when_server_arg_provided(
 async def test_main_initializes_client_when_server_arg_not_provided(mock_client, mock_server):
     args = Namespace(
         server=False,
+        agent=False,
+        agent_socket=None,
+        no_agent=False,
         address="localhost",
         port=8889,
         command="test_command",
         broker_cert="test-cert.pem",
+        client_ca=None,
+        client_cert=None,
+        client_key=None,
+        no_cache=False,
+        timings=False,
+        timeout=0,
+        exec=False,
+        cwd=None,
+        env=[],
+        batch=None,
+        sequential=False,
+        max_parallel=None,
+        stop_on_failure=False,
+        compression="none",
     )
 
     await cli.main(args)
@@ -101,10 +151,16 @@ async def test_run_server_mode_with_config(mock_main, mock_exists, mock_argv):
         Namespace(
             config="test-config.json",
             server=True,
+            agent=False,
+            agent_socket=cli.default_agent_socket(),
+            no_agent=False,
             address="127.0.0.1",
             port=8889,
             command=None,
             broker_cert="diff-cert.pem",
+            client_ca=None,
+            client_cert=None,
+            client_key=None,
             broker_key="broker-key.pem",
             cert_country="US",
             cert_state="AZ",
@@ -113,6 +169,32 @@ async def test_run_server_mode_with_config(mock_main, mock_exists, mock_argv):
             cert_days=30,
             generate_cert_and_key=True,
             password=None,
+            max_processes=32,
+            max_queued=256,
+            max_client_processes=0,
+            rate_limit_requests=0,
+            rate_limit_bytes=0,
+            max_frame_size=16 * 1024 * 1024,
+            warm_shells=0,
+            metrics_port=0,
+            log_requests=False,
+            workers=1,
+            event_loop="asyncio",
+            cache_ttl=0,
+            cache_size=64 * 1024 * 1024,
+            cache_env=["HOME", "LANG", "PATH"],
+            no_cache=False,
+            timings=False,
+            timeout=0,
+            drain_timeout=30,
+            exec=False,
+            cwd=None,
+            env=[],
+            batch=None,
+            sequential=False,
+            max_parallel=None,
+            stop_on_failure=False,
+            compression="none",
         )
     )
 
@@ -182,9 +264,15 @@ async def test_run_server_mode(mock_main, mock_argv, ssl_files):
             config="test-config.json",
             command=None,
             server=True,
+            agent=False,
+            agent_socket=cli.default_agent_socket(),
+            no_agent=False,
             address="127.0.0.1",
             port=8889,
             broker_cert=ssl_files[0],
+            client_ca=None,
+            client_cert=None,
+            client_key=None,
             broker_key=ssl_files[1],
             cert_country=None,
             cert_state=None,
@@ -193,6 +281,32 @@ async def test_run_server_mode(mock_main, mock_argv, ssl_files):
             cert_days=365,
             generate_cert_and_key=False,
             password=None,
+            max_processes=32,
+            max_queued=256,
+            max_client_processes=0,
+            rate_limit_requests=0,
+            rate_limit_bytes=0,
+            max_frame_size=16 * 1024 * 1024,
+            warm_shells=0,
+            metrics_port=0,
+            log_requests=False,
+            workers=1,
+            event_loop="asyncio",
+            cache_ttl=0,
+            cache_size=64 * 1024 * 1024,
+            cache_env=["HOME", "LANG", "PATH"],
+            no_cache=False,
+            timings=False,
+            timeout=0,
+            drain_timeout=30,
+            exec=False,
+            cwd=None,
+            env=[],
+            batch=None,
+            sequential=False,
+            max_parallel=None,
+            stop_on_failure=False,
+            compression="none",
         )
     )
 
@@ -221,9 +335,15 @@ async def test_run_client_mode_with_command(mock_main, mock_argv, ssl_files):
             config="test-config.json",
             command='"ls -la"',
             server=False,
+            agent=False,
+            agent_socket=cli.default_agent_socket(),
+            no_agent=False,
             address="127.0.0.1",
             port=8889,
             broker_cert=ssl_files[0],
+            client_ca=None,
+            client_cert=None,
+            client_key=None,
             broker_key="broker-key.pem",
             cert_country=None,
             cert_state=None,
@@ -232,6 +352,32 @@ async def test_run_client_mode_with_command(mock_main, mock_argv, ssl_files):
             cert_days=365,
             generate_cert_and_key=False,
             password=None,
+            max_processes=32,
+            max_queued=256,
+            max_client_processes=0,
+            rate_limit_requests=0,
+            rate_limit_bytes=0,
+            max_frame_size=16 * 1024 * 1024,
+            warm_shells=0,
+            metrics_port=0,
+            log_requests=False,
+            workers=1,
+            event_loop="asyncio",
+            cache_ttl=0,
+            cache_size=64 * 1024 * 1024,
+            cache_env=["HOME", "LANG", "PATH"],
+            no_cache=False,
+            timings=False,
+            timeout=0,
+            drain_timeout=30,
+            exec=False,
+            cwd=None,
+            env=[],
+            batch=None,
+            sequential=False,
+            max_parallel=None,
+            stop_on_failure=False,
+            compression="none",
         )
     )
 
@@ -271,3 +417,298 @@ async def test_run_client_mode_with_missing_cert_file(mock_main, mock_argv):
             await cli.run()
 
         assert buf.getvalue().endswith("Broker certificate file not found\n")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "options, error",
+    [
+        (["--cwd", "/tmp"], "--cwd and --env require --exec\n"),
+        (["--env", "A=B"], "--cwd and --env require --exec\n"),
+        (["--exec", "--env", "A"], "--env takes NAME=VALUE\n"),
+    ],
+)
+@patch("cmdbroker.cli.main")
+async def test_run_client_mode_with_invalid_exec_options(mock_main, mock_argv, options, error):
+    sys.argv = ["cmdbroker", "ls", "--config", "test-config.json", "--address", "::1", *options]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith(error)
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_server_mode_without_workers(mock_main, mock_argv):
+    sys.argv = ["cmdbroker", "--server", "--address", "::1", "--workers", "0"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith("--workers must be at least 1\n")
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_server_mode_without_processes(mock_main, mock_argv):
+    sys.argv = ["cmdbroker", "--server", "--address", "::1", "--max-processes", "0"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith("--max-processes must be at least 1\n")
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("option", ["--max-queued", "--cache-size", "--warm-shells"])
+@patch("cmdbroker.cli.main")
+async def test_run_with_negative_server_limit(mock_main, mock_argv, option):
+    sys.argv = ["cmdbroker", "--server", "--address", "::1", option, "-1"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith(
+            "--max-queued, --cache-size and --warm-shells must not be negative\n"
+        )
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_with_max_frame_size_below_a_chunk(mock_main, mock_argv):
+    sys.argv = ["cmdbroker", "--server", "--address", "::1", "--max-frame-size", "1024"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith("--max-frame-size must be at least 65536\n")
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_with_negative_timeout(mock_main, mock_argv):
+    sys.argv = ["cmdbroker", "--server", "--address", "::1", "--timeout", "-1"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith("--timeout must not be negative\n")
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_with_negative_drain_timeout(mock_main, mock_argv):
+    sys.argv = ["cmdbroker", "--server", "--address", "::1", "--drain-timeout", "-1"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith("--drain-timeout must not be negative\n")
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "option", ["--max-client-processes", "--rate-limit-requests", "--rate-limit-bytes"]
+)
+@patch("cmdbroker.cli.main")
+async def test_run_with_negative_rate_limit(mock_main, mock_argv, option):
+    sys.argv = ["cmdbroker", "--server", "--address", "::1", option, "-1"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith(
+            "--max-client-processes, --rate-limit-requests and --rate-limit-bytes"
+            " must not be negative\n"
+        )
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_with_client_key_without_client_cert(mock_main, mock_argv):
+    sys.argv = ["cmdbroker", "--address", "::1", "--client-key", "client-key.pem", "ls"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith("--client-key requires --client-cert\n")
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_agent_mode(mock_main, mock_argv, tmp_path):
+    # Neither an address nor a certificate, requests name their server
+    sys.argv = ["cmdbroker", "--config", "test-config.json", "--agent"]
+    sys.argv += ["--agent-socket", str(tmp_path / "agent.sock")]
+
+    await cli.run()
+
+    args = mock_main.call_args.args[0]
+    assert (args.agent, args.agent_socket, args.address) == (
+        True,
+        str(tmp_path / "agent.sock"),
+        None,
+    )
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_agent_mode_with_server(mock_main, mock_argv):
+    sys.argv = ["cmdbroker", "--config", "test-config.json", "--agent", "--server"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert buf.getvalue().endswith("--agent and --server are exclusive\n")
+    mock_main.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.agent.Agent.run", new_callable=AsyncMock)
+@patch("cmdbroker.client.Client.run", new_callable=AsyncMock)
+async def test_main_runs_the_agent(mock_client, mock_agent, tmp_path):
+    args = Namespace(server=False, agent=True, agent_socket=str(tmp_path / "agent.sock"))
+
+    await cli.main(args)
+
+    mock_agent.assert_awaited_once()
+    mock_client.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.cli.main")
+async def test_run_client_mode_with_batch(mock_main, mock_argv, ssl_files):
+    sys.argv = ["cmdbroker", "--address", "::1", "--broker-cert", ssl_files[0]]
+    sys.argv += ["--batch", "commands.txt", "--max-parallel", "4", "--stop-on-failure"]
+    sys.argv += ["--compression", "zlib"]
+
+    await cli.run()
+
+    args = mock_main.call_args.args[0]
+    assert args.command is None
+    assert (args.batch, args.sequential) == ("commands.txt", False)
+    assert (args.max_parallel, args.stop_on_failure) == (4, True)
+    assert args.compression == "zlib"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "options, error",
+    [
+        (["ls", "--batch", "commands.txt"], "--batch takes its commands from a file, not the"),
+        (["ls", "--sequential"], "--sequential, --max-parallel and --stop-on-failure require"),
+        (["ls", "--max-parallel", "2"], "--sequential, --max-parallel and --stop-on-failure"),
+        (["ls", "--stop-on-failure"], "--sequential, --max-parallel and --stop-on-failure"),
+        (["--batch", "commands.txt", "--timings"], "--timings does not apply to --batch"),
+    ],
+)
+@patch("cmdbroker.cli.main")
+async def test_run_client_mode_with_invalid_batch_options(mock_main, mock_argv, options, error):
+    sys.argv = ["cmdbroker", "--config", "test-config.json", "--address", "::1", *options]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert error in buf.getvalue()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "config, error",
+    [
+        ({"event-loop": "uvlop"}, "--event-loop must be one of asyncio, uvloop, auto\n"),
+        ({"compression": "zstandard"}, "--compression must be one of auto, none, "),
+    ],
+)
+@patch("cmdbroker.cli.main")
+async def test_run_with_unknown_choice_in_config(mock_main, mock_argv, tmp_path, config, error):
+    config_file = tmp_path / "cmdbroker.json"
+    config_file.write_text(json.dumps(config))
+    sys.argv = ["cmdbroker", "--config", str(config_file), "--address", "::1", "ls"]
+
+    with io.StringIO() as buf, redirect_stderr(buf):
+        with pytest.raises(SystemExit):
+            await cli.run()
+
+        assert error in buf.getvalue()
+    mock_main.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "options, config, event_loop",
+    [
+        ([], {}, "asyncio"),
+        (["--event-loop", "auto"], {}, "auto"),
+        ([], {"event-loop": "uvloop"}, "uvloop"),
+        (["--event-loop", "asyncio"], {"event-loop": "uvloop"}, "asyncio"),
+        ([], {"event-loop": "uvlop"}, "asyncio"),
+    ],
+)
+@patch("cmdbroker.cli.run", new_callable=AsyncMock)
+@patch("cmdbroker.eventloop.run")
+def test_async_run_picks_the_event_loop(
+    mock_eventloop_run, mock_run, mock_argv, tmp_path, options, config, event_loop
+):
+    config_file = tmp_path / "cmdbroker.json"
+    config_file.write_text(json.dumps(config))
+    sys.argv = ["cmdbroker", "ls", "--config", str(config_file), *options]
+
+    cli.async_run()
+
+    coroutine, chosen = mock_eventloop_run.call_args.args
+    assert chosen == event_loop
+    coroutine.close()
+
+
+# Seconds importing the client may take, well above what it needs without the server's imports
+CLIENT_IMPORT_BUDGET = 0.5
+
+
+@pytest.mark.asyncio
+async def test_client_mode_imports_only_the_client(tmp_path):
+    async with benchmark.local_server(str(tmp_path), 1) as (address, port, broker_cert):
+        # fmt: off
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-X", "importtime", "-m", "cmdbroker",
+            "--config", str(tmp_path / "missing.json"),
+            "--address", address, "--port", str(port), "--broker-cert", broker_cert, "echo hello",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        # fmt: on
+        stdout, stderr = await process.communicate()
+
+    assert process.returncode == 0
+    assert stdout == b"hello\n"
+    # Lines of "import time: self [us] | cumulative | imported package", after a header
+    timings = [
+        line.split("|") for line in stderr.decode().splitlines() if line.startswith("import time:")
+    ]
+    imports = {module.strip(): int(cumulative) / 1e6 for _, cumulative, module in timings[1:]}
+    assert "cmdbroker.client" in imports
+    assert not [
+        module
+        for module in imports
+        if module.split(".")[0] in ("cryptography", "uvloop", "zstandard")
+        or module == "cmdbroker.server"
+    ]
+    assert imports["cmdbroker.cli"] < CLIENT_IMPORT_BUDGET
@@ -1,9 +1,38 @@
-import sys
-from unittest.mock import AsyncMock, MagicMock, patch
+import asyncio
+import base64
+import io
+import json
+import ssl
+import zlib
+from contextlib import redirect_stderr
+from contextvars import copy_context
+from unittest.mock import ANY, AsyncMock, MagicMock, call, patch
 
 import pytest
 
-from cmdbroker.client import Client
+from cmdbroker.client import (
+    AgentConnection,
+    BatchResult,
+    BrokerError,
+    Client,
+    Connection,
+    ConnectionPool,
+    Result,
+    ResumableSSLContext,
+    Session,
+    ThrottledError,
+    agent_running,
+    client_ssl_context,
+    connecting_port,
+    default_agent_socket,
+    read_chunks,
+    split,
+)
+from cmdbroker.compression import CODECS, compress
+from cmdbroker.flow import STDIN_WINDOW
+from cmdbroker.message import CHUNK_SIZE, COMPRESSED, PROTOCOL_VERSION, Message, MessageType
+
+from .conftest import end, welcome
 
 
 def test_client_initialization(client_args):
@@ -14,55 +43,1055 @@ def test_client_initialization(client_args):
     assert client.port == 8080
 
 
+def server_reader(*messages, eof=False, hello=None):
+    reader = asyncio.StreamReader()
+    for message in (hello or welcome(), *messages):
+        reader.feed_data(message.output())
+    if eof:
+        reader.feed_eof()
+    return reader
+
+
+def server_writer():
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    writer.wait_closed = AsyncMock()
+    writer.is_closing.return_value = False
+    return writer
+
+
+def sent(writer):
+    return [b"".join(args[0]) for args, _ in writer.writelines.call_args_list]
+
+
+async def aiter_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.fixture
+def connected(client_ssl_context):
+    async def connect(*messages, eof=False, hello=None, compression=()):
+        reader, writer = server_reader(*messages, eof=eof, hello=hello), server_writer()
+
+        async def open_connection(*args, **kwargs):
+            # The TLS handshake looks up the session with this port
+            assert connecting_port.get() == 8080
+            return reader, writer
+
+        with patch(
+            "cmdbroker.client.client_ssl_context", return_value=client_ssl_context
+        ) as mock_client_ssl_context:
+            with patch(
+                "asyncio.open_connection", side_effect=open_connection
+            ) as mock_open_connection:
+                connection = Connection("127.0.0.1", 8080, "test-cert.pem", compression)
+                await connection.open()
+        assert connecting_port.get() is None
+
+        mock_open_connection.assert_awaited_once_with("127.0.0.1", 8080, ssl=client_ssl_context)
+        mock_client_ssl_context.assert_called_once_with("test-cert.pem", None, None)
+        return connection
+
+    return connect
+
+
+@pytest.mark.asyncio
+async def test_connection_request(connected):
+    connection = await connected(Message(MessageType.STDOUT, b"chunk", 1), end(1))
+
+    responses = [response async for response in connection.request({"method": "process"})]
+
+    assert [(response.type, response.text) for response in responses] == [
+        (MessageType.STDOUT, b"chunk"),
+        (MessageType.END, b"{}"),
+    ]
+    assert sent(connection.writer) == [
+        Message.hello().output(),
+        Message.build({"method": "process"}, 1).output(),
+    ]
+    assert connection.streams == {}
+    assert connection.version == PROTOCOL_VERSION
+
+    await connection.close()
+
+    connection.writer.close.assert_called_once()
+    connection.writer.wait_closed.assert_awaited_once()
+    ssl_object = connection.writer.get_extra_info.return_value
+    connection.writer.get_extra_info.assert_called_with("ssl_object")
+    assert connection.ssl_context.sessions == {("127.0.0.1", 8080): ssl_object.session}
+
+
+@pytest.mark.asyncio
+async def test_connection_with_compression(connected):
+    log = b"".join(b"line %d of a very repetitive log\n" % i for i in range(200))
+    codec = CODECS["zlib"]
+    connection = await connected(
+        compress(Message(MessageType.STDOUT, log, 1), codec),
+        end(1),
+        hello=welcome(version=PROTOCOL_VERSION, compression="zlib"),
+        compression=["bogus", "zlib"],
+    )
+
+    request = connection.request({"method": "process"}, aiter_chunks(log, b"short"))
+    responses = [response async for response in request]
+
+    assert connection.codec is codec
+    assert [(response.type, response.text) for response in responses] == [
+        (MessageType.STDOUT, log),
+        (MessageType.END, b"{}"),
+    ]
+    assert sent(connection.writer) == [
+        Message.hello(["bogus", "zlib"]).output(),
+        Message.build({"method": "process", "stdin": True}, 1).output(),
+        compress(Message(MessageType.STDIN, log, 1), codec).output(),
+        Message(MessageType.STDIN, b"short", 1).output(),
+        Message(MessageType.STDIN, b"", 1).output(),
+    ]
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_compressed_without_agreement(connected):
+    connection = await connected(
+        Message(MessageType.STDOUT, zlib.compress(b"output"), 1, COMPRESSED), eof=True
+    )
+
+    with pytest.raises(BrokerError, match="Lost the connection to the server"):
+        [_ async for _ in connection.request({"method": "process"})]
+
+    assert connection.codec is None
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_without_tls_session(connected):
+    connection = await connected()
+    connection.writer.get_extra_info.return_value = None
+
+    await connection.close()
+
+    assert connection.ssl_context.sessions == {}
+
+
+@pytest.mark.asyncio
+async def test_connection_closed_by_the_server(connected):
+    connection = await connected()
+    connection.writer.wait_closed.side_effect = BrokenPipeError
+
+    await connection.close()
+
+    connection.writer.close.assert_called_once()
+
+
+def test_client_ssl_context():
+    client_ssl_context.cache_clear()
+    with patch.object(ResumableSSLContext, "load_verify_locations") as mock_load_verify_locations:
+        ssl_context = client_ssl_context("test-cert.pem")
+
+        assert client_ssl_context("test-cert.pem") is ssl_context
+        mock_load_verify_locations.assert_called_once_with("test-cert.pem")
+    assert isinstance(ssl_context, ResumableSSLContext)
+    assert ssl_context.check_hostname
+    assert ssl_context.verify_mode == ssl.CERT_REQUIRED
+    assert ssl_context.sessions == {}
+    client_ssl_context.cache_clear()
+
+
+def test_client_ssl_context_with_client_cert():
+    client_ssl_context.cache_clear()
+    with patch.object(ResumableSSLContext, "load_verify_locations"):
+        with patch.object(ResumableSSLContext, "load_cert_chain") as mock_load_cert_chain:
+            ssl_context = client_ssl_context("test-cert.pem", "client.pem", "client-key.pem")
+
+            assert client_ssl_context("test-cert.pem") is not ssl_context
+    mock_load_cert_chain.assert_called_once_with("client.pem", "client-key.pem")
+    client_ssl_context.cache_clear()
+
+
+@patch("ssl.SSLContext.wrap_bio")
+def test_resumable_ssl_context_wrap_bio(mock_wrap_bio):
+    ssl_context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.sessions["127.0.0.1", 8080] = session = MagicMock()
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+
+    def wrap_bio(port, *args, **kwargs):
+        connecting_port.set(port)
+        ssl_context.wrap_bio(incoming, outgoing, *args, **kwargs)
+
+    copy_context().run(wrap_bio, 8080, server_hostname="127.0.0.1")
+    copy_context().run(wrap_bio, 8081, server_hostname="127.0.0.1")
+    copy_context().run(wrap_bio, 8080, server_hostname="localhost")
+    copy_context().run(wrap_bio, 8080, False, "127.0.0.1", other := MagicMock())
+
+    assert mock_wrap_bio.call_args_list == [
+        call(incoming, outgoing, False, "127.0.0.1", session),
+        call(incoming, outgoing, False, "127.0.0.1", None),
+        call(incoming, outgoing, False, "localhost", None),
+        call(incoming, outgoing, False, "127.0.0.1", other),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_connection_context_manager(client_ssl_context):
+    reader, writer = server_reader(), server_writer()
+    with patch("cmdbroker.client.client_ssl_context", return_value=client_ssl_context):
+        with patch("asyncio.open_connection", new_callable=AsyncMock) as mock_open_connection:
+            mock_open_connection.return_value = (reader, writer)
+            async with Connection("127.0.0.1", 8080, "test-cert.pem") as connection:
+                assert not connection.receive_task.done()
+
+    await asyncio.sleep(0)
+    assert connection.receive_task.cancelled()
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_connection_request_abandoned(connected):
+    connection = await connected(
+        Message(MessageType.STDOUT, b"first", 1), Message(MessageType.STDOUT, b"second", 1)
+    )
+    request = connection.request({"method": "process"})
+
+    assert (await request.__anext__()).text == b"first"
+    await asyncio.sleep(0)
+    await request.aclose()
+
+    assert connection.streams == {}
+    # The server is told to stop the command
+    assert sent(connection.writer)[-1] == Message(MessageType.CANCEL, b"", 1).output()
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_concurrent_requests(connected):
+    connection = await connected()
+
+    async def collect(request):
+        return [(response.type, response.text) async for response in request]
+
+    requests = asyncio.gather(
+        collect(connection.request({"method": "process"})),
+        collect(connection.request({"method": "process"})),
+    )
+    await asyncio.sleep(0)
+    for message in (
+        Message(MessageType.STDOUT, b"second", 2),
+        Message(MessageType.STDOUT, b"first", 1),
+        end(2, returncode=2),
+        Message(MessageType.STDERR, b"first", 1),
+        end(1, returncode=1),
+    ):
+        connection.reader.feed_data(message.output())
+    first, second = await requests
+
+    assert first == [
+        (MessageType.STDOUT, b"first"),
+        (MessageType.STDERR, b"first"),
+        (MessageType.END, b'{"returncode": 1}'),
+    ]
+    assert second == [(MessageType.STDOUT, b"second"), (MessageType.END, b'{"returncode": 2}')]
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_request_with_stdin(connected):
+    connection = await connected()
+    request = connection.request({"method": "process"}, aiter_chunks(b"\x00binary", b"more"))
+
+    response = asyncio.create_task(request.__anext__())
+    await asyncio.sleep(0)
+    connection.reader.feed_data(Message(MessageType.STDOUT, b"out", 1).output())
+    connection.reader.feed_data(end(1).output())
+
+    assert (await response).text == b"out"
+    assert [response.type async for response in request] == [MessageType.END]
+    assert sent(connection.writer) == [
+        Message.hello().output(),
+        Message.build({"method": "process", "stdin": True}, 1).output(),
+        Message(MessageType.STDIN, b"\x00binary", 1).output(),
+        Message(MessageType.STDIN, b"more", 1).output(),
+        Message(MessageType.STDIN, b"", 1).output(),
+    ]
+    await connection.close()
+
+
+def window(stream_id, size):
+    return Message.build({"size": size}, stream_id, MessageType.WINDOW)
+
+
+@pytest.mark.asyncio
+async def test_connection_request_with_stdin_waits_for_the_window(connected):
+    connection = await connected(window(7, 1))
+    request = connection.request({"method": "process"}, aiter_chunks(bytes(STDIN_WINDOW + 10)))
+
+    response = asyncio.create_task(request.__anext__())
+    await asyncio.sleep(0.01)
+    assert (
+        sent(connection.writer)[-1] == Message(MessageType.STDIN, bytes(STDIN_WINDOW), 1).output()
+    )
+    connection.reader.feed_data(window(1, 10).output())
+    await asyncio.sleep(0.01)
+    connection.reader.feed_data(end(1).output())
+
+    assert (await response).type == MessageType.END
+    assert sent(connection.writer)[-2:] == [
+        Message(MessageType.STDIN, bytes(10), 1).output(),
+        Message(MessageType.STDIN, b"", 1).output(),
+    ]
+    assert [response async for response in request] == []
+    assert connection.windows == {}
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_request_error(connected):
+    connection = await connected(end(1, error="Invalid method: bogus"))
+
+    with pytest.raises(BrokerError, match="Invalid method: bogus"):
+        [response async for response in connection.request({"method": "bogus"})]
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_request_throttled(connected):
+    throttled = {"limit": "requests", "retry_after": 0.25}
+    connection = await connected(end(1, error="Too many requests", throttled=throttled))
+
+    with pytest.raises(ThrottledError, match="Too many requests") as exc_info:
+        [response async for response in connection.request({"method": "process"})]
+
+    assert exc_info.value.details == throttled
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_ignores_unknown_streams(connected):
+    connection = await connected(Message(MessageType.STDOUT, b"stale", 7), end(1))
+
+    assert [response.type async for response in connection.request({"method": "process"})] == [
+        MessageType.END
+    ]
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_goaway(connected):
+    connection = await connected(
+        Message(MessageType.STDOUT, b"chunk", 1), Message(MessageType.GOAWAY), end(1)
+    )
+
+    responses = [response.type async for response in connection.request({"method": "process"})]
+
+    # The request in flight still finishes, the connection is closed after it
+    assert responses == [MessageType.STDOUT, MessageType.END]
+    assert connection.draining
+    connection.writer.close.assert_called_once()
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_goaway_while_idle(connected):
+    connection = await connected(Message(MessageType.GOAWAY))
+    await asyncio.sleep(0)
+
+    connection.writer.close.assert_called_once()
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_close_once_hung_up(connected):
+    connection = await connected(eof=True)
+    await asyncio.sleep(0)
+    connection.ssl_context.sessions.clear()
+    connection.writer.is_closing.return_value = True
+
+    await connection.close()
+
+    # The TLS state is gone along with the transport
+    assert connection.ssl_context.sessions == {}
+
+
+@pytest.mark.asyncio
+async def test_connection_lost(connected):
+    connection = await connected(Message(MessageType.STDOUT, b"partial", 1), eof=True)
+
+    with pytest.raises(BrokerError, match="Lost the connection"):
+        [response async for response in connection.request({"method": "process"})]
+    with pytest.raises(BrokerError, match="Lost the connection"):
+        [response async for response in connection.request({"method": "process"})]
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_rejected_by_server(connected):
+    connection = await connected(hello=welcome(error="Unsupported protocol version"), eof=True)
+    await asyncio.sleep(0)
+
+    with pytest.raises(BrokerError, match="Unsupported protocol version"):
+        [response async for response in connection.request({"method": "process"})]
+    assert connection.version is None
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_disconnected_mid_request(connected):
+    connection = await connected()
+    request = asyncio.create_task(connection.request({"method": "process"}).__anext__())
+    await asyncio.sleep(0)
+    connection.reader.feed_data(welcome(error="Unknown message type 99").output())
+
+    with pytest.raises(BrokerError, match="Unknown message type 99"):
+        await request
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_garbled_response(connected):
+    connection = await connected()
+    request = asyncio.create_task(connection.request({"method": "process"}).__anext__())
+    await asyncio.sleep(0)
+    connection.reader.feed_data(b"\xff" * Message.HEADER.size)
+
+    with pytest.raises(BrokerError, match="Lost the connection"):
+        await request
+    await connection.close()
+
+
+def pooled_connection():
+    connection = MagicMock()
+    connection.open = AsyncMock()
+    connection.close = AsyncMock()
+    connection.receive_task.done.return_value = False
+    connection.draining = False
+    return connection
+
+
+@pytest.mark.asyncio
+async def test_connection_pool_spreads_requests():
+    connections = [pooled_connection(), pooled_connection()]
+    pool = ConnectionPool(
+        "127.0.0.1", 8080, "test-cert.pem", size=2, compression=["zlib"], client_cert="client.pem"
+    )
+
+    with patch("cmdbroker.client.Connection", side_effect=connections) as mock_connection:
+        async with pool.borrow() as first:
+            async with pool.borrow() as second:
+                async with pool.borrow() as third:
+                    assert pool.connections == {connections[0]: 2, connections[1]: 1}
+        async with pool.borrow() as fourth:
+            pass
+
+    assert (first, second, third, fourth) == (*connections, connections[0], connections[0])
+    assert mock_connection.call_count == 2
+    mock_connection.assert_called_with(
+        "127.0.0.1", 8080, "test-cert.pem", ["zlib"], "client.pem", None
+    )
+    assert pool.connections == {connections[0]: 0, connections[1]: 0}
+
+    await pool.close()
+
+    for connection in connections:
+        connection.close.assert_awaited_once()
+    assert pool.connections == {}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("draining", [False, True])
+async def test_connection_pool_replaces_lost_connections(draining):
+    connections = [pooled_connection(), pooled_connection()]
+    pool = ConnectionPool("127.0.0.1", 8080, "test-cert.pem", size=1)
+
+    with patch("cmdbroker.client.Connection", side_effect=connections):
+        async with pool.borrow() as first:
+            # Closed by the server, or about to be
+            first.draining = draining
+            first.receive_task.done.return_value = not draining
+            async with pool.borrow() as second:
+                pass
+
+    assert (first, second) == tuple(connections)
+    assert pool.connections == {connections[1]: 0}
+
+
+def requested(*responses):
+    async def request(payload, stdin=None):
+        if stdin is not None:
+            payload["stdin"] = [chunk async for chunk in stdin]
+        for response in responses:
+            yield response
+
+    return MagicMock(side_effect=request)
+
+
+@pytest.mark.asyncio
+async def test_session_run():
+    connection = pooled_connection()
+    connection.request = requested(
+        Message(MessageType.STDOUT, b"out", 1),
+        Message(MessageType.STDERR, b"err", 1),
+        Message(MessageType.STDOUT, b"put", 1),
+        end(1, returncode=3, wait_time=0.5, rusage={"user_time": 0.25, "max_rss": 1024}),
+    )
+
+    with patch("cmdbroker.client.Connection", return_value=connection) as mock_connection:
+        async with Session(
+            "test-cert.pem", compression=["lz4", "zlib"], client_cert="c.pem", client_key="k.pem"
+        ) as session:
+            result = await session.run("127.0.0.1", 8080, "test_command", b"input")
+
+    mock_connection.assert_called_once_with(
+        "127.0.0.1", 8080, "test-cert.pem", ["lz4", "zlib"], "c.pem", "k.pem"
+    )
+    connection.request.assert_called_once_with(
+        {"method": "process", "parameters": {"command": "test_command"}, "stdin": [b"input"]},
+        ANY,
+    )
+    assert result == Result(
+        b"output", b"err", 3, result.timings, {"user_time": 0.25, "max_rss": 1024}
+    )
+    assert list(result.timings) == ["connect", "first_response", "queued", "total"]
+    assert result.timings["queued"] == 0.5
+    connection.close.assert_awaited_once()
+    assert session.pools == {}
+
+
+@pytest.mark.asyncio
+async def test_session_reuses_pools():
+    connection = pooled_connection()
+    connection.request = requested(end(1, returncode=0, wait_time=0.0, rusage={}))
+
+    with patch("cmdbroker.client.Connection", return_value=connection) as mock_connection:
+        session = Session("test-cert.pem", pool_size=1)
+        first, second = await asyncio.gather(
+            session.run("127.0.0.1", 8080, "first"), session.run("127.0.0.1", 8080, "second")
+        )
+
+    assert first.returncode == second.returncode == 0
+    assert not first.cached
+    mock_connection.assert_called_once()
+    assert list(session.pools) == [("127.0.0.1", 8080)]
+    assert session.pools[("127.0.0.1", 8080)].size == 1
+    await session.close()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.client.CHUNK_SIZE", 4)
+async def test_split():
+    assert [chunk async for chunk in split(b"0123456789")] == [b"0123", b"4567", b"89"]
+    assert [chunk async for chunk in split(b"")] == []
+
+
+@pytest.mark.asyncio
+async def test_read_chunks():
+    stdin = MagicMock()
+    stdin.read1.side_effect = [b"\x00binary", b"more", b""]
+
+    assert [chunk async for chunk in read_chunks(stdin)] == [b"\x00binary", b"more"]
+    stdin.read1.assert_called_with(CHUNK_SIZE)
+
+
+def connection_responses(*responses):
+    connection = MagicMock()
+    connection.open = AsyncMock()
+    connection.close = AsyncMock()
+
+    async def request(payload, stdin=None):
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+            yield response
+
+    connection.request = MagicMock(side_effect=request)
+    return connection
+
+
 @pytest.mark.asyncio
-@patch("cmdbroker.message.Message.build")
 @patch("select.select", return_value=[False])
-@patch("cmdbroker.client.Client.relay_to_server", new_callable=AsyncMock)
-async def test_run_without_stdin(mock_relay_to_server, mock_select, mock_build, client):
-    mock_relay_to_server.return_value = MagicMock()
+async def test_run_without_stdin(mock_select, client):
+    connection = connection_responses(Message(MessageType.STDOUT, b"out"), end(0, returncode=0))
 
-    await client.run()
+    with patch("cmdbroker.client.Connection", return_value=connection) as mock_connection:
+        with patch("sys.stdout") as mock_stdout:
+            await client.run()
 
     mock_select.assert_called_once()
-    mock_build.assert_called_once()
-    assert "stdin" not in mock_build.call_args[0][0]
-    mock_relay_to_server.assert_awaited_once()
-    mock_relay_to_server.return_value.write.assert_called_once_with(sys.stdout.buffer)
+    mock_connection.assert_called_once_with("127.0.0.1", 8080, "test-cert.pem", [], None, None)
+    connection.request.assert_called_once_with(
+        {"method": "process", "parameters": {"command": "test_command"}}, None
+    )
+    mock_stdout.buffer.write.assert_called_once_with(b"out")
+    mock_stdout.buffer.flush.assert_called_once()
 
 
 @pytest.mark.asyncio
-@patch("cmdbroker.message.Message.build")
-@patch("asyncio.to_thread", new_callable=AsyncMock, return_value="test_stdin")
 @patch("select.select", return_value=[True])
-@patch("cmdbroker.client.Client.relay_to_server", new_callable=AsyncMock)
-async def test_run_with_stdin(mock_relay_to_server, mock_select, mock_asyncio, mock_build, client):
-    mock_relay_to_server.return_value = MagicMock()
+async def test_run_with_stdin(mock_select, client):
+    connection = connection_responses(
+        Message(MessageType.STDOUT, b"out"),
+        Message(MessageType.STDERR, b"err"),
+        end(0, returncode=0),
+    )
 
-    await client.run()
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with patch("cmdbroker.client.read_chunks") as mock_read_chunks:
+            with patch("sys.stdin") as mock_stdin:
+                with patch("sys.stdout") as mock_stdout, patch("sys.stderr") as mock_stderr:
+                    await client.run()
 
     mock_select.assert_called_once()
-    mock_asyncio.assert_awaited_once()
-    mock_build.assert_called_once()
-    assert "stdin" in mock_build.call_args[0][0]
-    mock_relay_to_server.assert_awaited_once()
-    mock_relay_to_server.return_value.write.assert_called_once_with(sys.stdout.buffer)
-
-
-@pytest.mark.asyncio
-@patch("asyncio.open_connection", new_callable=AsyncMock)
-@patch("ssl.create_default_context")
-async def test_relay_to_server(
-    mock_ssl_create_default_context, mock_open_connection, client_ssl_context, client
-):
-    mock_reader = AsyncMock()
-    mock_reader.read = AsyncMock(side_effect=[b"0019", b'{"fake":"response"}'])
-    mock_writer = MagicMock()
-    mock_writer.wait_closed = AsyncMock()
-    mock_open_connection.return_value = (mock_reader, mock_writer)
-    mock_ssl_create_default_context.return_value = client_ssl_context
-
-    await client.relay_to_server(AsyncMock())
-
-    mock_open_connection.assert_awaited_with("127.0.0.1", 8080, ssl=client_ssl_context)
-    mock_writer.close.assert_called_once()
-    mock_writer.wait_closed.assert_awaited_once()
+    mock_read_chunks.assert_called_once_with(mock_stdin.buffer)
+    connection.request.assert_called_once_with(
+        {"method": "process", "parameters": {"command": "test_command"}},
+        mock_read_chunks.return_value,
+    )
+    mock_stdout.buffer.write.assert_called_once_with(b"out")
+    mock_stderr.buffer.write.assert_called_once_with(b"err")
+
+
+@pytest.mark.asyncio
+@patch("select.select", return_value=[False])
+async def test_run_error(mock_select, client):
+    connection = connection_responses(BrokerError("Invalid method: bogus"))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with io.StringIO() as buf, redirect_stderr(buf):
+            with pytest.raises(SystemExit) as exit_info:
+                await client.run()
+
+            assert buf.getvalue() == "Error: Invalid method: bogus\n"
+    assert exit_info.value.code == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("returncode, exit_code", [(3, 3), (-9, 137)])
+@patch("select.select", return_value=[False])
+async def test_run_exits_with_the_remote_status(mock_select, client, returncode, exit_code):
+    connection = connection_responses(end(0, returncode=returncode))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with pytest.raises(SystemExit) as exit_info:
+            await client.run()
+
+    assert exit_info.value.code == exit_code
+
+
+@pytest.mark.asyncio
+async def test_agent_connection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    reader, writer = server_reader(end(1, returncode=0)), server_writer()
+
+    with patch("asyncio.open_unix_connection", new_callable=AsyncMock) as mock_open_connection:
+        mock_open_connection.return_value = (reader, writer)
+        async with AgentConnection(
+            "agent.sock", "::1", 8080, "test-cert.pem", ["zlib"], "client.pem", "client-key.pem"
+        ) as agent:
+            responses = [r async for r in agent.request({"method": "process"}, aiter_chunks(b"in"))]
+
+    mock_open_connection.assert_awaited_once_with("agent.sock")
+    assert [response.json() for response in responses] == [{"returncode": 0}]
+    server = {
+        "address": "::1",
+        "port": 8080,
+        "broker_cert": str(tmp_path / "test-cert.pem"),
+        "compression": ["zlib"],
+        "client_cert": str(tmp_path / "client.pem"),
+        "client_key": str(tmp_path / "client-key.pem"),
+    }
+    assert sent(writer) == [
+        Message.hello().output(),
+        Message.build({"method": "process", "server": server, "stdin": True}, 1).output(),
+        Message(MessageType.STDIN, b"in", 1).output(),
+        Message(MessageType.STDIN, b"", 1).output(),
+    ]
+    writer.get_extra_info.assert_not_called()
+
+
+@pytest.fixture
+def agent_socket(tmp_path):
+    # Any file owned by the user will do, the client only looks for it
+    path = tmp_path / "agent.sock"
+    path.touch()
+    return str(path)
+
+
+@pytest.mark.asyncio
+@patch("select.select", return_value=[False])
+async def test_run_through_the_agent(mock_select, client_args, agent_socket):
+    client_args.agent_socket = agent_socket
+    client_args.client_cert, client_args.client_key = "client.pem", "client-key.pem"
+    agent = connection_responses(end(0, returncode=0))
+
+    with patch("cmdbroker.client.AgentConnection", return_value=agent) as mock_agent:
+        with patch("cmdbroker.client.Connection") as mock_connection:
+            await Client(client_args).run()
+
+    mock_agent.assert_called_once_with(
+        agent_socket, "127.0.0.1", 8080, "test-cert.pem", [], "client.pem", "client-key.pem"
+    )
+    agent.open.assert_awaited_once()
+    agent.close.assert_awaited_once()
+    mock_connection.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("no_agent", [False, True])
+@patch("select.select", return_value=[False])
+async def test_run_without_the_agent(mock_select, client_args, agent_socket, no_agent):
+    client_args.agent_socket = agent_socket
+    client_args.no_agent = no_agent
+    agent = connection_responses()
+    # The agent exited without removing its socket
+    agent.open.side_effect = ConnectionRefusedError
+    connection = connection_responses(end(0, returncode=0))
+
+    with patch("cmdbroker.client.AgentConnection", return_value=agent):
+        with patch("cmdbroker.client.Connection", return_value=connection):
+            await Client(client_args).run()
+
+    assert agent.open.await_count == (0 if no_agent else 1)
+    connection.open.assert_awaited_once()
+    connection.close.assert_awaited_once()
+
+
+def test_agent_running(agent_socket, tmp_path):
+    assert agent_running(agent_socket)
+    assert not agent_running(str(tmp_path / "missing.sock"))
+    with patch("os.getuid", return_value=12345):
+        assert not agent_running(agent_socket)
+
+
+@pytest.mark.parametrize("runtime_dir", ["/run/user/1000", None])
+def test_default_agent_socket(monkeypatch, runtime_dir):
+    if runtime_dir:
+        monkeypatch.setenv("XDG_RUNTIME_DIR", runtime_dir)
+    else:
+        monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr("tempfile.tempdir", "/tmp")
+
+    with patch("os.getuid", return_value=1000):
+        assert default_agent_socket() == f"{runtime_dir or '/tmp'}/cmdbroker-agent-1000.sock"
+
+
+@pytest.mark.asyncio
+async def test_session_run_without_cache():
+    connection = pooled_connection()
+    connection.request = requested(end(1, returncode=0, wait_time=0.0, rusage={}, cached=True))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        async with Session("test-cert.pem") as session:
+            result = await session.run("127.0.0.1", 8080, "test_command", cache=False)
+
+    connection.request.assert_called_once_with(
+        {"method": "process", "parameters": {"command": "test_command"}, "cache": False}, None
+    )
+    assert result.cached
+
+
+@pytest.mark.asyncio
+@patch("select.select", return_value=[False])
+async def test_run_without_cache(mock_select, client_args):
+    client_args.no_cache = True
+    connection = connection_responses(end(0, returncode=0))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        await Client(client_args).run()
+
+    connection.request.assert_called_once_with(
+        {"method": "process", "parameters": {"command": "test_command"}, "cache": False}, None
+    )
+
+
+@pytest.mark.asyncio
+async def test_session_run_with_timeout():
+    connection = pooled_connection()
+    connection.request = requested(end(1, returncode=0, wait_time=0.0, rusage={}))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        async with Session("test-cert.pem") as session:
+            await session.exec("127.0.0.1", 8080, ["sleep", "1"], timeout=2.5)
+
+    connection.request.assert_called_once_with(
+        {"method": "exec", "parameters": {"argv": ["sleep", "1"]}, "timeout": 2.5}, None
+    )
+
+
+@pytest.mark.asyncio
+@patch("select.select", return_value=[False])
+async def test_run_with_timeout(mock_select, client_args):
+    client_args.timeout = 2.5
+    connection = connection_responses(end(0, returncode=0))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        await Client(client_args).run()
+
+    connection.request.assert_called_once_with(
+        {"method": "process", "parameters": {"command": "test_command"}, "timeout": 2.5}, None
+    )
+
+
+@pytest.mark.asyncio
+@patch("select.select", return_value=[False])
+async def test_run_with_timings(mock_select, client_args):
+    client_args.timings = True
+    timings = {"read": 0.001, "queue": 0.0, "spawn": 0.002, "run": 0.01, "total": 0.015}
+    connection = connection_responses(end(0, returncode=0, request_id="abc", timings=timings))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with patch("time.perf_counter", side_effect=[1.0, 1.25, 1.5]):
+            with io.StringIO() as buf, redirect_stderr(buf):
+                await Client(client_args).run()
+
+                printed = json.loads(buf.getvalue())
+
+    connection.request.assert_called_once_with(
+        {"method": "process", "parameters": {"command": "test_command"}, "timings": True}, None
+    )
+    assert printed == {
+        "request_id": "abc",
+        "server": timings,
+        "client": {"connect": 0.25, "total": 0.5},
+    }
+
+
+@pytest.mark.asyncio
+async def test_session_exec():
+    connection = pooled_connection()
+    connection.request = requested(end(1, returncode=0, wait_time=0.0, rusage={}))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        async with Session("test-cert.pem") as session:
+            await session.exec("127.0.0.1", 8080, ("ls", "-l"), cwd="/tmp", env={"A": "B"})
+            await session.exec("127.0.0.1", 8080, ["true"])
+
+    assert connection.request.call_args_list == [
+        call(
+            {
+                "method": "exec",
+                "parameters": {"argv": ["ls", "-l"], "cwd": "/tmp", "env": {"A": "B"}},
+            },
+            None,
+        ),
+        call({"method": "exec", "parameters": {"argv": ["true"]}}, None),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "cwd, env, parameters",
+    [
+        (None, [], {}),
+        ("/tmp", ["A=B", "C=d=e"], {"cwd": "/tmp", "env": {"A": "B", "C": "d=e"}}),
+    ],
+)
+@patch("select.select", return_value=[False])
+async def test_run_exec(mock_select, client_args, cwd, env, parameters):
+    client_args.command = "grep -r 'two words' ."
+    client_args.exec = True
+    client_args.cwd = cwd
+    client_args.env = env
+    connection = connection_responses(end(0, returncode=0))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        await Client(client_args).run()
+
+    connection.request.assert_called_once_with(
+        {
+            "method": "exec",
+            "parameters": {"argv": ["grep", "-r", "two words", "."], **parameters},
+        },
+        None,
+    )
+
+
+def result(index, stdout=b"", stderr=b"", **fields):
+    return Message.build(
+        {
+            "index": index,
+            **({"stdout": base64.b64encode(stdout).decode()} if stdout else {}),
+            **({"stderr": base64.b64encode(stderr).decode()} if stderr else {}),
+            **fields,
+        },
+        1,
+        MessageType.RESULT,
+    )
+
+
+@pytest.mark.asyncio
+async def test_session_batch():
+    connection = pooled_connection()
+    connection.request = requested(
+        result(1, b"out", b"err", returncode=2, wait_time=0.5, rusage={"user_time": 0.25}),
+        result(0, error="No such file or directory"),
+        result(2, skipped=True),
+        result(3, b"\x00" * 4, returncode=0, truncated=True),
+        end(1, returncode=1, succeeded=1, failed=2, skipped=1),
+    )
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        async with Session("test-cert.pem") as session:
+            results = [
+                result
+                async for result in session.batch(
+                    "127.0.0.1",
+                    8080,
+                    [{"argv": ["missing"]}, "false", "true", "head -c 4 /dev/zero"],
+                    parallel=False,
+                    max_parallel=2,
+                    stop_on_failure=True,
+                    timeout=30,
+                )
+            ]
+
+    connection.request.assert_called_once_with(
+        {
+            "method": "batch",
+            "parameters": {
+                "commands": [
+                    {"argv": ["missing"]},
+                    {"command": "false"},
+                    {"command": "true"},
+                    {"command": "head -c 4 /dev/zero"},
+                ],
+                "parallel": False,
+                "stop_on_failure": True,
+                "max_parallel": 2,
+            },
+            "timeout": 30,
+        }
+    )
+    assert results == [
+        BatchResult(1, b"out", b"err", 2, 0.5, {"user_time": 0.25}),
+        BatchResult(0, error="No such file or directory"),
+        BatchResult(2, skipped=True),
+        BatchResult(3, b"\x00" * 4, returncode=0, truncated=True),
+    ]
+
+
+@pytest.fixture
+def batch_file(tmp_path):
+    path = tmp_path / "commands.txt"
+    path.write_text("ls /missing\n\n# Comments are left out\n  echo 'two words'  \n")
+    return str(path)
+
+
+def captured():
+    """A text stream that also takes bytes and keeps everything written to it in order."""
+    return io.TextIOWrapper(io.BytesIO(), write_through=True)
+
+
+@pytest.mark.asyncio
+async def test_run_batch(client_args, batch_file):
+    client_args.command = None
+    client_args.batch = batch_file
+    client_args.exec = True
+    client_args.cwd = "/tmp"
+    client_args.timeout = 60
+    connection = pooled_connection()
+    connection.request = requested(
+        result(1, b"two words\n", returncode=0),
+        result(0, stderr=b"ls: /missing: No such file\n", returncode=2),
+        end(1, returncode=1),
+    )
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with patch("sys.stdout", captured()) as stdout, patch("sys.stderr", captured()) as stderr:
+            with pytest.raises(SystemExit) as exit_info:
+                await Client(client_args).run()
+
+    assert exit_info.value.code == 1
+    connection.request.assert_called_once_with(
+        {
+            "method": "batch",
+            "parameters": {
+                "commands": [
+                    {"argv": ["ls", "/missing"], "cwd": "/tmp"},
+                    {"argv": ["echo", "two words"], "cwd": "/tmp"},
+                ],
+                "parallel": True,
+                "stop_on_failure": False,
+            },
+            "timeout": 60,
+        }
+    )
+    assert stdout.buffer.getvalue() == b"two words\n"
+    assert stderr.buffer.getvalue() == (
+        b"ls: /missing: No such file\n" b"Command 1 (ls /missing) exited with status 2\n"
+    )
+
+
+@pytest.mark.asyncio
+async def test_run_batch_from_stdin(client_args):
+    client_args.command = None
+    client_args.batch = "-"
+    client_args.sequential = True
+    client_args.max_parallel = 4
+    client_args.stop_on_failure = True
+    connection = pooled_connection()
+    connection.request = requested(
+        result(0, b"x" * 8, returncode=0, truncated=True),
+        result(1, error="Server is busy"),
+        result(2, skipped=True),
+        end(1, returncode=1),
+    )
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with patch("sys.stdin", io.StringIO("yes | head -c 8\nsleep 1\ntrue\n")):
+            with patch("sys.stdout", captured()) as stdout:
+                with patch("sys.stderr", captured()) as stderr:
+                    with pytest.raises(SystemExit):
+                        await Client(client_args).run()
+
+    parameters = connection.request.call_args.args[0]["parameters"]
+    assert parameters["commands"] == [
+        {"command": "yes | head -c 8"},
+        {"command": "sleep 1"},
+        {"command": "true"},
+    ]
+    assert (parameters["parallel"], parameters["max_parallel"]) == (False, 4)
+    assert parameters["stop_on_failure"]
+    assert stdout.buffer.getvalue() == b"x" * 8
+    assert stderr.buffer.getvalue() == (
+        b"Command 1 (yes | head -c 8) output was truncated\n"
+        b"Command 2 (sleep 1) failed: Server is busy\n"
+        b"Command 3 (true) was skipped\n"
+    )
+
+
+@pytest.mark.asyncio
+async def test_run_batch_succeeds(client_args, batch_file):
+    client_args.batch = batch_file
+    connection = pooled_connection()
+    connection.request = requested(
+        result(0, returncode=0), result(1, returncode=0), end(1, returncode=0)
+    )
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with patch("sys.stdout", captured()), patch("sys.stderr", captured()) as stderr:
+            await Client(client_args).run()
+
+    assert stderr.buffer.getvalue() == b""
+
+
+@pytest.mark.asyncio
+async def test_run_batch_error(client_args, batch_file):
+    client_args.batch = batch_file
+    connection = pooled_connection()
+    connection.request = MagicMock(side_effect=BrokerError("Lost the connection to the server"))
+
+    with patch("cmdbroker.client.Connection", return_value=connection):
+        with io.StringIO() as buf, redirect_stderr(buf):
+            with pytest.raises(SystemExit) as exit_info:
+                await Client(client_args).run()
+
+            assert buf.getvalue() == "Error: Lost the connection to the server\n"
+    assert exit_info.value.code == 1
+
+
+@pytest.mark.parametrize(
+    "compression, offered", [("none", []), ("auto", list(CODECS)), ("zlib", ["zlib"])]
+)
+def test_client_compression(client_args, compression, offered):
+    client_args.compression = compression
+
+    assert Client(client_args).compression == offered
@@ -0,0 +1,107 @@
+import os
+import zlib
+
+import pytest
+
+from cmdbroker.compression import CODECS, COMPRESSION_THRESHOLD, Zlib, choose, compress, decompress
+from cmdbroker.message import COMPRESSED, Message, MessageType, ProtocolError
+
+LOG = b"".join(b"2024-06-01 12:00:%02d INFO request served in 3ms\n" % i for i in range(60))
+
+
+@pytest.fixture(params=list(CODECS))
+def codec(request):
+    return CODECS[request.param]
+
+
+def test_codecs_in_order_of_preference():
+    assert list(CODECS)[-1] == "zlib"
+    assert [name for name in ("zstd", "lz4", "zlib") if name in CODECS] == list(CODECS)
+
+
+def test_choose():
+    assert choose(["bogus", "zlib"]) is CODECS["zlib"]
+    assert choose(["bogus"]) is None
+    assert choose([]) is None
+
+
+def test_compress_round_trip(codec):
+    message = Message(MessageType.STDOUT, LOG, 3)
+
+    compressed = compress(message, codec)
+
+    assert compressed.flags == COMPRESSED
+    assert (compressed.type, compressed.stream_id) == (MessageType.STDOUT, 3)
+    assert len(compressed.text) < len(LOG) / 4
+    restored = decompress(compressed, codec, len(LOG))
+    assert (restored.type, restored.text, restored.stream_id) == (MessageType.STDOUT, LOG, 3)
+    assert restored.flags == 0
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        # Too short to bother
+        b"x" * (COMPRESSION_THRESHOLD - 1),
+        # Random data would only grow
+        os.urandom(COMPRESSION_THRESHOLD * 4),
+    ],
+)
+def test_compress_leaves_message_as_is(codec, text):
+    message = Message(MessageType.STDIN, text, 1)
+
+    assert compress(message, codec) is message
+
+
+def test_compress_without_codec():
+    message = Message(MessageType.STDOUT, LOG, 1)
+
+    assert compress(message, None) is message
+
+
+def test_decompress_uncompressed_message(codec):
+    message = Message(MessageType.STDOUT, LOG, 1)
+
+    assert decompress(message, codec, 0) is message
+
+
+def test_decompress_without_codec():
+    message = Message(MessageType.STDOUT, zlib.compress(LOG), 1, COMPRESSED)
+
+    with pytest.raises(ProtocolError, match="without agreeing on compression"):
+        decompress(message, None, len(LOG))
+
+
+def test_decompress_refuses_to_inflate_past_max_size(codec):
+    message = compress(Message(MessageType.STDOUT, LOG, 1), codec)
+
+    with pytest.raises(ProtocolError, match=f"exceeds {len(LOG) - 1} bytes"):
+        decompress(message, codec, len(LOG) - 1)
+
+
+def test_decompress_truncated_data(codec):
+    message = compress(Message(MessageType.STDOUT, LOG, 1), codec)
+    message.text = message.text[:-8]
+
+    with pytest.raises(ProtocolError):
+        decompress(message, codec, len(LOG))
+
+
+def test_decompress_invalid_data(codec):
+    message = Message(MessageType.STDOUT, b"not compressed at all", 1, COMPRESSED)
+
+    with pytest.raises(ProtocolError, match=f"Invalid {codec.name} data"):
+        decompress(message, codec, len(LOG))
+
+
+def test_zlib_level():
+    # The fastest level keeps up with the network
+    assert Zlib().compress(LOG) == zlib.compress(LOG, 1)
+
+
+def test_zstd_without_content_size():
+    zstandard = pytest.importorskip("zstandard")
+    text = zstandard.ZstdCompressor(write_content_size=False).compress(LOG)
+
+    with pytest.raises(ProtocolError, match="truncated or exceeds"):
+        decompress(Message(MessageType.STDOUT, text, 1, COMPRESSED), CODECS["zstd"], len(LOG))
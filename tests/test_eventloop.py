@@ -0,0 +1,37 @@
+import asyncio
+import io
+from contextlib import redirect_stderr
+from unittest.mock import patch
+
+import pytest
+
+from cmdbroker import eventloop
+
+requires_uvloop = pytest.mark.skipif(
+    not eventloop.uvloop_installed(), reason="uvloop is not installed"
+)
+
+
+async def loop_module():
+    return type(asyncio.get_running_loop()).__module__
+
+
+def test_run_on_asyncio():
+    assert eventloop.run(loop_module()).startswith("asyncio")
+    assert eventloop.resolve("asyncio") == "asyncio"
+
+
+@requires_uvloop
+@pytest.mark.parametrize("event_loop", ["uvloop", "auto"])
+def test_run_on_uvloop(event_loop):
+    assert eventloop.run(loop_module(), event_loop) == "uvloop"
+    assert eventloop.resolve(event_loop) == "uvloop"
+
+
+@patch("cmdbroker.eventloop.importlib.util.find_spec", lambda name: None)
+@pytest.mark.parametrize("event_loop, warning", [("uvloop", True), ("auto", False)])
+def test_run_without_uvloop(event_loop, warning):
+    with io.StringIO() as buf, redirect_stderr(buf):
+        assert eventloop.run(loop_module(), event_loop).startswith("asyncio")
+
+        assert ("uvloop is not installed" in buf.getvalue()) == warning
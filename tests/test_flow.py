@@ -0,0 +1,84 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from cmdbroker.flow import STDIN_WINDOW, InputQueue, SendWindow, end_stream
+from cmdbroker.message import Message, MessageType, ProtocolError
+
+
+def granted(writer):
+    """The sizes of the WINDOW messages written."""
+    return [
+        Message(MessageType.WINDOW, b"".join(args[0])[Message.HEADER.size :]).json()["size"]
+        for args, _ in writer.writelines.call_args_list
+    ]
+
+
+@pytest.fixture
+def writer():
+    return MagicMock(drain=AsyncMock())
+
+
+@pytest.mark.asyncio
+async def test_input_queue_grants_the_window_again(writer):
+    stdin_queue = InputQueue(1, writer)
+    chunk = bytes(STDIN_WINDOW // 4)
+    for _ in range(4):
+        await stdin_queue.put(chunk)
+    await stdin_queue.put(b"")
+
+    chunks = [chunk async for chunk in stdin_queue.chunks()]
+
+    assert len(chunks) == 4
+    # Half the window at a time
+    assert granted(writer) == [STDIN_WINDOW // 2] * 2
+    assert stdin_queue.window == STDIN_WINDOW
+
+
+@pytest.mark.asyncio
+async def test_input_queue_does_not_wait_for_the_command(writer):
+    stdin_queue = InputQueue(1, writer)
+
+    await asyncio.wait_for(stdin_queue.put(bytes(STDIN_WINDOW)), 1)
+
+    with pytest.raises(ProtocolError, match="Stream 1 sent more stdin than its window"):
+        await stdin_queue.put(b"x")
+
+
+@pytest.mark.asyncio
+async def test_input_queue_clear(writer):
+    stdin_queue = InputQueue(1, writer)
+    await stdin_queue.put(b"unread")
+
+    stdin_queue.clear()
+
+    assert stdin_queue.queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_end_stream_drops_unread_stdin(writer):
+    stdin_queue = InputQueue(1, writer)
+    await stdin_queue.put(b"unread")
+    task = MagicMock()
+    stdin_queues = {1: stdin_queue}
+    tasks = {1: task}
+
+    end_stream(stdin_queues, tasks, 1, task)
+
+    assert stdin_queues == {}
+    assert tasks == {}
+    assert stdin_queue.queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_send_window():
+    window = SendWindow()
+
+    assert await window.take(STDIN_WINDOW + 1) == STDIN_WINDOW
+    taking = asyncio.create_task(window.take(100))
+    await asyncio.sleep(0.01)
+    assert not taking.done()
+
+    window.grant(60)
+    assert await taking == 60
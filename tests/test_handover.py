@@ -0,0 +1,115 @@
+import json
+import os
+import socket
+import sys
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from cmdbroker import handover
+from cmdbroker.handover import CONTROL_FD, LISTEN_FD, Predecessor, predecessor, start_successor
+
+
+@pytest.fixture
+def listening():
+    sock = socket.create_server(("127.0.0.1", 0))
+    yield sock
+    sock.close()
+
+
+def successor(behave):
+    """Stand in for `subprocess.Popen`, running `behave` on the inherited descriptors."""
+    started = []
+    process = MagicMock(pid=4321)
+
+    def popen(argv, pass_fds, env):
+        # The parent closes its copies as soon as the child is started
+        listen_fd, control_fd = (os.dup(fd) for fd in pass_fds)
+        thread = threading.Thread(target=behave, args=(listen_fd, control_fd))
+        thread.start()
+        started.append((argv, pass_fds, env, thread))
+        return process
+
+    return MagicMock(side_effect=popen, return_value=process), started
+
+
+def ready(listen_fd, control_fd):
+    Predecessor(listen_fd, control_fd).ready()
+
+
+def crash(listen_fd, control_fd):
+    os.close(listen_fd)
+    os.close(control_fd)
+
+
+@pytest.mark.asyncio
+async def test_start_successor(listening):
+    popen, started = successor(ready)
+
+    with patch("cmdbroker.handover.subprocess.Popen", popen):
+        pid = await start_successor(listening, "secret")
+
+    ((argv, pass_fds, env, thread),) = started
+    thread.join()
+    assert pid == 4321
+    assert argv == [sys.executable, "-m", "cmdbroker", *sys.argv[1:]]
+    assert pass_fds[0] == listening.fileno()
+    assert (env[LISTEN_FD], env[CONTROL_FD]) == tuple(str(fd) for fd in pass_fds)
+    popen.return_value.terminate.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_start_successor_that_exits(listening):
+    popen, started = successor(crash)
+
+    with patch("cmdbroker.handover.subprocess.Popen", popen):
+        assert await start_successor(listening, "secret") is None
+
+    started[0][3].join()
+    process = popen.return_value
+    process.terminate.assert_called_once()
+    process.wait.assert_called_once()
+
+
+@pytest.mark.asyncio
+@patch.object(handover, "READY_TIMEOUT", 0.01)
+async def test_start_successor_that_hangs(listening):
+    done = threading.Event()
+
+    def hang(listen_fd, control_fd):
+        done.wait()
+        crash(listen_fd, control_fd)
+
+    popen, started = successor(hang)
+
+    with patch("cmdbroker.handover.subprocess.Popen", popen):
+        assert await start_successor(listening, "secret") is None
+
+    done.set()
+    started[0][3].join()
+    popen.return_value.terminate.assert_called_once()
+
+
+def test_predecessor(listening, monkeypatch):
+    control, inherited = socket.socketpair()
+    control.sendall(json.dumps({"password": "secret"}).encode() + b"\n")
+    monkeypatch.setenv(LISTEN_FD, str(os.dup(listening.fileno())))
+    monkeypatch.setenv(CONTROL_FD, str(inherited.detach()))
+
+    found = predecessor()
+
+    assert found is not None
+    assert found.password == "secret"
+    assert found.socket.getsockname() == listening.getsockname()
+    assert LISTEN_FD not in os.environ and CONTROL_FD not in os.environ
+    found.ready()
+    assert control.recv(64) == b"ready\n"
+    found.socket.close()
+    control.close()
+
+
+def test_no_predecessor(monkeypatch):
+    monkeypatch.delenv(LISTEN_FD, raising=False)
+
+    assert predecessor() is None
@@ -1,8 +1,16 @@
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
-from cmdbroker.message import Message
+from cmdbroker.message import (
+    FRAME_VERSION,
+    PROTOCOL_VERSION,
+    SUPPORTED_VERSIONS,
+    Message,
+    MessageType,
+    ProtocolError,
+    negotiate,
+)
 
 
 def test_build(sample_message):
@@ -12,18 +20,36 @@ def test_build(sample_message):
         message.text
         == b'{"method": "process", "parameters": {"param1": "value1", "param2": "value2"}}'
     )
-    assert message.unpack_length() == len(message.text)
+    assert message.type == MessageType.REQUEST
 
 
-def test_unpack_length(sample_message):
+def test_header(sample_message):
     message = Message.build(sample_message)
 
-    assert message.unpack_length() == 77
+    assert Message.HEADER.unpack(message.header()) == (
+        FRAME_VERSION,
+        MessageType.REQUEST,
+        0,
+        0,
+        77,
+    )
+
+
+def test_header_with_stream_id(sample_message):
+    message = Message.build(sample_message, 42, MessageType.END)
+
+    assert Message.HEADER.unpack(message.header()) == (
+        FRAME_VERSION,
+        MessageType.END,
+        0,
+        42,
+        77,
+    )
 
 
 def test_output(sample_message):
     message = Message.build(sample_message)
-    expected_output = message.text_length_bytes + message.text
+    expected_output = message.header() + message.text
 
     assert message.output() == expected_output
 
@@ -39,21 +65,122 @@ def test_write(sample_message):
     mocked_writer = MagicMock()
     message.write(mocked_writer)
 
-    mocked_writer.write.assert_called_with(message.output())
+    mocked_writer.writelines.assert_called_once_with((message.header(), message.text))
 
 
 @pytest.mark.asyncio
 async def test_async_read_write(sample_message):
     message = Message.build(sample_message)
     mocked_writer = AsyncMock()
-    mocked_writer.write = MagicMock()
+    mocked_writer.writelines = MagicMock()
     mocked_writer.drain = AsyncMock()
     await message.async_write(mocked_writer)
-    mocked_writer.write.assert_called_with(message.output())
+    mocked_writer.writelines.assert_called_with((message.header(), message.text))
     mocked_writer.drain.assert_awaited_once()
     mocked_reader = AsyncMock()
-    mocked_reader.read = AsyncMock(side_effect=[message.text_length_bytes, message.text])
+    mocked_reader.readexactly = AsyncMock(side_effect=[message.header(), message.text])
 
     received = await Message.async_read(mocked_reader)
 
+    mocked_reader.readexactly.assert_any_await(Message.HEADER.size)
+    mocked_reader.readexactly.assert_any_await(77)
+    assert received.type == MessageType.REQUEST
     assert received.json() == sample_message
+
+
+@pytest.mark.asyncio
+async def test_async_read_output_chunk():
+    message = Message(MessageType.STDOUT, b"\x00binary\xff", 3)
+    mocked_reader = AsyncMock()
+    mocked_reader.readexactly = AsyncMock(side_effect=[message.header(), message.text])
+
+    received = await Message.async_read(mocked_reader)
+
+    assert received.type == MessageType.STDOUT
+    assert received.text == b"\x00binary\xff"
+    assert received.stream_id == 3
+
+
+@pytest.mark.asyncio
+async def test_async_read_times_the_payload():
+    message = Message(MessageType.STDIN, b"data", 1)
+    mocked_reader = AsyncMock()
+    mocked_reader.readexactly = AsyncMock(side_effect=[message.header(), message.text])
+
+    with patch("time.perf_counter", side_effect=[10.0, 10.5]):
+        received = await Message.async_read(mocked_reader)
+
+    assert received.read_time == 0.5
+    assert message.read_time == 0.0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "header, error",
+    [
+        (Message.HEADER.pack(0, MessageType.REQUEST, 0, 1, 77), "Unsupported protocol version 0"),
+        (Message.HEADER.pack(FRAME_VERSION, 99, 0, 1, 77), "Unknown message type 99"),
+    ],
+)
+async def test_async_read_rejects_unknown_header(header, error):
+    mocked_reader = AsyncMock()
+    mocked_reader.readexactly = AsyncMock(side_effect=[header])
+
+    with pytest.raises(ProtocolError, match=error):
+        await Message.async_read(mocked_reader)
+
+    # The payload length is not trusted
+    mocked_reader.readexactly.assert_awaited_once_with(Message.HEADER.size)
+
+
+@pytest.mark.asyncio
+async def test_async_read_rejects_oversized_message(sample_message):
+    message = Message.build(sample_message)
+    mocked_reader = AsyncMock()
+    mocked_reader.readexactly = AsyncMock(side_effect=[message.header()])
+
+    with pytest.raises(ProtocolError, match="Message of 77 bytes exceeds the maximum of 76"):
+        await Message.async_read(mocked_reader, 76)
+
+    mocked_reader.readexactly.assert_awaited_once_with(Message.HEADER.size)
+
+
+def test_hello():
+    message = Message.hello()
+
+    assert message.type == MessageType.HELLO
+    assert message.json() == {"versions": SUPPORTED_VERSIONS}
+
+
+def test_hello_offering_compression():
+    message = Message.hello(("zstd", "zlib"))
+
+    assert message.json() == {"versions": SUPPORTED_VERSIONS, "compression": ["zstd", "zlib"]}
+
+
+def test_negotiate():
+    assert negotiate(Message.hello()) == PROTOCOL_VERSION
+    hello = Message.build({"versions": [PROTOCOL_VERSION, 1000]}, 0, MessageType.HELLO)
+    assert negotiate(hello) == PROTOCOL_VERSION
+
+
+@pytest.mark.parametrize(
+    "hello, error",
+    [
+        (Message.build({"method": "process"}), "Expected a HELLO message"),
+        (Message.build({"versions": [1000]}, 0, MessageType.HELLO), "Unsupported protocol"),
+        (Message.build({}, 0, MessageType.HELLO), "Unsupported protocol"),
+        (Message(MessageType.HELLO, b"{"), "not valid JSON"),
+        (Message(MessageType.HELLO, b"\xff"), "not valid JSON"),
+        (Message.build([1], 0, MessageType.HELLO), "must be a JSON object"),
+        (Message.build({"versions": 1}, 0, MessageType.HELLO), "offer versions as a list"),
+        (Message.build({"versions": [[1]]}, 0, MessageType.HELLO), "offer versions as a list"),
+        (
+            Message.build({"versions": [1], "compression": "zlib"}, 0, MessageType.HELLO),
+            "offer compression as a list",
+        ),
+    ],
+)
+def test_negotiate_fails(hello, error):
+    with pytest.raises(ProtocolError, match=error):
+        negotiate(hello)
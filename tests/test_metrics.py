@@ -0,0 +1,178 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from cmdbroker.metrics import Counter, CountingWriter, Gauge, Histogram, Registry, ServerMetrics
+from cmdbroker.scheduler import Scheduler
+
+
+def test_counter():
+    counter = Counter("requests_total", "Requests received", ["method"])
+    counter.inc(method="exec")
+    counter.inc(2, method='say "hi"\\\n')
+    counter.inc(method="exec")
+
+    assert counter.render() == [
+        "# HELP requests_total Requests received",
+        "# TYPE requests_total counter",
+        'requests_total{method="exec"} 2.0',
+        'requests_total{method="say \\"hi\\"\\\\\\n"} 2.0',
+    ]
+
+
+def test_counter_without_labels_starts_at_zero():
+    assert Counter("bytes_total", "Bytes sent").render()[-1] == "bytes_total 0.0"
+
+
+def test_gauge():
+    gauge = Gauge("connections", "Connections open")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert gauge.render()[1:] == ["# TYPE connections gauge", "connections 1.0"]
+
+
+def test_gauge_function():
+    scheduler = Scheduler(4, 8)
+    scheduler.running = 3
+
+    assert ServerMetrics(scheduler).running.render()[-1] == "cmdbroker_commands_running 3.0"
+
+
+def test_histogram():
+    histogram = Histogram("duration_seconds", "Durations", buckets=[1, 0.5])
+    for value in (0.25, 0.5, 0.75, 2):
+        histogram.observe(value)
+
+    assert histogram.render()[2:] == [
+        'duration_seconds_bucket{le="0.5"} 2.0',
+        'duration_seconds_bucket{le="1.0"} 3.0',
+        'duration_seconds_bucket{le="+Inf"} 4.0',
+        "duration_seconds_sum 3.5",
+        "duration_seconds_count 4.0",
+    ]
+
+
+def test_histogram_with_labels():
+    histogram = Histogram("duration_seconds", "Durations", ["method"], buckets=[1])
+    assert histogram.render()[2:] == []
+
+    histogram.observe(0.5, method="exec")
+
+    assert histogram.render()[2:] == [
+        'duration_seconds_bucket{method="exec",le="1.0"} 1.0',
+        'duration_seconds_bucket{method="exec",le="+Inf"} 1.0',
+        'duration_seconds_sum{method="exec"} 0.5',
+        'duration_seconds_count{method="exec"} 1.0',
+    ]
+
+
+def test_server_metrics_render():
+    metrics = ServerMetrics(Scheduler(4, 8))
+
+    text = metrics.render()
+
+    assert text.endswith("\n")
+    names = [line.split()[2] for line in text.splitlines() if line.startswith("# TYPE")]
+    assert names == [
+        "cmdbroker_connections",
+        "cmdbroker_connections_total",
+        "cmdbroker_tls_handshake_duration_seconds",
+        "cmdbroker_requests_total",
+        "cmdbroker_errors_total",
+        "cmdbroker_commands_running",
+        "cmdbroker_commands_queued",
+        "cmdbroker_command_wait_seconds",
+        "cmdbroker_command_duration_seconds",
+        "cmdbroker_received_bytes_total",
+        "cmdbroker_sent_bytes_total",
+    ]
+
+
+def test_counting_writer():
+    counter = Counter("sent_bytes_total", "Bytes sent")
+    writer = MagicMock()
+    counting = CountingWriter(writer, counter)
+
+    counting.writelines([b"head", b"payload"])
+    counting.close()
+
+    writer.writelines.assert_called_once_with([b"head", b"payload"])
+    writer.close.assert_called_once_with()
+    assert counter.values == {(): 11}
+
+
+async def scrape(registry, request):
+    server = await asyncio.start_server(registry.handle_scrape, "127.0.0.1", 0)
+    async with server:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+        writer.write(request)
+        response = await reader.read()
+        writer.close()
+    head, _, body = response.partition(b"\r\n\r\n")
+    return head.decode().split("\r\n"), body.decode()
+
+
+@pytest.fixture
+def registry():
+    registry = Registry()
+    registry.register(Counter("requests_total", "Requests received")).inc()
+    return registry
+
+
+@pytest.mark.asyncio
+async def test_scrape(registry):
+    head, body = await scrape(
+        registry, b"GET /metrics?format=text HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    )
+
+    assert head == [
+        "HTTP/1.1 200 OK",
+        "Content-Type: text/plain; version=0.0.4; charset=utf-8",
+        f"Content-Length: {len(body)}",
+        "Connection: close",
+    ]
+    assert body == registry.render()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "request_text, status",
+    [
+        (b"GET / HTTP/1.1\r\n\r\n", "HTTP/1.1 404 Not Found"),
+        (b"POST /metrics HTTP/1.1\r\n\r\n", "HTTP/1.1 405 Method Not Allowed"),
+        (b"nonsense\r\n\r\n", "HTTP/1.1 400 Bad Request"),
+        (b"GET /metrics HTTP/1.1\r\n", "HTTP/1.1 400 Bad Request"),
+    ],
+)
+async def test_scrape_errors(registry, request_text, status):
+    with patch("cmdbroker.metrics.SCRAPE_TIMEOUT", 0.1):
+        head, body = await scrape(registry, request_text)
+
+    assert head[0] == status
+    assert "requests_total" not in body
+
+
+@pytest.mark.asyncio
+async def test_scrape_connection_reset(registry):
+    reader = MagicMock()
+    reader.readline = AsyncMock(side_effect=ConnectionResetError)
+    writer = MagicMock()
+
+    await registry.handle_scrape(reader, writer)
+
+    writer.write.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_scrape_scraper_gone(registry):
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"GET /metrics HTTP/1.1\r\n\r\n")
+    writer = MagicMock()
+    writer.drain = AsyncMock(side_effect=BrokenPipeError)
+
+    await registry.handle_scrape(reader, writer)
+
+    writer.close.assert_called_once_with()
@@ -0,0 +1,234 @@
+import asyncio
+import signal
+
+import pytest
+
+from cmdbroker.process import CommandTimeoutError, Process, ShellPool
+
+
+@pytest.mark.asyncio
+async def test_process_output_and_exit_code():
+    process = await Process.start("echo out; echo err >&2; exit 3")
+
+    stdout, stderr = await asyncio.gather(process.stdout.read(), process.stderr.read())
+
+    assert await process.wait() == 3
+    assert process.returncode == 3
+    assert (stdout, stderr) == (b"out\n", b"err\n")
+    assert process.stdin is None
+
+
+@pytest.mark.asyncio
+async def test_process_stdin():
+    process = await Process.start("tr a-z A-Z", stdin=True)
+
+    process.stdin.write(b"hello")
+    await process.stdin.drain()
+    process.stdin.close()
+
+    assert await process.stdout.read() == b"HELLO"
+    assert await process.wait() == 0
+
+
+@pytest.mark.asyncio
+async def test_process_without_stdin_reads_nothing():
+    process = await Process.start("wc -c")
+
+    assert (await process.stdout.read()).strip() == b"0"
+    assert await process.wait() == 0
+
+
+@pytest.mark.asyncio
+async def test_process_exec():
+    process = await Process.exec(
+        ["sh", "-c", 'read line; echo "$line $FOO from $(pwd)"'],
+        stdin=True,
+        cwd="/",
+        env={"FOO": "bar"},
+    )
+
+    process.stdin.write(b"hello\n")
+    process.stdin.close()
+
+    assert await process.stdout.read() == b"hello bar from /\n"
+    assert await process.wait() == 0
+
+
+@pytest.mark.asyncio
+async def test_process_exec_does_not_use_a_shell():
+    process = await Process.exec(["echo", "$HOME", ";", "*"])
+
+    assert await process.stdout.read() == b"$HOME ; *\n"
+    assert await process.wait() == 0
+
+
+@pytest.mark.asyncio
+async def test_process_rusage():
+    # Burn a little CPU and memory in the command itself
+    process = await Process.start("i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done; sleep 0.1")
+
+    await process.wait()
+
+    assert set(process.rusage) == {"wall_time", "user_time", "system_time", "max_rss"}
+    assert process.rusage["wall_time"] >= 0.1
+    assert process.rusage["user_time"] + process.rusage["system_time"] > 0
+    assert process.rusage["max_rss"] > 0
+
+
+@pytest.mark.asyncio
+async def test_process_killed_by_signal():
+    process = await Process.start("kill -TERM $$")
+
+    assert await process.wait() == -signal.SIGTERM
+
+
+@pytest.mark.asyncio
+async def test_process_wait_cancelled():
+    process = await Process.start("sleep 0.1")
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(process.wait(), 0.01)
+
+    # The command is still reaped and can be waited for again
+    assert await process.wait() == 0
+    assert process.popen.returncode == 0
+
+
+@pytest.mark.asyncio
+async def test_process_terminate_stops_the_process_group():
+    process = await Process.start("sleep 60 & echo started; wait")
+    await process.stdout.readline()
+
+    await process.terminate()
+
+    assert process.returncode == -signal.SIGTERM
+    # The child holds on to stdout until it is gone too
+    assert await asyncio.wait_for(process.stdout.read(), 5) == b""
+
+
+@pytest.mark.asyncio
+async def test_process_terminate_kills_after_timeout():
+    # The shell and its children ignore SIGTERM
+    process = await Process.start("trap '' TERM; sleep 60 & echo started; wait")
+    await process.stdout.readline()
+
+    await process.terminate(timeout=0.1)
+
+    assert process.returncode == -signal.SIGKILL
+    assert await asyncio.wait_for(process.stdout.read(), 5) == b""
+
+
+@pytest.mark.asyncio
+async def test_process_terminate_after_exit():
+    process = await Process.start("true")
+    await process.wait()
+
+    await process.terminate()
+
+    assert process.returncode == 0
+
+
+@pytest.mark.asyncio
+async def test_process_supervise():
+    process = await Process.start("echo done")
+
+    assert await process.supervise(process.stdout.read(), 5) == b"done\n"
+    assert await process.wait() == 0
+
+
+@pytest.mark.asyncio
+async def test_process_supervise_times_out():
+    process = await Process.start("sleep 60")
+
+    with pytest.raises(CommandTimeoutError, match="^Command timed out after 0.1 seconds$"):
+        await process.supervise(process.wait(), 0.1)
+
+    assert process.returncode == -signal.SIGTERM
+
+
+@pytest.mark.asyncio
+async def test_process_supervise_cancelled():
+    process = await Process.start("sleep 60")
+    supervised = asyncio.create_task(process.supervise(process.stdout.read()))
+    await asyncio.sleep(0.05)
+
+    supervised.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await supervised
+
+    assert process.returncode == -signal.SIGTERM
+
+
+@pytest.mark.asyncio
+async def test_warm_process():
+    process = await Process.warm()
+    await asyncio.sleep(0.05)
+    assert not process.exited.done()
+
+    process.run('cd /; read line; echo "$line from $(pwd)"; exit 4', stdin=True)
+    process.stdin.write(b"hello\n")
+    process.stdin.close()
+
+    assert await process.stdout.read() == b"hello from /\n"
+    assert await process.wait() == 4
+    assert process.rusage["wall_time"] < 1
+
+
+@pytest.mark.asyncio
+async def test_warm_process_without_stdin():
+    process = await Process.warm()
+
+    process.run("wc -c")
+
+    assert process.stdin is None
+    assert (await process.stdout.read()).strip() == b"0"
+    assert await process.wait() == 0
+
+
+@pytest.mark.asyncio
+async def test_shell_pool():
+    pool = ShellPool(2)
+    pool.fill()
+    refill_task = pool.refill_task
+    pool.fill()
+    assert pool.refill_task is refill_task
+    await pool.refill_task
+    shells = list(pool.shells)
+
+    first = await pool.run("echo first")
+    second = await pool.run("echo second")
+
+    assert [first, second] == shells
+    assert await first.stdout.read() == b"first\n"
+    assert await second.stdout.read() == b"second\n"
+    assert not pool.shells
+    pool.fill()
+    await pool.refill_task
+    assert len(pool.shells) == 2
+    assert not set(pool.shells) & set(shells)
+
+
+@pytest.mark.asyncio
+async def test_shell_pool_ran_dry():
+    pool = ShellPool(1)
+
+    process = await pool.run("echo cold", stdin=True)
+
+    assert process not in pool.shells
+    process.stdin.close()
+    assert await process.stdout.read() == b"cold\n"
+
+
+@pytest.mark.asyncio
+async def test_shell_pool_drops_dead_shells():
+    pool = ShellPool(1)
+    await pool.refill()
+    dead = pool.shells[0]
+    dead.popen.kill()
+    await dead.wait()
+
+    process = await pool.run("echo replaced")
+
+    assert process is not dead
+    assert dead.script.is_closing()
+    assert await process.stdout.read() == b"replaced\n"
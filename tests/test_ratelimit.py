@@ -0,0 +1,177 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from cmdbroker import ratelimit
+from cmdbroker.ratelimit import RateLimiter, ThrottledError, ThrottledWriter, TokenBucket
+
+
+@pytest.fixture
+def clock():
+    """A monotonic clock that only moves when the test says so."""
+    now = [100.0]
+    with patch("cmdbroker.ratelimit.time.perf_counter", side_effect=lambda: now[0]):
+        yield now
+
+
+def test_token_bucket_take(clock):
+    bucket = TokenBucket(2)
+
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.5]
+    clock[0] += 0.25
+    assert bucket.take() == 0.25
+    clock[0] += 0.25
+    assert bucket.take() == 0.0
+    # Idle time does not let it burst beyond a second's worth
+    clock[0] += 10
+    assert bucket.full()
+    assert bucket.tokens == 2
+
+
+def test_token_bucket_take_below_one_per_second(clock):
+    bucket = TokenBucket(0.5)
+
+    assert bucket.take() == 0.0
+    assert bucket.take() == 2.0
+
+
+def test_token_bucket_spend(clock):
+    bucket = TokenBucket(100)
+
+    assert bucket.spend(60) == 0.0
+    assert bucket.spend(90) == 0.5
+    assert not bucket.full()
+    clock[0] += 0.5
+    assert bucket.spend(0) == 0.0
+    clock[0] += 1
+    assert bucket.full()
+
+
+def test_rate_limiter_without_limits():
+    limiter = RateLimiter()
+
+    for _ in range(100):
+        limiter.admit("client")
+        with limiter.command("client"):
+            with limiter.command("client"):
+                pass
+    assert limiter.delay("client", 1 << 30) == 0.0
+    assert limiter.clients == {}
+
+
+def test_rate_limiter_admit(clock):
+    limiter = RateLimiter(requests_per_second=2)
+
+    limiter.admit("client")
+    limiter.admit("client")
+    with pytest.raises(ThrottledError, match="Too many requests, at most 2 per second") as err:
+        limiter.admit("client")
+    # Other clients have limits of their own
+    limiter.admit("other")
+
+    assert err.value.details == {"limit": "requests", "retry_after": 0.5}
+    clock[0] += 0.5
+    limiter.admit("client")
+
+
+def test_rate_limiter_command():
+    limiter = RateLimiter(max_commands=2)
+
+    with limiter.command("client"):
+        with limiter.command("client"):
+            with pytest.raises(ThrottledError, match="Too many commands, at most 2") as err:
+                with limiter.command("client"):
+                    pass  # pragma: no cover
+            with limiter.command("other"):
+                assert limiter.clients["client"].commands == 2
+        assert limiter.clients["client"].commands == 1
+
+    assert err.value.details == {"limit": "commands"}
+    assert limiter.clients["client"].commands == 0
+
+
+def test_rate_limiter_command_failure():
+    limiter = RateLimiter(max_commands=1)
+
+    with pytest.raises(OSError):
+        with limiter.command("client"):
+            raise OSError("No such file or directory")
+
+    assert limiter.clients["client"].commands == 0
+
+
+def test_rate_limiter_delay(clock):
+    limiter = RateLimiter(bytes_per_second=1000)
+
+    assert limiter.delay("client", 1000) == 0.0
+    assert limiter.delay("client", 500) == 0.5
+    assert limiter.delay("other", 500) == 0.0
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_transfer():
+    limiter = RateLimiter(bytes_per_second=1000)
+
+    with patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+        await limiter.transfer("client", 1000)
+        mock_sleep.assert_not_awaited()
+        await limiter.transfer("client", 100)
+
+    (delay,) = mock_sleep.await_args.args
+    assert 0 < delay <= 0.1
+
+
+@patch.object(ratelimit, "PRUNE_THRESHOLD", 3)
+def test_rate_limiter_forgets_idle_clients(clock):
+    limiter = RateLimiter(requests_per_second=1, max_commands=1)
+
+    limiter.admit("recent")
+    limiter.admit("idle")
+    with limiter.command("busy"):
+        clock[0] += 0.5
+        limiter.admit("other")
+        assert set(limiter.clients) == {"recent", "idle", "busy", "other"}
+
+        clock[0] += 0.75
+        limiter.admit("new")
+
+    # Clients are only forgotten once they could not have been limited anyway
+    assert set(limiter.clients) == {"busy", "other", "new"}
+
+
+@pytest.mark.asyncio
+async def test_throttled_writer():
+    writer = MagicMock(drain=AsyncMock())
+    limiter = RateLimiter(bytes_per_second=1000)
+    throttled = ThrottledWriter(writer, limiter, "client")
+
+    with patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+        throttled.writelines([b"x" * 600, b"x" * 400])
+        await throttled.drain()
+        mock_sleep.assert_not_awaited()
+
+        throttled.writelines([b"x" * 250])
+        await throttled.drain()
+
+    writer.writelines.assert_called_with([b"x" * 250])
+    assert writer.drain.await_count == 2
+    (delay,) = mock_sleep.await_args.args
+    assert 0 < delay <= 0.25
+    assert throttled.get_extra_info is writer.get_extra_info
+
+
+@pytest.mark.asyncio
+async def test_throttled_writer_paces_output():
+    writer = MagicMock(drain=AsyncMock())
+    throttled = ThrottledWriter(writer, RateLimiter(bytes_per_second=10000), "client")
+
+    started = asyncio.get_running_loop().time()
+    for _ in range(3):
+        throttled.writelines([b"x" * 1000])
+        await throttled.drain()
+    throttled.writelines([b"x" * 9000])
+    await throttled.drain()
+
+    # A second's worth went out at once, the rest at 10000 bytes per second
+    assert asyncio.get_running_loop().time() - started >= 0.19
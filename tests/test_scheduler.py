@@ -0,0 +1,173 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from cmdbroker.scheduler import QueueFullError, Scheduler
+
+
+async def hold(scheduler, client, started, release):
+    async with scheduler.slot(client) as wait_time:
+        started.append((client, wait_time))
+        await release.wait()
+
+
+def test_scheduler_initialization():
+    scheduler = Scheduler(2, 3)
+
+    assert scheduler.stats() == {
+        "running": 0,
+        "queued": 0,
+        "max_running": 2,
+        "max_queued": 3,
+        "mean_wait_time": 0.0,
+        "max_wait_time": 0.0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_slot_runs_immediately_under_the_limit():
+    scheduler = Scheduler(2, 0)
+
+    async with scheduler.slot("client") as wait_time:
+        async with scheduler.slot("client"):
+            assert scheduler.running == 2
+
+    assert wait_time < 0.1
+    assert scheduler.running == 0
+    assert scheduler.waited == 2
+
+
+@pytest.mark.asyncio
+async def test_slot_queues_over_the_limit():
+    scheduler = Scheduler(1, 4)
+    started, release = [], asyncio.Event()
+
+    tasks = [asyncio.create_task(hold(scheduler, "client", started, release)) for _ in range(3)]
+    await asyncio.sleep(0)
+
+    assert len(started) == 1
+    assert scheduler.stats()["running"] == 1
+    assert scheduler.stats()["queued"] == 2
+
+    release.set()
+    await asyncio.gather(*tasks)
+
+    assert len(started) == 3
+    assert scheduler.running == 0
+    assert scheduler.queued == 0
+    assert scheduler.waiting == {}
+
+
+@pytest.mark.asyncio
+async def test_slot_rejects_when_the_queue_is_full():
+    scheduler = Scheduler(1, 1)
+    started, release = [], asyncio.Event()
+    tasks = [asyncio.create_task(hold(scheduler, "client", started, release)) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    with pytest.raises(QueueFullError, match="1 commands are already queued"):
+        async with scheduler.slot("client"):
+            pass  # pragma: no cover
+
+    release.set()
+    await asyncio.gather(*tasks)
+
+
+@pytest.mark.asyncio
+async def test_slot_takes_turns_between_clients():
+    scheduler = Scheduler(1, 10)
+    started, releases = [], [asyncio.Event() for _ in range(5)]
+    clients = ["busy", "busy", "busy", "busy", "quiet"]
+
+    tasks = []
+    for client, release in zip(clients, releases):
+        tasks.append(asyncio.create_task(hold(scheduler, client, started, release)))
+        await asyncio.sleep(0)
+    for release in releases:
+        release.set()
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+
+    # The quiet client goes ahead of the commands the busy one queued before it
+    assert [client for client, _ in started] == ["busy", "busy", "quiet", "busy", "busy"]
+
+
+@pytest.mark.asyncio
+async def test_slot_cancelled_while_queued():
+    scheduler = Scheduler(1, 10)
+    started, release = [], asyncio.Event()
+    running = asyncio.create_task(hold(scheduler, "first", started, release))
+    queued = [asyncio.create_task(hold(scheduler, "second", started, release)) for _ in range(2)]
+    await asyncio.sleep(0)
+
+    for remaining, task in enumerate(reversed(queued)):
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert scheduler.queued == 1 - remaining
+
+    assert scheduler.waiting == {}
+    release.set()
+    await running
+    assert scheduler.running == 0
+    assert len(started) == 1
+
+
+@pytest.mark.asyncio
+async def test_slot_cancelled_after_it_was_handed_over():
+    scheduler = Scheduler(1, 10)
+    started, release = [], asyncio.Event()
+    await scheduler.acquire("first")
+    queued = asyncio.create_task(hold(scheduler, "second", started, release))
+    await asyncio.sleep(0)
+
+    # The slot is handed to the queued command right before it is cancelled
+    scheduler.release()
+    queued.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await queued
+
+    assert started == []
+    assert scheduler.running == 0
+    assert scheduler.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_slot_released_right_after_a_queued_command_was_cancelled():
+    scheduler = Scheduler(1, 10)
+    started, releases = [], [asyncio.Event() for _ in range(3)]
+    tasks = [
+        asyncio.create_task(hold(scheduler, client, started, release))
+        for client, release in zip(["first", "second", "third"], releases)
+    ]
+    await asyncio.sleep(0)
+
+    # The queued command notices its cancellation only after the slot was released
+    releases[0].set()
+    tasks[1].cancel()
+    await tasks[0]
+    with pytest.raises(asyncio.CancelledError):
+        await tasks[1]
+
+    # The slot skipped the cancelled command
+    assert [client for client, _ in started] == ["first", "third"]
+    releases[2].set()
+    await tasks[2]
+    assert scheduler.running == 0
+    assert scheduler.queued == 0
+    assert scheduler.waiting == {}
+
+
+@pytest.mark.asyncio
+async def test_stats_wait_times():
+    scheduler = Scheduler(1, 10)
+
+    with patch("cmdbroker.scheduler.time.perf_counter", side_effect=[0.0, 1.0, 5.0, 8.0]):
+        async with scheduler.slot("client"):
+            pass
+        async with scheduler.slot("client"):
+            pass
+
+    assert scheduler.stats()["mean_wait_time"] == 2.0
+    assert scheduler.stats()["max_wait_time"] == 3.0
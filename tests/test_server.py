@@ -1,15 +1,82 @@
+import argparse
 import asyncio
+import base64
 import io
+import json
 import os
 import signal
+import socket
 import ssl
+import sys
+import threading
+import time
+import zlib
 from contextlib import redirect_stdout
-from unittest.mock import AsyncMock, MagicMock, patch
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import ANY, AsyncMock, MagicMock, call, patch
 
 import pytest
 from cryptography import x509
 
-from cmdbroker.server import Server
+from cmdbroker import benchmark
+from cmdbroker.client import BrokerError, Session, client_ssl_context
+from cmdbroker.compression import CODECS, compress, decompress
+from cmdbroker.flow import STDIN_WINDOW
+from cmdbroker.message import COMPRESSED, PROTOCOL_VERSION, SUPPORTED_VERSIONS, Message, MessageType
+from cmdbroker.process import Process
+from cmdbroker.server import Server, TimedSSLContext, run_worker
+
+from .conftest import client_reader, client_writer, end, welcome, written
+
+
+@pytest.fixture(autouse=True)
+def frozen_clock():
+    # Keep the reported wait times predictable
+    with patch("cmdbroker.scheduler.time.perf_counter", return_value=0.0):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def fixed_rusage():
+    # Keep the reported resource usage predictable, the commands still run for real
+    wait4 = os.wait4
+
+    def fixed_wait4(pid, options):
+        pid, status, _ = wait4(pid, options)
+        return pid, status, MagicMock(ru_utime=0.5, ru_stime=0.25, ru_maxrss=1024)
+
+    with patch("cmdbroker.process.os.wait4", side_effect=fixed_wait4):
+        yield
+
+
+RUSAGE = {"wall_time": 0.0, "user_time": 0.5, "system_time": 0.25, "max_rss": 1024}
+
+
+def process(command, stream_id=1, **request):
+    return Message.build(
+        {"method": "process", "parameters": {"command": command}, **request}, stream_id
+    )
+
+
+def done(stream_id=1):
+    """The END message of a command that ran fine."""
+    return end(stream_id, returncode=0, wait_time=0.0, rusage=RUSAGE)
+
+
+def answered(writer):
+    """The streams the server has sent an END message for."""
+    headers = (Message.HEADER.unpack(output[: Message.HEADER.size]) for output in written(writer))
+    return {stream_id for _, kind, _, stream_id, _ in headers if kind == MessageType.END}
+
+
+async def handle_request(server, reader, writer):
+    """Serve a client that disconnects once all of its requests have been answered."""
+    handler = asyncio.create_task(server.handle_request(reader, writer))
+    while not handler.done() and not reader.streams <= answered(writer):
+        await asyncio.sleep(0.001)
+    reader.feed_eof()
+    await handler
 
 
 def test_server_init(server_args):
@@ -128,10 +195,10 @@ async def test_server_generate_cert_and_key_not_ip(mock_input, server_args):
 
 
 @pytest.mark.asyncio
-@patch("ssl.create_default_context")
-async def test_server_run_start_server(mock_ssl_create_default_context, server_args, mock_server):
+@patch("cmdbroker.server.TimedSSLContext")
+async def test_server_run_start_server(mock_ssl_context, server_args, mock_server):
     ssl_context = MagicMock()
-    mock_ssl_create_default_context.return_value = ssl_context
+    mock_ssl_context.return_value = ssl_context
     with patch(
         "asyncio.start_server", new_callable=AsyncMock, return_value=mock_server
     ) as mock_start_server:
@@ -140,8 +207,13 @@ async def test_server_run_start_server(mock_ssl_create_default_context, server_a
 
             await server.run()
 
+            mock_ssl_context.assert_called_once_with(ssl.PROTOCOL_TLS_SERVER)
             mock_start_server.assert_called_once_with(
-                server.handle_request, server_args.address, server_args.port, ssl=ssl_context
+                server.handle_request,
+                server_args.address,
+                server_args.port,
+                ssl=ssl_context,
+                reuse_port=False,
             )
             mock_server.serve_forever.assert_awaited_once_with()
             assert buf.getvalue().startswith(
@@ -151,12 +223,367 @@ async def test_server_run_start_server(mock_ssl_create_default_context, server_a
 
 
 @pytest.mark.asyncio
-@patch("ssl.create_default_context")
-async def test_server_run_start_server_bad_pass(
-    mock_ssl_create_default_context, server_args, mock_server
-):
+@patch("cmdbroker.server.TimedSSLContext")
+async def test_server_run_warms_up_shells(mock_ssl_context, server_args, mock_server):
+    server_args.warm_shells = 2
+    with patch("asyncio.start_server", new_callable=AsyncMock, return_value=mock_server):
+        with io.StringIO() as buf, redirect_stdout(buf):
+            server = Server(server_args)
+
+            await server.run()
+
+    await server.shells.refill_task
+    assert len(server.shells.shells) == 2
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext")
+async def test_server_run_serves_metrics(mock_ssl_context, server_args, mock_server):
+    server_args.metrics_port = 9100
+    with patch(
+        "asyncio.start_server", new_callable=AsyncMock, return_value=mock_server
+    ) as mock_start_server:
+        with io.StringIO() as buf, redirect_stdout(buf):
+            server = Server(server_args)
+
+            await server.run()
+
+            mock_start_server.assert_called_with(
+                server.metrics.handle_scrape, server_args.address, server_args.metrics_port
+            )
+            assert server.metrics_server is mock_server
+            assert "Serving metrics on http://127.0.0.1:8080/metrics\n" in buf.getvalue()
+
+
+def test_timed_ssl_context():
+    context = TimedSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+
+    with patch("time.perf_counter", return_value=12.5):
+        ssl_object = context.wrap_bio(ssl.MemoryBIO(), ssl.MemoryBIO(), server_hostname="example")
+
+    assert ssl_object.handshake_started == 12.5
+
+
+@patch("cmdbroker.server.TimedSSLContext")
+def test_server_ssl_context_with_client_ca(mock_ssl_context, server_args):
+    server_args.client_ca = "client-ca.pem"
+    ssl_context = mock_ssl_context.return_value
+
+    assert Server(server_args).ssl_context() is ssl_context
+
+    assert ssl_context.verify_mode == ssl.CERT_REQUIRED
+    ssl_context.load_verify_locations.assert_called_once_with("client-ca.pem")
+
+
+@pytest.mark.parametrize(
+    "extra_info, identity",
+    [
+        ({"peername": ("10.0.0.1", 50000)}, "10.0.0.1"),
+        (
+            {
+                "peername": ("10.0.0.1", 50000),
+                "peercert": {
+                    "subject": ((("organizationName", "Example"),), (("commonName", "alice"),))
+                },
+            },
+            "alice",
+        ),
+        ({"peername": ("10.0.0.1", 50000), "peercert": {"subject": ()}}, "10.0.0.1"),
+        ({}, None),
+    ],
+)
+def test_client_identity(extra_info, identity):
+    writer = MagicMock()
+    writer.get_extra_info.side_effect = extra_info.get
+
+    assert Server.client_identity(writer) == identity
+
+
+def client_certificate(path, common_name):
+    """Write a self-signed certificate for `common_name` and its key to `path`."""
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.now(timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    with open(path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+
+
+@pytest.mark.asyncio
+async def test_server_with_mutual_tls(tmp_path):
+    client_cert = str(tmp_path / "client.pem")
+    client_certificate(client_cert, "alice")
+    server_args = ["--client-ca", client_cert]
+
+    async with benchmark.local_server(str(tmp_path), 1, server_args) as (address, port, cert):
+        async with Session(cert, client_cert=client_cert) as session:
+            result = await session.run(address, port, "echo hello")
+        async with Session(cert) as session:
+            # Turned away during the handshake, the client notices as soon as it sends or reads
+            with pytest.raises((BrokerError, ConnectionError)):
+                await session.run(address, port, "echo hello")
+
+    assert result.stdout == b"hello\n"
+    client_ssl_context.cache_clear()
+
+
+@pytest.mark.asyncio
+async def test_server_queued_stdin_does_not_hold_up_the_connection(tmp_path):
+    # More stdin than the window, for more commands than can run, over a single connection.
+    # Each command takes a while to read its input, the stdin of the others piles up.
+    stdin = bytes(4 * STDIN_WINDOW)
+    async with benchmark.local_server(str(tmp_path), 1) as (address, port, cert):
+        async with Session(cert, pool_size=1) as session:
+            results = await asyncio.wait_for(
+                asyncio.gather(
+                    *(
+                        session.run(address, port, "sleep 0.2; wc -c", stdin, cache=False)
+                        for _ in range(8)
+                    )
+                ),
+                10,
+            )
+
+    assert [int(result.stdout) for result in results] == [len(stdin)] * 8
+    client_ssl_context.cache_clear()
+
+
+@pytest.mark.asyncio
+async def test_server_restart_drops_no_requests(tmp_path):
+    async with benchmark.local_server(str(tmp_path), 4) as (address, port, cert):
+        async with Session(cert) as session:
+
+            async def server_pid():
+                # The server is the parent of the shell running the command
+                result = await session.run(address, port, "echo $PPID", cache=False)
+                return int(result.stdout)
+
+            old = await server_pid()
+            running = asyncio.create_task(session.run(address, port, "sleep 1; echo done"))
+            await asyncio.sleep(0.1)
+            os.kill(old, signal.SIGUSR2)
+            # Requests keep being answered while one server takes over from the other
+            pids = [await server_pid()]
+            while pids[-1] == old and len(pids) < 200:
+                await asyncio.sleep(0.05)
+                pids.append(await server_pid())
+            result = await running
+        os.kill(pids[-1], signal.SIGINT)
+
+    assert result.stdout == b"done\n"
+    assert result.returncode == 0
+    assert len(set(pids)) == 2
+    client_ssl_context.cache_clear()
+
+
+async def printed(stdout, prefix):
+    """Read what the server prints up to the line starting with `prefix`."""
+    line = b""
+    while not line.startswith(prefix):
+        line = await asyncio.wait_for(stdout.readline(), benchmark.STARTUP_TIMEOUT)
+        assert line, "The server stopped"
+
+
+@pytest.mark.asyncio
+async def test_server_reload_rotates_the_certificate(tmp_path):
+    address, port = "127.0.0.1", benchmark.free_port()
+    cert, old_cert = str(tmp_path / "broker-cert.pem"), str(tmp_path / "old-cert.pem")
+    # Same options as the benchmark server, with a password to generate the new key with
+    options = SimpleNamespace(
+        address=address,
+        cert_country="US",
+        cert_state="CA",
+        cert_locality="Benchmark",
+        cert_org="cmdbroker",
+        cert_days=1,
+        broker_cert=cert,
+        broker_key=str(tmp_path / "broker-key.pem"),
+        password="test-password",
+    )
+    # fmt: off
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "cmdbroker", "--server", "--generate-cert-and-key",
+        "--config", str(tmp_path / "missing.json"), "--address", address, "--port", str(port),
+        "--password", options.password,
+        "--broker-cert", options.broker_cert, "--broker-key", options.broker_key,
+        "--cert-country", "US", "--cert-state", "CA", "--cert-locality", "Benchmark",
+        "--cert-org", "cmdbroker", "--max-processes", "1",
+        stdout=asyncio.subprocess.PIPE, env={**os.environ, "PYTHONUNBUFFERED": "1"},
+    )
+    # fmt: on
+    try:
+        await printed(process.stdout, b"Server listening")
+        os.rename(cert, old_cert)
+        async with Session(old_cert) as old:
+            await old.run(address, port, "true")
+            with io.StringIO() as buf, redirect_stdout(buf):
+                Server.generate_cert_and_key(options)
+            process.send_signal(signal.SIGHUP)
+            await printed(process.stdout, b"Reloaded the configuration")
+
+            async with Session(cert) as new:
+                result = await new.run(address, port, "echo new")
+            # The connection that was open keeps the certificate it was made with
+            assert (await old.run(address, port, "echo old")).stdout == b"old\n"
+        # Resumed sessions skip the certificate, a full handshake no longer verifies
+        client_ssl_context.cache_clear()
+        async with Session(old_cert) as old:
+            with pytest.raises((BrokerError, ConnectionError, ssl.SSLError)):
+                await old.run(address, port, "echo old")
+    finally:
+        process.send_signal(signal.SIGINT)
+        await process.wait()
+
+    assert result.stdout == b"new\n"
+    client_ssl_context.cache_clear()
+
+
+@pytest.fixture
+def reloaded(server_args, tmp_path):
+    """The command line a reload parses, with a certificate that loads."""
+    cert = str(tmp_path / "broker.pem")
+    client_certificate(cert, "127.0.0.1")
+    params = argparse.Namespace(**{**vars(server_args), "broker_cert": cert, "broker_key": cert})
+    with patch("cmdbroker.cli.parse_args", return_value=params):
+        yield params
+
+
+def test_server_reload(server, reloaded):
+    reloaded.timeout = 5
+    reloaded.log_requests = True
+    reloaded.rate_limit_requests = 10
+    limiter = server.limiter
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        assert server.reload()
+
+        assert buf.getvalue() == "Reloaded the configuration, certificate and key.\n"
+    assert isinstance(server.latest_ssl_context, TimedSSLContext)
+    assert (server.broker_cert, server.timeout, server.log_requests) == (
+        reloaded.broker_cert,
+        5,
+        True,
+    )
+    assert server.limiter is not limiter
+    assert server.limiter.requests_per_second == 10
+    assert server.params.timeout == 5
+
+
+def test_server_reload_keeps_the_limiter(server, reloaded):
+    limiter = server.limiter
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        assert server.reload()
+
+    assert server.limiter is limiter
+
+
+def test_server_reload_reports_options_that_take_a_restart(server, reloaded):
+    reloaded.port = 9000
+    reloaded.cache_ttl = 60
+    reloaded.client_ca = reloaded.broker_cert
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        assert server.reload()
+
+        output = buf.getvalue()
+
+    assert output.endswith("Restart the server to change --port, --cache-ttl, --client-ca.\n")
+    assert (server.params.port, server.params.cache_ttl, server.client_ca) == (8080, 0, None)
+    assert server.params.client_ca is None
+
+
+def test_server_reload_worker(server, reloaded):
+    server.worker = 1
+    reloaded.port = 9000
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        assert server.reload()
+
+        assert buf.getvalue() == ""
+
+
+def test_server_reload_keeps_the_password(server, reloaded):
+    reloaded.password = None
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        assert server.reload()
+
+    assert server.password == "test-password"
+
+
+@pytest.mark.parametrize("error", [SystemExit(2), ValueError("Expecting value")])
+def test_server_reload_invalid_configuration(server, error):
+    with patch("cmdbroker.cli.parse_args", side_effect=error):
+        with io.StringIO() as buf, redirect_stdout(buf):
+            assert not server.reload()
+
+            assert buf.getvalue() == "Not reloading, the configuration is invalid.\n"
+
+
+def test_server_reload_certificate_that_does_not_load(server, reloaded, server_args):
+    reloaded.broker_cert = reloaded.broker_key = server_args.broker_cert
+    reloaded.timeout = 5
+    server.latest_ssl_context = ssl_context = MagicMock()
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        assert not server.reload()
+
+        assert buf.getvalue().startswith("Not reloading, the certificate and key do not load:")
+    assert server.latest_ssl_context is ssl_context
+    assert server.timeout == 0
+
+
+def test_server_use_latest_ssl_context(server):
+    listening, latest = MagicMock(), MagicMock()
+    ssl_object = SimpleNamespace(context=listening)
+    server.latest_ssl_context = listening
+
+    server.use_latest_ssl_context(ssl_object, None, listening)
+    assert ssl_object.context is listening
+
+    server.latest_ssl_context = latest
+    server.use_latest_ssl_context(ssl_object, None, listening)
+    assert ssl_object.context is latest
+
+
+@pytest.mark.parametrize("reloads", [True, False])
+def test_server_reload_workers(server, reloads):
+    workers = {0: SimpleNamespace(pid=11), 1: SimpleNamespace(pid=12)}
+
+    with patch.object(server, "reload", return_value=reloads):
+        with patch("os.kill", side_effect=[ProcessLookupError, None]) as mock_kill:
+            server.reload_workers(workers)
+
+    expected = [call(11, signal.SIGHUP), call(12, signal.SIGHUP)] if reloads else []
+    assert mock_kill.call_args_list == expected
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext")
+async def test_server_run_start_server_bad_pass(mock_ssl_context, server_args, mock_server):
     ssl_context = MagicMock()
-    mock_ssl_create_default_context.return_value = ssl_context
+    mock_ssl_context.return_value = ssl_context
     ssl_context.load_cert_chain.side_effect = ssl.SSLError
     with io.StringIO() as buf, redirect_stdout(buf):
         server = Server(server_args)
@@ -177,77 +604,1547 @@ def test_server_stop(server_args):
         assert buf.getvalue().endswith("Server stopped by user.\n")
 
 
+def test_server_stop_without_stdout(server_args):
+    server = Server(server_args)
+    server.server = MagicMock()
+    server.serving = MagicMock()
+
+    with redirect_stdout(MagicMock(write=MagicMock(side_effect=BrokenPipeError))):
+        server.stop()
+
+    server.server.close.assert_called_once()
+    server.serving.cancel.assert_called_once()
+
+
+def test_server_stop_with_metrics(server_args):
+    server = Server(server_args)
+    server.server = MagicMock()
+    server.metrics_server = MagicMock()
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        server.stop()
+
+    server.metrics_server.close.assert_called_once()
+
+
 @pytest.mark.asyncio
-@patch("ssl.create_default_context")
+@patch("cmdbroker.server.TimedSSLContext")
 @patch("asyncio.get_running_loop")
 async def test_server_run_handle_keyboard_interrupt(
-    mock_get_running_loop, mock_ssl_create_default_context, server_args, mock_server
+    mock_get_running_loop, mock_ssl_context, server_args, mock_server
 ):
     mock_loop = MagicMock()
     mock_get_running_loop.return_value = mock_loop
     ssl_context = MagicMock()
-    mock_ssl_create_default_context.return_value = ssl_context
+    mock_ssl_context.return_value = ssl_context
     mock_server.close = MagicMock()
     mock_server.serve_forever.side_effect = asyncio.exceptions.CancelledError
     with patch("asyncio.start_server", return_value=mock_server):
         with io.StringIO() as buf, redirect_stdout(buf):
             server = Server(server_args)
 
+            # In a task of its own, the cancellation thrown into it stops there
+            await asyncio.create_task(server.run())
+
+    assert mock_loop.add_signal_handler.call_args_list == [
+        call(signal.SIGINT, server.stop),
+        call(signal.SIGTERM, server.stop),
+        call(signal.SIGHUP, server.reload),
+        call(signal.SIGUSR2, server.restart, mock_server.sockets, server.stop),
+    ]
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext")
+async def test_server_run_as_worker(mock_ssl_context, server_args, mock_server):
+    mock_server.close = MagicMock()
+    with patch(
+        "asyncio.start_server", new_callable=AsyncMock, return_value=mock_server
+    ) as mock_start_server:
+        with io.StringIO() as buf, redirect_stdout(buf):
+            server = Server(server_args)
+            server.worker = 1
+            server.listening = MagicMock()
+
             await server.run()
+            server.stop()
+
+            assert mock_start_server.call_args.kwargs["reuse_port"]
+            server.listening.set.assert_called_once()
+            assert buf.getvalue() == f"Worker 1 (pid {os.getpid()}) listening on 127.0.0.1:8080.\n"
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext")
+async def test_server_run_takes_over_a_socket(mock_ssl_context, server_args, mock_server):
+    server_args.password = None
+    server_args.generate_cert_and_key = True
+    predecessor = MagicMock(password="inherited")
+    mock_server.close = MagicMock()
+    with patch("cmdbroker.server.handover.predecessor", return_value=predecessor):
+        with patch.object(Server, "generate_cert_and_key") as mock_generate:
+            server = Server(server_args)
+    with patch(
+        "asyncio.start_server", new_callable=AsyncMock, return_value=mock_server
+    ) as mock_start_server:
+        with io.StringIO() as buf, redirect_stdout(buf):
+            run = asyncio.create_task(server.run())
+            while not predecessor.ready.called:
+                await asyncio.sleep(0.001)
+            server.stop()
+            await run
 
-            mock_loop.add_signal_handler.assert_called_once_with(signal.SIGINT, server.stop)
+    # Neither prompted for the password nor made a new certificate
+    assert server.password == "inherited"
+    mock_generate.assert_not_called()
+    mock_start_server.assert_awaited_once_with(
+        server.handle_request, ssl=mock_ssl_context.return_value, sock=predecessor.socket
+    )
+    asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR2)
 
 
 @pytest.mark.asyncio
-@patch(
-    "cmdbroker.message.Message.json",
-    return_value={"method": "process", "parameters": {"command": "echo 'Hello World'"}},
+@pytest.mark.parametrize(
+    "pid, sockets, output",
+    [
+        (
+            4321,
+            [MagicMock()],
+            "Restarting, starting a new server on the same socket.\n"
+            "Server 4321 took over the port.\n",
+        ),
+        (
+            None,
+            [MagicMock()],
+            "Restarting, starting a new server on the same socket.\n"
+            "The new server did not start, this one keeps running.\n",
+        ),
+        (
+            4321,
+            [MagicMock(), MagicMock()],
+            "Restarting takes a server listening on a single address.\n",
+        ),
+    ],
 )
-async def test_handle_valid_process_request(mock_message, server):
-    # Dummy data, since we are mocking the json method
-    reader = AsyncMock()
-    reader.read = AsyncMock(side_effect=[b"0019", b'{"fake":"response"}'])
-    writer = AsyncMock()
-    writer.write = MagicMock()
-    writer.close = MagicMock()
+async def test_server_restart(server, mock_server, pid, sockets, output):
+    server.server = mock_server
+    mock_server.close = MagicMock()
 
-    await server.handle_request(reader, writer)
+    with patch("cmdbroker.server.handover.start_successor", return_value=pid) as mock_start:
+        with io.StringIO() as buf, redirect_stdout(buf):
+            server.restart(sockets, server.stop)
+            restarting = server.restarting
+            # Signalled again while it is at it
+            server.restart(sockets, server.stop)
+            await restarting
 
-    writer.write.assert_called_once_with(b"Hello World" + os.linesep.encode())
+            assert buf.getvalue() == output
+
+    assert server.restarting is restarting
+    assert mock_start.await_count == (len(sockets) == 1)
+    assert mock_server.close.called == (pid is not None and len(sockets) == 1)
 
 
 @pytest.mark.asyncio
-@patch(
-    "cmdbroker.message.Message.json",
-    return_value={"method": "bogus"},
-)
-async def test_handle_invalid_method_request(mock_message, server):
-    # Dummy data, since we are mocking the json method
-    reader = AsyncMock()
-    reader.read = AsyncMock(side_effect=[b"0019", b'{"fake":"response"}'])
-    writer = AsyncMock()
+async def test_server_drain_lets_requests_finish(server):
+    reader, writer = client_reader(process("sleep 0.1; echo done")), client_writer()
+    handler = asyncio.create_task(server.handle_request(reader, writer))
+    while not server.connections:
+        await asyncio.sleep(0.001)
 
-    with pytest.raises(ValueError):
-        await server.handle_request(reader, writer)
+    with io.StringIO() as buf, redirect_stdout(buf):
+        drain = asyncio.create_task(server.drain())
+        while answered(writer) != {1}:
+            await asyncio.sleep(0.001)
+        # The client hangs up once it got the output of its request
+        reader.feed_eof()
+        await drain
+
+        assert buf.getvalue() == "Waiting up to 30 seconds for the requests in flight.\n"
+
+    assert handler.done() and not handler.cancelled()
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.GOAWAY).output(),
+        Message(MessageType.STDOUT, b"done\n", 1).output(),
+        done().output(),
+    ]
+    assert server.connections == set()
 
 
 @pytest.mark.asyncio
-@patch(
-    "cmdbroker.message.Message.json",
-    return_value={
-        "method": "process",
-        "stdin": "Hello World",
-        "parameters": {"command": "grep Hello"},
-    },
-)
-async def test_handle_valid_process_request_with_stdin(mock_message, server):
-    # Dummy data, since we are mocking the json method
-    reader = AsyncMock()
-    reader.read = AsyncMock(side_effect=[b"0019", b'{"fake":"response"}'])
-    writer = AsyncMock()
-    writer.write = MagicMock()
-    writer.close = MagicMock()
+async def test_server_drain_cancels_requests_at_the_deadline(server_args):
+    server_args.drain_timeout = 0.05
+    server = Server(server_args)
+    server.worker = 1
+    reader, writer = client_reader(process("sleep 10")), client_writer()
+    handler = asyncio.create_task(server.handle_request(reader, writer))
+    while not server.scheduler.running:
+        await asyncio.sleep(0.001)
 
-    await server.handle_request(reader, writer)
+    await asyncio.wait_for(server.drain(), 5)
+
+    assert handler.done() and not handler.cancelled()
+    assert answered(writer) == set()
+    writer.close.assert_called_once()
+    assert server.connections == set()
+
+
+@pytest.mark.asyncio
+async def test_server_drain_without_connections(server):
+    with io.StringIO() as buf, redirect_stdout(buf):
+        await server.drain()
+
+        assert buf.getvalue() == ""
+    assert server.draining.is_set()
+
+
+class FakeWorker:
+    """Stands in for a worker process, which runs until it is stopped unless it crashed."""
+
+    def __init__(self, exitcode=None, stubborn=False):
+        self.exitcode = exitcode
+        self.stubborn = stubborn
+        self.done = threading.Event()
+        if exitcode is not None:
+            self.done.set()
+
+    def start(self):
+        pass
+
+    def join(self):
+        self.done.wait()
+
+    def terminate(self):
+        if not self.stubborn:
+            self.kill()
+
+    def kill(self):
+        self.exitcode = -signal.SIGTERM
+        self.done.set()
+
+
+@pytest.fixture
+def spawned():
+    """Replace the worker processes with fakes, handed out in the order they are listed."""
+    workers = []
+    context = MagicMock()
+    context.Process.side_effect = lambda **kwargs: workers.pop(0)
+    with patch("multiprocessing.get_context", return_value=context) as get_context:
+        yield workers, context.Process
+    get_context.assert_called_with("spawn")
+
+
+async def supervise(server, process, started):
+    """Run the supervisor until `started` workers were started, then stop it."""
+    task = asyncio.create_task(server.run())
+    while process.call_count < started:
+        await asyncio.sleep(0.01)
+    server.stopping.set()
+    await task
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext", MagicMock())
+@patch("cmdbroker.server.WORKER_RESTART_DELAY", 0.01)
+# The clock stands still, the crashed worker exited as soon as it started
+@patch("cmdbroker.server.time", MagicMock(wraps=time, **{"monotonic.return_value": 0.0}))
+async def test_server_supervises_workers(server_args, spawned):
+    workers, process = spawned
+    server_args.port = 0
+    server_args.workers = 2
+    server_args.metrics_port = 9100
+    server = Server(server_args)
+    crashed, running, replacement = FakeWorker(exitcode=1), FakeWorker(), FakeWorker()
+    workers.extend([crashed, running, replacement])
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        await supervise(server, process, 3)
+
+        output = buf.getvalue()
+
+    first, second, third = (kwargs for _, kwargs in process.call_args_list)
+    assert [kwargs["target"] for kwargs in (first, second, third)] == [run_worker] * 3
+    assert [kwargs["args"][1] for kwargs in (first, second, third)] == [0, 1, 0]
+    params = second["args"][0]
+    assert params.port != 0
+    assert params.port == third["args"][0].port
+    assert (params.password, params.generate_cert_and_key) == ("test-password", False)
+    assert (first["args"][0].metrics_port, params.metrics_port) == (9100, 9101)
+    assert output.startswith(f"Server listening on 127.0.0.1:{params.port} with 2 workers.")
+    assert "Worker 0 exited with status 1, restarting it.\n" in output
+    assert output.endswith("Server stopped by user.\n")
+    assert running.exitcode == replacement.exitcode == -signal.SIGTERM
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext", MagicMock())
+@patch("cmdbroker.server.WORKER_RESTART_DELAY", 0)
+async def test_server_supervises_workers_without_stdout(server_args, spawned):
+    workers, process = spawned
+    server_args.port = 0
+    server_args.workers = 2
+    server = Server(server_args)
+    crashed, running, replacement = FakeWorker(exitcode=1), FakeWorker(), FakeWorker()
+    workers.extend([crashed, running, replacement])
+
+    with redirect_stdout(MagicMock(write=MagicMock(side_effect=BrokenPipeError))):
+        await supervise(server, process, 3)
+
+    assert running.exitcode == replacement.exitcode == -signal.SIGTERM
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext", MagicMock())
+@patch("cmdbroker.server.WORKER_STOP_TIMEOUT", 0.01)
+@patch("cmdbroker.server.WORKER_RESTART_DELAY", 0)
+async def test_server_kills_workers_that_do_not_stop(server_args, spawned):
+    workers, process = spawned
+    server_args.port = 0
+    server_args.workers = 2
+    server = Server(server_args)
+    stubborn = FakeWorker(stubborn=True)
+    # The first worker is restarted right away, it ran for long enough
+    workers.extend([FakeWorker(exitcode=0), stubborn, FakeWorker()])
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        await supervise(server, process, 3)
+
+    assert stubborn.exitcode == -signal.SIGTERM
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext")
+@patch("multiprocessing.get_context")
+async def test_server_supervisor_checks_the_key_password(
+    mock_get_context, mock_ssl_context, server_args
+):
+    server_args.workers = 2
+    mock_ssl_context.return_value.load_cert_chain.side_effect = ssl.SSLError
+
+    with io.StringIO() as buf, redirect_stdout(buf):
+        with pytest.raises(SystemExit):
+            await Server(server_args).run()
+
+    mock_get_context.assert_not_called()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext", MagicMock())
+async def test_server_supervisor_takes_over_a_port(server_args):
+    server_args.workers = 2
+    predecessor = MagicMock()
+    predecessor.socket.getsockname.return_value = ("127.0.0.1", 8123)
+    with patch("cmdbroker.server.handover.predecessor", return_value=predecessor):
+        server = Server(server_args)
+    listening = [threading.Event(), threading.Event()]
+    workers = [FakeWorker(), FakeWorker()]
+
+    with patch("multiprocessing.get_context") as get_context:
+        get_context.return_value.Event.side_effect = listening
+        get_context.return_value.Process.side_effect = lambda **kwargs: workers.pop(0)
+        with io.StringIO() as buf, redirect_stdout(buf):
+            task = asyncio.create_task(server.run())
+            await asyncio.sleep(0.15)
+            # It only hands over once every worker accepts connections
+            predecessor.ready.assert_not_called()
+            for event in listening:
+                event.set()
+            while not predecessor.ready.called:
+                await asyncio.sleep(0.01)
+            server.stopping.set()
+            await task
+
+    assert get_context.return_value.Process.call_args.kwargs["args"][0].port == 8123
+    predecessor.socket.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.TimedSSLContext", MagicMock())
+async def test_server_supervisor_restart(server_args, spawned):
+    workers, process = spawned
+    server_args.port = 0
+    server_args.workers = 2
+    server = Server(server_args)
+    running = [FakeWorker(), FakeWorker()]
+    workers.extend(running)
+
+    with patch("cmdbroker.server.handover.start_successor", return_value=4321) as mock_start:
+        with io.StringIO() as buf, redirect_stdout(buf):
+            task = asyncio.create_task(server.run())
+            while process.call_count < 2:
+                await asyncio.sleep(0.01)
+            os.kill(os.getpid(), signal.SIGUSR2)
+            await task
+
+            output = buf.getvalue()
+
+    reserved, password = mock_start.await_args.args
+    assert isinstance(reserved, socket.socket)
+    assert password == "test-password"
+    assert output.endswith("Server 4321 took over the port.\n")
+    assert [worker.exitcode for worker in running] == [-signal.SIGTERM] * 2
+    asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR2)
+
+
+def test_run_worker(server_args):
+    listening = MagicMock()
+    with patch.object(Server, "run", autospec=True) as mock_run:
+        run_worker(server_args, 3, listening)
+
+    server = mock_run.call_args.args[0]
+    assert (server.worker, server.port, server.listening) == (3, 8080, listening)
+
+
+@pytest.mark.asyncio
+async def test_handle_valid_process_request(server):
+    reader = client_reader(process("echo 'Hello World'"))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"Hello World" + os.linesep.encode(), 1).output(),
+        done().output(),
+    ]
+    writer.close.assert_called_once()
+    writer.wait_closed.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_handle_failing_process_request(server):
+    reader = client_reader(process("exit 3"))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        end(returncode=3, wait_time=0.0, rusage=RUSAGE).output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_process_request_in_warm_shells(server_args):
+    server_args.warm_shells = 1
+    server = Server(server_args)
+    server.shells.fill()
+    await server.shells.refill_task
+    reader = client_reader(
+        process("cat", stdin=True),
+        Message(MessageType.STDIN, b"warm", 1),
+        Message(MessageType.STDIN, b"", 1),
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"warm", 1).output(),
+        done().output(),
+    ]
+    await server.shells.refill_task
+
+
+def exec_(argv, stream_id=1, **parameters):
+    return Message.build({"method": "exec", "parameters": {"argv": argv, **parameters}}, stream_id)
+
+
+@pytest.mark.asyncio
+async def test_handle_exec_request(server):
+    reader = client_reader(
+        exec_(["sh", "-c", 'echo "$FOO from $(pwd)"'], cwd="/", env={"FOO": "bar"})
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"bar from /\n", 1).output(),
+        done().output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_exec_request_with_stdin(server):
+    reader = client_reader(
+        Message.build({"method": "exec", "parameters": {"argv": ["cat"]}, "stdin": True}, 1),
+        Message(MessageType.STDIN, b"$HOME", 1),
+        Message(MessageType.STDIN, b"", 1),
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"$HOME", 1).output(),
+        done().output(),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("argv", [[], "echo", ["echo", 1], None])
+async def test_handle_exec_request_invalid_argv(server, argv):
+    reader = client_reader(exec_(argv))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        end(error="argv must be a non-empty list of strings").output(),
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "parameters, error",
+    [
+        ({"cwd": 1}, "cwd must be a string"),
+        ({"env": ["A"]}, "env must map strings to strings"),
+        ({"env": {"A": 1}}, "env must map strings to strings"),
+    ],
+)
+async def test_handle_exec_request_invalid_cwd_or_env(server, parameters, error):
+    reader = client_reader(
+        exec_(["true"], **parameters), batch([{"argv": ["true"], **parameters}], 2)
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert end(error=error).output() in written(writer)
+    assert [result["error"] for result in results(writer)] == [error]
+
+
+@pytest.mark.asyncio
+async def test_handle_exec_request_missing_program(server):
+    reader = client_reader(exec_(["/nonexistent/program"]))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        end(error="[Errno 2] No such file or directory: '/nonexistent/program'").output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_invalid_method_request(server):
+    reader = client_reader(Message.build({"method": "bogus"}, 1))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [welcome().output(), end(error="Invalid method: bogus").output()]
+    assert server.metrics.requests.values == {(("method", "invalid"),): 1}
+    assert server.metrics.errors.values == {(("error", "ValueError"),): 1}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "request_json, error",
+    [
+        ([], "A request must be a JSON object with a method"),
+        ({"parameters": {"command": "echo"}}, "A request must be a JSON object with a method"),
+        ({"method": 1}, "A request must be a JSON object with a method"),
+        ({"method": "process"}, "A process request needs its parameters as a JSON object"),
+        (
+            {"method": "batch", "parameters": ["echo"]},
+            "A batch request needs its parameters as a JSON object",
+        ),
+        ({"method": "process", "parameters": {}}, "command must be a string"),
+        ({"method": "process", "parameters": {"command": ["echo"]}}, "command must be a string"),
+    ],
+)
+async def test_handle_malformed_request(server, request_json, error):
+    reader = client_reader(Message.build(request_json, 1))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [welcome().output(), end(error=error).output()]
+    assert server.metrics.errors.values == {(("error", "ValueError"),): 1}
+
+
+@pytest.mark.asyncio
+async def test_handle_request_unexpected_error(server):
+    reader = client_reader(process("echo 'Hello World'"))
+    writer = client_writer()
+
+    with patch.object(server, "process_request", side_effect=KeyError("command")):
+        await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        end(error="Internal server error: KeyError: 'command'").output(),
+    ]
+    assert server.metrics.errors.values == {(("error", "KeyError"),): 1}
+
+
+@pytest.mark.asyncio
+async def test_handle_valid_process_request_with_stdin(server):
+    reader = client_reader(
+        process("grep Hello", stdin=True),
+        Message(MessageType.STDIN, b"Hello ", 1),
+        Message(MessageType.STDIN, b"World" + os.linesep.encode(), 1),
+        Message(MessageType.STDIN, b"", 1),
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"Hello World" + os.linesep.encode(), 1).output(),
+        done().output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_process_request_streams_stderr(server):
+    reader = client_reader(process("echo out; echo err >&2"))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    writes = written(writer)
+    assert writes[0] == welcome().output()
+    assert Message(MessageType.STDOUT, b"out" + os.linesep.encode(), 1).output() in writes
+    assert Message(MessageType.STDERR, b"err" + os.linesep.encode(), 1).output() in writes
+    assert writes[-1] == done().output()
+
+
+@pytest.mark.asyncio
+async def test_handle_process_request_ignoring_stdin(server):
+    # The command exits without reading stdin and the client never finishes sending it
+    reader = client_reader(process("true", stdin=True), Message(MessageType.STDIN, b"unread", 1))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [welcome().output(), done().output()]
+
+
+@pytest.mark.asyncio
+async def test_handle_concurrent_requests(server):
+    reader = client_reader(
+        process("sleep 0.2; echo first", stream_id=1),
+        process("echo second", stream_id=2),
+        Message(MessageType.STDIN, b"unknown stream", 3),
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"second" + os.linesep.encode(), 2).output(),
+        done(2).output(),
+        Message(MessageType.STDOUT, b"first" + os.linesep.encode(), 1).output(),
+        done(1).output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_request_over_the_queue_limit(server_args):
+    server_args.max_processes = 1
+    server_args.max_queued = 0
+    server = Server(server_args)
+    reader = client_reader(
+        process("sleep 0.2; echo first", stream_id=1), process("echo second", stream_id=2)
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        end(2, error="Server is busy, 0 commands are already queued").output(),
+        Message(MessageType.STDOUT, b"first" + os.linesep.encode(), 1).output(),
+        done(1).output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_request_over_the_request_rate(server_args):
+    server_args.rate_limit_requests = 1
+    server = Server(server_args)
+    reader = client_reader(process("echo first", stream_id=1), process("echo second", stream_id=2))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    throttled = {"limit": "requests", "retry_after": 1.0}
+    assert written(writer) == [
+        welcome().output(),
+        end(2, error="Too many requests, at most 1 per second", throttled=throttled).output(),
+        Message(MessageType.STDOUT, b"first" + os.linesep.encode(), 1).output(),
+        done(1).output(),
+    ]
+    assert server.metrics.errors.values == {(("error", "ThrottledError"),): 1}
+
+
+@pytest.mark.asyncio
+async def test_handle_request_over_the_client_command_limit(server_args):
+    server_args.max_client_processes = 1
+    server = Server(server_args)
+    reader = client_reader(
+        process("sleep 0.2; echo first", stream_id=1), process("echo second", stream_id=2)
+    )
+    writer = client_writer()
+    # Another client is not held up by the first one's limit
+    other_reader = client_reader(process("echo other"))
+    other_writer = client_writer(peername=("127.0.0.2", 50000))
+
+    await asyncio.gather(
+        handle_request(server, reader, writer), handle_request(server, other_reader, other_writer)
+    )
+
+    assert written(writer) == [
+        welcome().output(),
+        end(
+            2, error="Too many commands, at most 1 at once", throttled={"limit": "commands"}
+        ).output(),
+        Message(MessageType.STDOUT, b"first" + os.linesep.encode(), 1).output(),
+        done(1).output(),
+    ]
+    assert written(other_writer)[-1] == done().output()
+    assert server.limiter.clients["127.0.0.1"].commands == 0
+
+
+@pytest.mark.asyncio
+async def test_handle_request_over_the_byte_rate(server_args):
+    server_args.rate_limit_bytes = 2000
+    server = Server(server_args)
+    stdin = [Message(MessageType.STDIN, b"x" * 1000, 1) for _ in range(3)]
+    reader = client_reader(process("wc -c", stdin=True), *stdin, Message(MessageType.STDIN, b"", 1))
+    writer = client_writer()
+
+    with patch("cmdbroker.ratelimit.asyncio", sleep=AsyncMock()) as mock_asyncio:
+        await handle_request(server, reader, writer)
+
+    # The clock is frozen, a second's worth goes through and everything after is held off
+    delays = [args[0] for args, _ in mock_asyncio.sleep.await_args_list]
+    assert delays == sorted(delays)
+    assert delays[-1] > 0.5
+    assert frames(writer)[1].text.strip() == b"3000"
+    assert written(writer)[-1] == done().output()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("default, timeout", [(0, 0.2), (0.2, None), (60, 0.2)])
+async def test_handle_request_timeout(server, default, timeout):
+    # The request's timeout overrides the server's default
+    server.timeout = default
+    request = process("echo started; sleep 60", **({} if timeout is None else {"timeout": timeout}))
+    writer = client_writer()
+
+    await handle_request(server, client_reader(request), writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"started" + os.linesep.encode(), 1).output(),
+        end(error="Command timed out after 0.2 seconds").output(),
+    ]
+    assert server.metrics.errors.values == {(("error", "CommandTimeoutError"),): 1}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("timeout", [0, -1, "5", True])
+async def test_handle_request_invalid_timeout(server, timeout):
+    writer = client_writer()
+
+    await handle_request(server, client_reader(process("echo never", timeout=timeout)), writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        end(error="timeout must be a positive number of seconds").output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_request_client_disconnects(server):
+    reader = client_reader(process("echo started; sleep 60"))
+    writer = client_writer()
+
+    with patch.object(Process, "terminate", autospec=True, side_effect=Process.terminate) as stop:
+        handler = asyncio.create_task(server.handle_request(reader, writer))
+        while len(written(writer)) < 2:
+            await asyncio.sleep(0.01)
+        reader.feed_eof()
+        await asyncio.wait_for(handler, 5)
+
+    # The command is stopped, and there is nobody left to answer
+    (process_stopped,) = [call.args[0] for call in stop.await_args_list]
+    assert process_stopped.returncode == -signal.SIGTERM
+    assert answered(writer) == set()
+    assert server.metrics.errors.values == {(("error", "CancelledError"),): 1}
+    assert server.scheduler.running == 0
+
+
+@pytest.mark.asyncio
+async def test_handle_request_cancelled_by_the_client(server):
+    reader = client_reader(process("sleep 60", stream_id=1), process("sleep 0.2", stream_id=3))
+    reader.streams = {3}
+    writer = client_writer()
+    handler = asyncio.create_task(handle_request(server, reader, writer))
+    await asyncio.sleep(0.05)
+
+    reader.feed_data(Message(MessageType.CANCEL, b"", 1).output())
+    # Cancelling an unknown or finished stream does nothing
+    reader.feed_data(Message(MessageType.CANCEL, b"", 5).output())
+    await asyncio.wait_for(handler, 5)
+
+    assert written(writer) == [welcome().output(), done(3).output()]
+    assert server.metrics.errors.values == {(("error", "CancelledError"),): 1}
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_timeout(server):
+    commands = [{"command": "sleep 60"}, {"command": "echo fast"}]
+    request = Message.build(
+        {"method": "batch", "parameters": {"commands": commands}, "timeout": 0.2}, 1
+    )
+    writer = client_writer()
+
+    await handle_request(server, client_reader(request), writer)
+
+    assert [(result["index"], result.get("error")) for result in results(writer)] == [
+        (1, None),
+        (0, "Command timed out after 0.2 seconds"),
+    ]
+
+
+def batch(commands, stream_id=1, **parameters):
+    return Message.build(
+        {"method": "batch", "parameters": {"commands": commands, **parameters}}, stream_id
+    )
+
+
+def results(writer):
+    """The RESULT messages written, in the order they were sent."""
+    return [
+        json.loads(output[Message.HEADER.size :])
+        for output in written(writer)
+        if output[1] == MessageType.RESULT
+    ]
+
+
+def b64(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request(server):
+    reader = client_reader(
+        batch([{"command": "echo one"}, {"argv": ["sh", "-c", "echo two >&2; exit 2"]}])
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert sorted(results(writer), key=lambda result: result["index"]) == [
+        {
+            "index": 0,
+            "returncode": 0,
+            "wait_time": 0.0,
+            "rusage": RUSAGE,
+            "stdout": b64(b"one\n"),
+            "stderr": "",
+            "truncated": False,
+        },
+        {
+            "index": 1,
+            "returncode": 2,
+            "wait_time": 0.0,
+            "rusage": RUSAGE,
+            "stdout": "",
+            "stderr": b64(b"two\n"),
+            "truncated": False,
+        },
+    ]
+    assert written(writer)[-1] == end(returncode=1, succeeded=1, failed=1, skipped=0).output()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "parameters, order",
+    [({}, [1, 0]), ({"parallel": False}, [0, 1]), ({"max_parallel": 1}, [0, 1])],
+)
+async def test_handle_batch_request_parallelism(server, parameters, order):
+    reader = client_reader(
+        batch([{"command": "sleep 0.2; echo slow"}, {"command": "echo fast"}], **parameters)
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert [result["index"] for result in results(writer)] == order
+    assert written(writer)[-1] == end(returncode=0, succeeded=2, failed=0, skipped=0).output()
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_within_the_client_command_limit(server_args):
+    server_args.max_client_processes = 1
+    server = Server(server_args)
+    reader = client_reader(
+        batch([{"command": "sleep 0.2; echo slow"}, {"command": "echo fast"}], max_parallel=2)
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    # The batch runs its commands one at a time instead of having them throttled
+    assert [result["index"] for result in results(writer)] == [0, 1]
+    assert written(writer)[-1] == end(returncode=0, succeeded=2, failed=0, skipped=0).output()
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_over_the_client_command_limit(server_args):
+    server_args.max_client_processes = 1
+    server = Server(server_args)
+    reader = client_reader(process("sleep 0.2"), batch([{"command": "echo one"}], stream_id=2))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert results(writer) == [
+        {
+            "index": 0,
+            "error": "Too many commands, at most 1 at once",
+            "throttled": {"limit": "commands"},
+        }
+    ]
+    assert end(2, returncode=1, succeeded=0, failed=1, skipped=0).output() in written(writer)
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_stop_on_failure(server):
+    reader = client_reader(
+        batch(
+            [{"command": "exit 1"}, {"command": "echo skipped"}],
+            parallel=False,
+            stop_on_failure=True,
+        )
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert [result["index"] for result in results(writer)] == [0, 1]
+    assert results(writer)[0]["returncode"] == 1
+    assert results(writer)[1] == {"index": 1, "skipped": True}
+    assert written(writer)[-1] == end(returncode=1, succeeded=0, failed=1, skipped=1).output()
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_command_errors(server_args):
+    server_args.max_processes = 1
+    server_args.max_queued = 0
+    server = Server(server_args)
+    reader = client_reader(
+        batch(
+            [
+                {"argv": []},
+                {"argv": ["/nonexistent/program"]},
+                {"command": "sleep 0.1"},
+                {"command": "true"},
+            ],
+            max_parallel=2,
+        )
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    errors = {result["index"]: result.get("error") for result in results(writer)}
+    assert errors == {
+        0: "argv must be a non-empty list of strings",
+        1: "[Errno 2] No such file or directory: '/nonexistent/program'",
+        2: None,
+        3: "Server is busy, 0 commands are already queued",
+    }
+    assert server.metrics.errors.values == {
+        (("error", "ValueError"),): 1,
+        (("error", "FileNotFoundError"),): 1,
+        (("error", "QueueFullError"),): 1,
+    }
+    assert server.metrics.command_duration.counts[(("method", "process"),)][0] == 1
+    assert written(writer)[-1] == end(returncode=1, succeeded=1, failed=3, skipped=0).output()
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_truncates_output(server):
+    # A quarter of the 1024 byte frame size is kept of each stream
+    reader = client_reader(batch([{"command": "head -c 200000 /dev/zero; echo err >&2"}]))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    [result] = results(writer)
+    assert base64.b64decode(result["stdout"]) == bytes(256)
+    assert base64.b64decode(result["stderr"]) == b"err\n"
+    assert result["truncated"]
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.MAX_FRAME_SIZE", 512)
+async def test_handle_batch_request_truncates_output_for_the_client(server_args):
+    # Clients read frames of up to MAX_FRAME_SIZE, even if the server takes larger ones
+    server_args.max_frame_size = 1 << 20
+    server = Server(server_args)
+    reader = client_reader(batch([{"command": "head -c 200000 /dev/zero"}]))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    [result] = results(writer)
+    assert base64.b64decode(result["stdout"]) == bytes(128)
+    assert result["truncated"]
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_in_warm_shells(server_args):
+    server_args.warm_shells = 1
+    server = Server(server_args)
+    reader = client_reader(batch([{"command": "echo one"}, {"command": "echo two"}]))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert sorted(base64.b64decode(result["stdout"]) for result in results(writer)) == [
+        b"one\n",
+        b"two\n",
+    ]
+    await server.shells.refill_task
+    assert len(server.shells.shells) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "parameters, error",
+    [
+        ({"commands": []}, "commands must be a non-empty list"),
+        ({"commands": "echo"}, "commands must be a non-empty list"),
+        (
+            {"commands": [{"cwd": "/"}]},
+            "Each command of a batch needs either a command string or argv",
+        ),
+        (
+            {"commands": [{"command": "echo", "argv": ["echo"]}]},
+            "Each command of a batch needs either a command string or argv",
+        ),
+        ({"commands": ["echo"]}, "Each command of a batch needs either a command string or argv"),
+        (
+            {"commands": [{"command": "echo"}], "max_parallel": 0},
+            "max_parallel must be a positive integer",
+        ),
+    ],
+)
+async def test_handle_invalid_batch_request(server, parameters, error):
+    reader = client_reader(Message.build({"method": "batch", "parameters": parameters}, 1))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [welcome().output(), end(error=error).output()]
+
+
+@pytest.mark.asyncio
+async def test_handle_status_request(server):
+    reader = client_reader(Message.build({"method": "status"}, 1))
+    writer = client_writer()
+    writer.get_extra_info.return_value = None
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        end(scheduler=server.scheduler.stats()).output(),
+    ]
+    assert server.scheduler.stats()["max_running"] == 4
+
+
+@pytest.mark.asyncio
+async def test_handle_connection_reset(server):
+    reader = MagicMock()
+    reader.readexactly = AsyncMock(side_effect=ConnectionResetError)
+    writer = client_writer()
+
+    await server.handle_request(reader, writer)
+
+    writer.writelines.assert_not_called()
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_handle_request_without_hello(server):
+    # Clients predating the handshake open with their request
+    reader = client_reader(hello=process("echo 'Hello World'"))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        Message.build(
+            {"error": "Expected a HELLO message, the client is too old"}, 0, MessageType.HELLO
+        ).output()
+    ]
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_handle_request_unsupported_version(server):
+    reader = client_reader(hello=Message.build({"versions": [0]}, 0, MessageType.HELLO))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        Message.build(
+            {"error": f"Unsupported protocol version, the server speaks {SUPPORTED_VERSIONS}"},
+            0,
+            MessageType.HELLO,
+        ).output()
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "hello",
+    [Message(MessageType.HELLO, b"{"), Message.build({"compression": 1}, 0, MessageType.HELLO)],
+)
+async def test_handle_request_malformed_hello(server, hello):
+    reader = client_reader(hello=hello)
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    ((error,),) = (json.loads(output[Message.HEADER.size :]).values() for output in written(writer))
+    assert error.startswith("The HELLO message")
+    assert server.metrics.connections.values == {(): 0}
+    assert server.connections == set()
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_handle_request_gone_before_the_error(server):
+    reader = client_reader(hello=Message(MessageType.HELLO, b"{"))
+    writer = client_writer()
+    writer.drain.side_effect = ConnectionResetError
+
+    await handle_request(server, reader, writer)
+
+    assert server.metrics.connections.values == {(): 0}
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("error", [ConnectionResetError, ssl.SSLError])
+async def test_handle_request_closes_while_the_client_sends(server, error):
+    reader = client_reader()
+    writer = client_writer()
+    writer.wait_closed.side_effect = error
+
+    await handle_request(server, reader, writer)
+
+    writer.close.assert_called_once()
+    assert server.metrics.connections.values == {(): 0}
+
+
+@pytest.mark.asyncio
+async def test_handle_request_oversized_frame(server):
+    # The server stops reading instead of buffering the advertised payload
+    reader = client_reader(process("x" * 1024))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message.build(
+            {"error": "Message of 1076 bytes exceeds the maximum of 1024"}, 0, MessageType.HELLO
+        ).output(),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_handle_request_bad_frame_after_hello(server):
+    reader = asyncio.StreamReader()
+    reader.feed_data(Message.hello().output() + b"\xff" * Message.HEADER.size)
+    writer = client_writer()
+
+    await server.handle_request(reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message.build({"error": "Unsupported protocol version 255"}, 0, MessageType.HELLO).output(),
+    ]
+    assert server.metrics.errors.values == {(("error", "ProtocolError"),): 1}
+
+
+@pytest.mark.asyncio
+async def test_handle_request_metrics(server):
+    request = process("echo 'Hello World'")
+    reader = client_reader(request)
+    writer = client_writer()
+    # The clock is frozen at 0, the handshake started a quarter of a second before
+    extra_info = {"peername": ("127.0.0.1", 50000), "ssl_object": SimpleNamespace()}
+    extra_info["ssl_object"].handshake_started = -0.25
+    writer.get_extra_info.side_effect = extra_info.get
+
+    await handle_request(server, reader, writer)
+
+    metrics = server.metrics
+    assert metrics.accepted.values == {(): 1}
+    assert metrics.connections.values == {(): 0}
+    assert metrics.handshake_duration.sums == {(): 0.25}
+    assert metrics.requests.values == {(("method", "process"),): 1}
+    assert metrics.errors.values == {}
+    assert sum(metrics.wait_time.counts[()]) == 1
+    assert sum(metrics.command_duration.counts[(("method", "process"),)]) == 1
+    assert metrics.received_bytes.values == {
+        (): len(Message.hello().output()) + len(request.output())
+    }
+    assert metrics.sent_bytes.values == {(): sum(len(output) for output in written(writer))}
+    writer.close.assert_called_once()
+
+
+def frames(writer):
+    """The messages written, parsed back."""
+    messages = []
+    for output in written(writer):
+        _, message_type, flags, stream_id, _ = Message.HEADER.unpack_from(output)
+        messages.append(
+            Message(MessageType(message_type), output[Message.HEADER.size :], stream_id, flags)
+        )
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_handle_request_with_compression(server):
+    server.max_frame_size = 64 * 1024
+    log = b"".join(b"line %d of a very repetitive log\n" % i for i in range(200))
+    stdin = compress(Message(MessageType.STDIN, log, 1), CODECS["zlib"])
+    assert stdin.flags == COMPRESSED
+    reader = client_reader(
+        process("cat", stdin=True),
+        stdin,
+        Message(MessageType.STDIN, b"", 1),
+        hello=Message.hello(["bogus", "zlib"]),
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    welcome_message, *output, end_message = frames(writer)
+    assert welcome_message.json() == {"version": PROTOCOL_VERSION, "compression": "zlib"}
+    assert all(message.flags == COMPRESSED for message in output)
+    assert b"".join(decompress(message, CODECS["zlib"], len(log)).text for message in output) == log
+    assert end_message.output() == done().output()
+
+
+@pytest.mark.asyncio
+async def test_handle_request_without_common_compression(server):
+    reader = client_reader(process("true"), hello=Message.hello(["bogus"]))
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    assert written(writer) == [welcome().output(), done().output()]
+
+
+@pytest.mark.asyncio
+async def test_handle_request_compressed_without_agreement(server):
+    reader = client_reader(
+        process("true", stdin=True),
+        Message(MessageType.STDIN, zlib.compress(b"input"), 1, COMPRESSED),
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    error = {"error": "Received a compressed message without agreeing on compression"}
+    assert Message.build(error, 0, MessageType.HELLO).output() in written(writer)
+
+
+@pytest.mark.asyncio
+async def test_handle_request_with_timings(server):
+    reader = client_reader(process("true", timings=True), process("true", stream_id=2))
+    writer = client_writer()
+    writer.get_extra_info.side_effect = {
+        "peername": ("127.0.0.1", 50000),
+        "ssl_object": SimpleNamespace(handshake_started=-0.25),
+    }.get
+
+    await handle_request(server, reader, writer)
+
+    ends = {message.stream_id: message.json() for message in frames(writer)[1:]}
+    # The clock is frozen at 0
+    assert ends[1] == {
+        "returncode": 0,
+        "wait_time": 0.0,
+        "rusage": RUSAGE,
+        "request_id": ANY,
+        "timings": {
+            "handshake": 0.25,
+            "read": 0.0,
+            "queue": 0.0,
+            "spawn": 0.0,
+            "run": 0.0,
+            "total": 0.0,
+        },
+    }
+    assert len(ends[1]["request_id"]) == 32
+    assert ends[2] == {"returncode": 0, "wait_time": 0.0, "rusage": RUSAGE}
+
+
+@pytest.mark.asyncio
+async def test_handle_batch_request_with_timings(server):
+    reader = client_reader(
+        Message.build(
+            {
+                "method": "batch",
+                "parameters": {"commands": [{"command": "true"}, {"argv": ["true"]}]},
+                "timings": True,
+            },
+            1,
+        )
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    timings = frames(writer)[-1].json()["timings"]
+    assert set(timings) == {"read", "queue", "spawn", "run", "write", "total"}
+
+
+@pytest.mark.asyncio
+async def test_handle_request_logs_requests(server_args, capsys):
+    server_args.log_requests = True
+    server = Server(server_args)
+    reader = client_reader(
+        process("exit 3"), Message.build({"method": "bogus"}, 2), Message(text=b"{", stream_id=3)
+    )
+    writer = client_writer()
+
+    await handle_request(server, reader, writer)
+
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(lines, key=lambda line: line["stream_id"]) == [
+        {
+            "request_id": ANY,
+            "client": "127.0.0.1",
+            "stream_id": 1,
+            "method": "process",
+            "returncode": 3,
+            "timings": {
+                "read": 0.0,
+                "queue": 0.0,
+                "spawn": 0.0,
+                "run": 0.0,
+                "write": 0.0,
+                "total": 0.0,
+            },
+        },
+        {
+            "request_id": ANY,
+            "client": "127.0.0.1",
+            "stream_id": 2,
+            "method": "bogus",
+            "error": "Invalid method: bogus",
+            "timings": {"read": 0.0, "write": 0.0, "total": 0.0},
+        },
+        {
+            "request_id": ANY,
+            "client": "127.0.0.1",
+            "stream_id": 3,
+            "method": None,
+            "error": ANY,
+            "timings": {"read": 0.0, "write": 0.0, "total": 0.0},
+        },
+    ]
+    assert len({line["request_id"] for line in lines}) == 3
+
+
+@pytest.fixture
+def cached_server(server_args):
+    server_args.cache_ttl = 60
+    return Server(server_args)
+
+
+def cached_end(stream_id=1, **response):
+    return end(stream_id, returncode=0, wait_time=0.0, rusage=RUSAGE, **response)
+
+
+@pytest.mark.asyncio
+async def test_handle_cached_process_requests(cached_server):
+    reader = asyncio.StreamReader()
+    reader.feed_data(Message.hello().output() + process("echo cached", stream_id=1).output())
+    writer = client_writer()
+    handler = asyncio.create_task(cached_server.handle_request(reader, writer))
+    while len(written(writer)) < 3:
+        await asyncio.sleep(0.01)
+    for message in (process("echo cached", stream_id=2), process("echo cached", 3, cache=False)):
+        reader.feed_data(message.output())
+    while answered(writer) != {1, 2, 3}:
+        await asyncio.sleep(0.01)
+    reader.feed_eof()
+    await handler
+
+    output = Message(MessageType.STDOUT, b"cached" + os.linesep.encode(), 1)
+    writes = written(writer)
+    assert writes[:3] == [welcome().output(), output.output(), cached_end(1).output()]
+    # The second request is answered from the cache, the third one opted out of it
+    assert Message(MessageType.STDOUT, output.text, 2).output() in writes[3:]
+    assert cached_end(2, cached=True).output() in writes[3:]
+    assert Message(MessageType.STDOUT, output.text, 3).output() in writes[3:]
+    assert cached_end(3).output() in writes[3:]
+    assert cached_server.cache.stats() == {
+        "entries": 1,
+        "size": len(output.text),
+        "hits": 1,
+        "misses": 1,
+        "coalesced": 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_handle_concurrent_identical_requests(cached_server):
+    reader = client_reader(
+        process("sleep 0.2; echo shared", stream_id=1),
+        process("sleep 0.2; echo shared", stream_id=2),
+    )
+    writer = client_writer()
+
+    await handle_request(cached_server, reader, writer)
+
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"shared" + os.linesep.encode(), 1).output(),
+        cached_end(1).output(),
+        Message(MessageType.STDOUT, b"shared" + os.linesep.encode(), 2).output(),
+        cached_end(2, cached=True).output(),
+    ]
+    assert cached_server.cache.coalesced == 1
+    assert cached_server.cache.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_handle_cached_requests_with_stdin(cached_server):
+    reader = client_reader(
+        process("cat", stream_id=1, stdin=True),
+        Message(MessageType.STDIN, b"first", 1),
+        Message(MessageType.STDIN, b"", 1),
+        process("cat", stream_id=2, stdin=True),
+        Message(MessageType.STDIN, b"second", 2),
+        Message(MessageType.STDIN, b"", 2),
+    )
+    writer = client_writer()
+
+    await handle_request(cached_server, reader, writer)
+
+    writes = written(writer)
+    assert Message(MessageType.STDOUT, b"first", 1).output() in writes
+    assert Message(MessageType.STDOUT, b"second", 2).output() in writes
+    assert cached_server.cache.misses == 2
+
+
+@pytest.mark.asyncio
+async def test_handle_cached_request_with_large_stdin(cached_server):
+    chunks = [b"x" * 1000, b"y" * 1000, b"z" * 1000]
+    reader = client_reader(
+        process("wc -c", stream_id=1, stdin=True),
+        *(Message(MessageType.STDIN, chunk, 1) for chunk in chunks),
+        Message(MessageType.STDIN, b"", 1),
+    )
+    writer = client_writer()
+
+    await handle_request(cached_server, reader, writer)
+
+    # Too large to cache, the command still gets all of it
+    assert written(writer) == [
+        welcome().output(),
+        Message(MessageType.STDOUT, b"3000" + os.linesep.encode(), 1).output(),
+        cached_end().output(),
+    ]
+    assert cached_server.cache.stats()["misses"] == 0
+
+
+@pytest.mark.asyncio
+async def test_handle_cached_request_failure_is_not_kept(cached_server):
+    reader = client_reader(process("exit 1", stream_id=1), process("exit 1", stream_id=2))
+    writer = client_writer()
+
+    await handle_request(cached_server, reader, writer)
+
+    assert cached_server.cache.entries == {}
+
+
+@pytest.mark.asyncio
+async def test_handle_status_request_with_cache(cached_server):
+    reader = client_reader(Message.build({"method": "status"}, 1))
+    writer = client_writer()
+
+    await handle_request(cached_server, reader, writer)
+
+    assert (
+        written(writer)[-1]
+        == end(
+            scheduler=cached_server.scheduler.stats(), cache=cached_server.cache.stats()
+        ).output()
+    )
+
+
+@pytest.mark.asyncio
+@patch("cmdbroker.server.CHUNK_SIZE", 4)
+async def test_stream_output_drains_each_chunk():
+    stream = asyncio.StreamReader()
+    stream.feed_data(b"0123456789")
+    stream.feed_eof()
+    writer = client_writer()
+
+    await Server.stream_output(stream, MessageType.STDOUT, 5, writer)
+
+    assert written(writer) == [
+        Message(MessageType.STDOUT, b"0123", 5).output(),
+        Message(MessageType.STDOUT, b"4567", 5).output(),
+        Message(MessageType.STDOUT, b"89", 5).output(),
+    ]
+    assert writer.drain.await_count == 3
+
+
+async def chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_stream_input():
+    stdin = MagicMock()
+    stdin.is_closing.return_value = False
+    stdin.drain = AsyncMock()
+
+    await Server.stream_input(chunks(b"chunk"), stdin)
+
+    stdin.write.assert_called_once_with(b"chunk")
+    stdin.drain.assert_awaited_once()
+    stdin.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_stream_input_command_stopped_reading():
+    stdin = MagicMock()
+    stdin.is_closing.side_effect = [False, True]
+    stdin.drain = AsyncMock(side_effect=BrokenPipeError)
+
+    await Server.stream_input(chunks(b"first", b"second"), stdin)
 
-    writer.write.assert_called_once_with(b"Hello World" + os.linesep.encode())
+    stdin.write.assert_called_once_with(b"first")
+    assert stdin.close.call_count == 2
@@ -0,0 +1,50 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from cmdbroker.tracing import TimedWriter, Trace
+
+
+def test_trace():
+    with patch("time.perf_counter", side_effect=[1.0, 1.5, 2.0, 3.0, 3.5, 4.0]):
+        trace = Trace(handshake=0.25)
+        trace.add("run", 0.125)
+        with trace.phase("spawn"):
+            pass
+        with trace.phase("spawn"):
+            pass
+
+        assert trace.timings() == {"handshake": 0.25, "run": 0.125, "spawn": 1.0, "total": 3.0}
+
+
+def test_trace_ids_are_unique():
+    assert Trace().id != Trace().id
+    assert "handshake" not in Trace().timings()
+
+
+def test_trace_phase_counts_failures():
+    trace = Trace()
+
+    with pytest.raises(OSError):
+        with trace.phase("spawn"):
+            raise OSError
+
+    assert "spawn" in trace.timings()
+
+
+@pytest.mark.asyncio
+async def test_timed_writer():
+    trace = Trace()
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    timed = TimedWriter(writer, trace)
+
+    with patch("time.perf_counter", side_effect=[1.0, 1.5, 2.0, 2.25]):
+        timed.writelines([b"head", b"payload"])
+        await timed.drain()
+    timed.close()
+
+    writer.writelines.assert_called_once_with([b"head", b"payload"])
+    writer.drain.assert_awaited_once_with()
+    writer.close.assert_called_once_with()
+    assert trace.phases == {"write": 0.75}
@@ -0,0 +1,21 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from cmdbroker.writer import WriterProxy
+
+
+@pytest.mark.asyncio
+async def test_writer_proxy():
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    proxy = WriterProxy(writer)
+
+    proxy.writelines([b"head", b"payload"])
+    await proxy.drain()
+    proxy.close()
+
+    writer.writelines.assert_called_once_with([b"head", b"payload"])
+    writer.drain.assert_awaited_once_with()
+    writer.close.assert_called_once_with()
+    assert proxy.transport is writer.transport